@@ -1,5 +1,6 @@
+import copy
+import json
 import numpy as np
-from PIL import Image
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -7,36 +8,113 @@ import os
 import torch.optim as optim
 from torch.distributions.categorical import Categorical
 
+from numpy_actor import save_actor, file_digest
+from profiling import NULL_PROFILER
+
+# Written next to saved weights: observation config, best score...
+MODEL_INFO = "model_info.json"
+
+######## ADVANTAGE ESTIMATION
+def compute_gae(rewards, values, dones, gamma, gae_lambda, last_values=None, final_values=None):
+    """
+    Generalized Advantage Estimation with a single reverse scan.
+
+    Input:
+        rewards, values, dones: arrays (T,) or (T, N_envs), time first
+        gamma, gae_lambda: float, discount factors
+        last_values: optional array (N_envs,), values of the states that follow
+                     the rollout. Without them the last step has no bootstrap
+                     and its advantage is 0.
+        final_values: optional array like rewards, values of the last
+                      observations of the episodes cut at the step limit. These
+                      steps are done, they bootstrap from final_values instead
+                      of the first state of the next episode.
+    Return:
+        advantages and returns, float32 arrays with the shape of rewards
+    """
+    rewards = np.asarray(rewards, dtype=np.float32)
+    values = np.asarray(values, dtype=np.float32)
+    not_dones = 1.0 - np.asarray(dones, dtype=np.float32)
+    if final_values is not None:
+        rewards = rewards + gamma * np.asarray(final_values, dtype=np.float32)
+    advantages = np.zeros_like(rewards)
+
+    n_steps = rewards.shape[0]
+    gae = np.zeros(rewards.shape[1:], dtype=np.float32)
+    if last_values is None:
+        last_step = n_steps - 1
+    else:
+        last_step = n_steps
+        values = np.concatenate([values, np.asarray(last_values, dtype=np.float32)[None]])
+    # A done step neither bootstraps nor propagates the advantage of the next episode,
+    # the bootstrap of a cut episode was added to its last reward
+    for t in reversed(range(last_step)):
+        delta = rewards[t] + gamma * values[t+1] * not_dones[t] - values[t]
+        gae = delta + gamma * gae_lambda * not_dones[t] * gae
+        advantages[t] = gae
+    return advantages, advantages + values[:n_steps]
+
 ######## NETWORK ARCHITECTURE
+# Observations consumed by the networks
+OBS_MODES = ("lidar", "image", "both")
+# Size of the flattened output of the image branch for 84x84 frames
+IMAGE_FEATURES = 64 * 7 * 7
+
+def image_input():
+    return nn.Sequential(
+        nn.Conv2d(in_channels=1, out_channels=32, kernel_size=8, stride=4),
+        nn.ReLU(),
+        nn.Conv2d(32, 64, kernel_size=4, stride=2),
+        nn.ReLU(),
+        nn.Conv2d(64, 64, kernel_size=3, stride=1),
+        nn.ReLU()
+    )
+
+def lidar_input(n_lidar=4):
+    return nn.Sequential(
+        nn.Linear(n_lidar, 64),
+        nn.ReLU(),
+        nn.Linear(64,256),
+        nn.ReLU()
+    )
+
+def n_features(obs_mode):
+    if obs_mode not in OBS_MODES:
+        raise ValueError(f"Unknown observation mode {obs_mode!r}, expected one of {OBS_MODES}")
+    return (IMAGE_FEATURES if obs_mode != "lidar" else 0) + (256 if obs_mode != "image" else 0)
+
+def encode(network, state):
+    """
+    Features of the input branches used by the observation mode of the network.
+    The state is the lidar tensor, the image tensor or an (image, lidar) tuple.
+    """
+    if network.obs_mode == "lidar":
+        return network.input(state)
+    img_state = state if network.obs_mode == "image" else state[0]
+    X1 = network.input_1(img_state)
+    X1 = X1.view(X1.size(0), -1)
+    if network.obs_mode == "image":
+        return X1
+    X2 = network.input(state[1])
+    return torch.cat([X1, X2], dim=1)
+
 class ActorNetwork(nn.Module):
-    def __init__(self, n_actions, learning_rate, save_root_dir='../model/'):
+    def __init__(self, n_actions, learning_rate, save_root_dir='../model/', obs_mode="lidar", n_lidar=4):
         super(ActorNetwork, self).__init__()
         
         # Set the model name and save root directory        
         self.save_dir = os.path.join(save_root_dir, "actor_network_ppo")
         self.n_actions = n_actions
-        # Common layers
-        '''
-        self.input_1 = nn.Sequential(
-            nn.Conv2d(in_channels=1, out_channels=32, kernel_size=8, stride=4),
-            nn.ReLU(),
-            nn.Conv2d(32, 64, kernel_size=4, stride=2),
-            nn.ReLU(),
-            nn.Conv2d(64, 64, kernel_size=3, stride=1),
-            nn.ReLU()            
-        )
-        '''
+        self.obs_mode = obs_mode
+        # Input branches
+        if obs_mode != "lidar":
+            self.input_1 = image_input()
+        if obs_mode != "image":
+            self.input = lidar_input(n_lidar)
 
-        self.input = nn.Sequential(
-            nn.Linear(4, 64),
-            nn.ReLU(),
-            nn.Linear(64,256),
-            nn.ReLU()
-        )
-
-        
+        # Common layers
         self.common_layers = nn.Sequential(                        
-            nn.Linear(256,256),
+            nn.Linear(n_features(obs_mode),256),
             nn.Linear(256, self.n_actions),
             nn.Softmax(dim=-1)
         )
@@ -50,55 +128,56 @@ class ActorNetwork(nn.Module):
 
     def forward(self, state):    
 
-        #X1 = self.input_1(state[0])
-        #X1 = X1.view(X1.size(0), -1)        
+        X = encode(self, state)
         
-        X2 = self.input(state)
-                
-        
-        X = self.common_layers(X2)
-          
+        X = self.common_layers(X)
         
         distribution = Categorical(X)
         
         return distribution
 
-    def save_checkpoint(self):
+    def save_checkpoint(self, path=None):
         """
-        Save the model checkpoint.
+        Save the model checkpoint, by default in save_dir.
         """        
-        torch.save(self.state_dict(), self.save_dir)    
+        torch.save(self.state_dict(), path or self.save_dir)    
         print(f"Model saved!!!")
 
-    def load_checkpoint(self):
-        print(self.save_dir)
-        self.load_state_dict(torch.load("../model/actor_network_ppo"))
+    def load_checkpoint(self, path=None):
+        print(path or self.save_dir)
+        self.load_state_dict(torch.load(path or self.save_dir, map_location=self.device))
+
+    def export_numpy(self, path, weights_path=None):
+        """
+        Export the weights to the NumPy format read by NumpyActor, with the
+        digest of the saved weights they match (weights_path, by default
+        save_dir) when there is one.
+        """
+        if self.obs_mode != "lidar":
+            raise ValueError("Only lidar actors can be exported to NumPy")
+        layers = []
+        for module in list(self.input) + list(self.common_layers):
+            if isinstance(module, nn.Linear):
+                layers.append([module.weight.detach().cpu().numpy().T, module.bias.detach().cpu().numpy(), None])
+            elif isinstance(module, nn.ReLU):
+                layers[-1][2] = "relu"
+        weights_path = weights_path or self.save_dir
+        save_actor(path, layers, file_digest(weights_path) if os.path.exists(weights_path) else None)
 
 class CriticNetwork(nn.Module):
-    def __init__(self, learning_rate, chkpt_dir='../model/'):
+    def __init__(self, learning_rate, chkpt_dir='../model/', obs_mode="lidar", n_lidar=4):
         super(CriticNetwork, self).__init__()
 
         self.save_dir = os.path.join(chkpt_dir, "critic_network_ppo")
-        '''
-        self.input_1 = nn.Sequential(
-            nn.Conv2d(in_channels=1, out_channels=32, kernel_size=8, stride=4),
-            nn.ReLU(),
-            nn.Conv2d(32, 64, kernel_size=4, stride=2),
-            nn.ReLU(),
-            nn.Conv2d(64, 64, kernel_size=3, stride=1),
-            nn.ReLU()            
-        )
-        '''
-
-        self.input = nn.Sequential(
-            nn.Linear(4, 64),
-            nn.ReLU(),
-            nn.Linear(64,256),
-            nn.ReLU()
-        )
+        self.obs_mode = obs_mode
+        # Input branches
+        if obs_mode != "lidar":
+            self.input_1 = image_input()
+        if obs_mode != "image":
+            self.input = lidar_input(n_lidar)
 
         self.common_layers = nn.Sequential(
-            nn.Linear(256, 256),
+            nn.Linear(n_features(obs_mode), 256),
             #nn.Linear(256, 256),
             nn.ReLU(),            
             nn.Linear(256,1)
@@ -111,32 +190,25 @@ class CriticNetwork(nn.Module):
     
     def forward(self, state):
         
-        #X1 = self.input_1(state[0])
-        #X1 = X1.view(X1.size(0), -1)
-        X2 = self.input(state)
-        #print(X2)
-        #X = X2.view(X2.size(0), -1)
-        
-        #X = torch.cat([X1, X2], dim=1)
+        X = encode(self, state)
 
-        value = self.common_layers(X2)
+        value = self.common_layers(X)
         
         return value
     
-    def save_checkpoint(self):
-        torch.save(self.state_dict(), self.save_dir)
+    def save_checkpoint(self, path=None):
+        torch.save(self.state_dict(), path or self.save_dir)
 
-    def load_checkpoint(self):
-        self.load_state_dict(torch.load("../model/critic_network_ppo"))
+    def load_checkpoint(self, path=None):
+        self.load_state_dict(torch.load(path or self.save_dir, map_location=self.device))
 
     
 
 
 class DRL_algorithm:
 
-    def __init__(self, memory):
+    def __init__(self, memory, obs_mode="lidar", n_lidar=4, model_dir='../model/'):
 
-        self.training_finished = False
         self.update_network_counter = 1
         
         
@@ -154,87 +226,174 @@ class DRL_algorithm:
         self.same_action_counter = 0
 
         ####### MODELS        
+        # Observations consumed by the networks: "lidar", "image" or "both"
+        self.obs_mode = obs_mode
+        # Distances of a lidar observation, 4 lines or the beams of a RayLidar
+        self.n_lidar = n_lidar
         
-        self.actor = ActorNetwork(self.action_dim, learning_rate=0.0003)          
-        self.critic = CriticNetwork(learning_rate=0.0003)                       
+        # Default directory of save_model and load_models
+        self.actor = ActorNetwork(self.action_dim, learning_rate=0.0003, save_root_dir=model_dir, obs_mode=obs_mode,
+                                  n_lidar=n_lidar)          
+        self.critic = CriticNetwork(learning_rate=0.0003, chkpt_dir=model_dir, obs_mode=obs_mode, n_lidar=n_lidar)                       
 
         self.gamma = 0.99
         self.policy_clip = 0.2
         self.n_epochs = 10
         self.gae_lambda = 0.95                        
+        # (actor loss, critic loss) of the latest update
+        self.last_losses = (float("nan"), float("nan"))
+        # Times the PPO updates, replaced by Environment when profiling
+        self.profiler = NULL_PROFILER
 
-    def policy(self, lidar_state):                                            
-        
-        # Lidar state
-        
-        lidar_state = np.array(lidar_state) / 200.0
-        
-        lidar_state_tensor = torch.tensor(lidar_state).to(self.actor.device)    
-        lidar_state_tensor = lidar_state_tensor.unsqueeze(0)
-        # Prediction            
+    def network_input(self, lidar_states, img_states=None):
+        """
+        Network input of the observation mode. uint8 images are normalized
+        and get a channel dimension.
+        """
+        if self.obs_mode == "lidar":
+            return lidar_states
+        img_states = img_states.unsqueeze(1).float() / 255.0
+        if self.obs_mode == "image":
+            return img_states
+        return img_states, lidar_states
+
+    def policy(self, lidar_state, img_state=None):                                            
+        """
+        Select the action of a single observation.
+
+        Input:
+            lidar_state: list or array (n_lidar,), lidar distances
+            img_state: uint8 array (84, 84), preprocessed frame. Only used when the
+                       networks consume images
+        Return:
+            action (int), log-probability (float) and value (float)
+        """
+        actions, probs, values = self.policy_batch(np.asarray(lidar_state, dtype=np.float32)[None],
+                                                   None if img_state is None else np.asarray(img_state)[None])
+        return int(actions[0]), float(probs[0]), float(values[0])
 
-        prob_dist = self.actor(lidar_state_tensor.float())
-        
-        value = self.critic(lidar_state_tensor.float())
-        
-        action = prob_dist.sample()
+    def policy_batch(self, lidar_states, img_states=None):
+        """
+        Select the actions of many observations in one call.
+
+        Input:
+            lidar_states: float32 array (N, n_lidar), lidar distances
+            img_states: uint8 array (N, 84, 84), preprocessed frames. Only used when
+                        the networks consume images
+        Return:
+            actions: int64 array (N,)
+            probs: float32 array (N,), log-probabilities of the actions
+            values: float32 array (N,), critic values
+        """
+        lidar_states = np.asarray(lidar_states, dtype=np.float32) / np.float32(200.0)
+        with torch.no_grad():
+            lidar_states_tensor = torch.from_numpy(lidar_states).to(self.actor.device)
+            img_states_tensor = None
+            if self.obs_mode != "lidar":
+                img_states_tensor = torch.from_numpy(np.asarray(img_states, dtype=np.uint8)).to(self.actor.device)
+            state = self.network_input(lidar_states_tensor, img_states_tensor)
+            # Prediction
+            prob_dist = self.actor(state)
+            values = self.critic(state)
+            actions = prob_dist.sample()
+            probs = prob_dist.log_prob(actions)
+        return actions.cpu().numpy(), probs.cpu().numpy(), values.squeeze(-1).cpu().numpy()
+
+    def values(self, lidar_states, img_states=None):
+        """
+        Critic values of many observations, e.g. the ones that follow a rollout.
 
-        probs = torch.squeeze(prob_dist.log_prob(action)).item()
-        action = torch.squeeze(action).item()
-        value = torch.squeeze(value).item()           
-        return action, probs, value
+        Input:
+            lidar_states, img_states: as policy_batch
+        Return:
+            float32 array (N,)
+        """
+        lidar_states = np.asarray(lidar_states, dtype=np.float32) / np.float32(200.0)
+        with torch.no_grad():
+            lidar_states_tensor = torch.from_numpy(lidar_states).to(self.critic.device)
+            img_states_tensor = None
+            if self.obs_mode != "lidar":
+                img_states_tensor = torch.from_numpy(np.asarray(img_states, dtype=np.uint8)).to(self.critic.device)
+            values = self.critic(self.network_input(lidar_states_tensor, img_states_tensor))
+        return values.squeeze(-1).cpu().numpy()
     
     def train(self):
-                  
-        # Sampling minibatch                
-        for _ in range(self.n_epochs):
-            img_state_arr, lidar_state_arr, action_arr, old_probs_arr, vals_arr, \
-            reward_arr, dones_arr, batches = self.memory.generate_batches()            
-            values = vals_arr
-            advantage = np.zeros(len(reward_arr), dtype=np.float32)
-
-            for t in range(len(reward_arr)-1):
-                discount = 1
-                a_t = 0
-                for k in range(t, len(reward_arr)-1):
-                    a_t += discount * (reward_arr[k] + self.gamma*values[k+1]* \
-                    (1-int(dones_arr[k])) - values[k])
-
-                    discount *= self.gamma*self.gae_lambda
-                
-                advantage[t] = a_t
-            advantage = torch.tensor(advantage).to(self.actor.device)
+        """
+        PPO update on the rollout stored in memory, then clear the memory.
+        """
+        losses = self.update(self.memory.rollout())
+        self.memory.clear_memory()
 
-            values = torch.tensor(values).to(self.actor.device)            
+        print("Training Finished")
+        return losses
 
-            for batch in batches:                
-                #img_states = torch.tensor(img_state_arr[batch], dtype=torch.float).to(self.actor.device)                
-                #img_states = img_states.unsqueeze(1)
-                lidar_states = torch.tensor(lidar_state_arr[batch], dtype=torch.float).to(self.actor.device)                                
-                
-                old_probs = torch.tensor(old_probs_arr[batch]).to(self.actor.device)
-                
-                actions = torch.tensor(action_arr[batch]).to(self.actor.device)
+    def update(self, rollout):
+        """
+        PPO update on a rollout.
+
+        Input:
+            rollout: tuple (img_states, lidar_states, actions, probs, vals,
+                     rewards, dones, final_vals) of time-first arrays and the
+                     last_vals that follow them, as Memory.rollout
+        Return:
+            (actor loss, critic loss) averaged over the minibatches
+        """
+        with self.profiler.phase("ppo.update"):
+            losses = self._update(rollout)
+        self.profiler.count("ppo.samples", rollout[2].size)
+        self.profiler.count("ppo.minibatches", self.n_epochs * -(-rollout[2].size // self.batch_size))
+        return losses
+
+    def _update(self, rollout):
+        img_state_arr, lidar_state_arr, action_arr, old_probs_arr, vals_arr, \
+        reward_arr, dones_arr, final_vals_arr, last_vals = rollout
+        # Advantages are computed once per rollout, time first
+        advantage_arr, returns_arr = compute_gae(reward_arr, vals_arr, dones_arr, self.gamma, self.gae_lambda,
+                                                 last_vals, final_vals_arr)
+
+        # Tensors are built once per update and share memory with the rollout buffer
+        n_states = action_arr.size
+        device = self.actor.device
+        rollout = [torch.from_numpy(lidar_state_arr.reshape(n_states, -1)).to(device),
+                   torch.from_numpy(action_arr.reshape(n_states)).to(device),
+                   torch.from_numpy(old_probs_arr.reshape(n_states)).to(device),
+                   torch.from_numpy(advantage_arr.reshape(n_states)).to(device),
+                   torch.from_numpy(returns_arr.reshape(n_states)).to(device)]
+        if self.obs_mode != "lidar":
+            rollout.append(torch.from_numpy(img_state_arr.reshape(n_states, 84, 84)).to(device))
+
+        # Summed without synchronising, read once at the end
+        actor_losses, critic_losses, n_batches = 0.0, 0.0, 0
+
+        # Sampling minibatch                
+        for _ in range(self.n_epochs):
+            # One shuffle per epoch, the minibatches are slices of it
+            permutation = torch.randperm(n_states, device=device)
+            rollout_epoch = [tensor[permutation] for tensor in rollout]
+
+            for start in range(0, n_states, self.batch_size):
+                batch = slice(start, start + self.batch_size)
+                lidar_states, actions, old_probs, advantage, returns, *img_states = \
+                    [tensor[batch] for tensor in rollout_epoch]
+                state = self.network_input(lidar_states, img_states[0] if img_states else None)
                 
-                distributions = self.actor(lidar_states)
+                distributions = self.actor(state)
                 
-                critic_value = self.critic(lidar_states)
+                critic_value = self.critic(state)
                 
-                critic_value = torch.squeeze(critic_value)
+                critic_value = torch.squeeze(critic_value, -1)
                 
                 new_probs = distributions.log_prob(actions)
                 
                 prob_ratio = new_probs.exp() / old_probs.exp()
                 
-                weighted_probs = advantage[batch] * prob_ratio
+                weighted_probs = advantage * prob_ratio
                 
                 weighted_clipped_probs = torch.clamp(prob_ratio, 1-self.policy_clip,
-                                                 1+self.policy_clip) * advantage[batch]
+                                                 1+self.policy_clip) * advantage
                 
                 actor_loss = -torch.min(weighted_probs, weighted_clipped_probs).mean()
                 
-                returns = advantage[batch] + values[batch]
-                
                 critic_loss = (returns - critic_value) ** 2
                 critic_loss = critic_loss.mean()
                 
@@ -245,20 +404,92 @@ class DRL_algorithm:
                 total_loss.backward()
                 self.actor.optimizer.step()
                 self.critic.optimizer.step()
-        
-        self.memory.clear_memory()
 
-        print("Training... ")        
-        
-        self.training_finished = True
-        print("Training Finished")
+                actor_losses += actor_loss.detach()
+                critic_losses += critic_loss.detach()
+                n_batches += 1
 
-    def save_model(self, f):        
-        self.actor.save_checkpoint()
-        self.critic.save_checkpoint()
+        self.last_losses = (float(actor_losses) / n_batches, float(critic_losses) / n_batches)
+        return self.last_losses
+
+    def _model_paths(self, f):
+        if f is None:
+            return None, None
+        return os.path.join(f, "actor_network_ppo"), os.path.join(f, "critic_network_ppo")
+
+    def model_info(self, f=None):
+        """
+        Contents of the model_info.json of the directory f (by default the
+        one of the networks), empty when the weights were saved without it.
+        """
+        path = os.path.join(f or os.path.dirname(self.actor.save_dir), MODEL_INFO)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as file:
+            return json.load(file)
+
+    def save_model(self, f=None, info=None):
+        """
+        Save the actor and critic weights in the directory f, by default model_dir.
+        Lidar actors are also exported next to them, so the NumPy actor
+        never lags behind the torch weights. model_info.json records the
+        observation config and the entries of info (e.g. the best score).
+        """
+        actor_path, critic_path = self._model_paths(f)
+        if f is not None:
+            os.makedirs(f, exist_ok=True)
+        self.actor.save_checkpoint(actor_path)
+        self.critic.save_checkpoint(critic_path)
+        if self.obs_mode == "lidar":
+            self.export_actor((actor_path or self.actor.save_dir) + ".npz", actor_path)
+        model_info = {"obs_mode": self.obs_mode, "n_lidar": self.n_lidar, **(info or {})}
+        with open(os.path.join(f or os.path.dirname(self.actor.save_dir), MODEL_INFO), 'w') as file:
+            json.dump(model_info, file, indent=1)
         print("Models saved")
     
-    def load_models(self, f):  
-        self.actor.load_checkpoint()
-        self.critic.load_checkpoint()      
+    def export_actor(self, path="../model/actor_network_ppo.npz", weights_path=None):
+        """
+        Export the actor to NumPy. weights_path is the saved actor these
+        weights were loaded from or saved to, by default the one of model_dir.
+        """
+        self.actor.export_numpy(path, weights_path)
+        print("Actor exported")
+
+    def load_models(self, f=None):  
+        """
+        Load the weights saved in the directory f, by default model_dir.
+        Weights of another observation config are refused.
+
+        Return:
+            dict, their model_info (see save_model)
+        """
+        actor_path, critic_path = self._model_paths(f)
+        directory = f or os.path.dirname(self.actor.save_dir)
+        info = self.model_info(f)
+        expected = f"{self.obs_mode} observations with {self.n_lidar} lidar distances"
+        if info and (info["obs_mode"], info["n_lidar"]) != (self.obs_mode, self.n_lidar):
+            raise ValueError(f"The weights in {directory} take {info['obs_mode']} observations with "
+                             f"{info['n_lidar']} lidar distances, not {expected}")
+        try:
+            self.actor.load_checkpoint(actor_path)
+            self.critic.load_checkpoint(critic_path)      
+        except RuntimeError as e:
+            # Weights saved without model_info.json
+            raise ValueError(f"The weights in {directory} do not take {expected}") from e
         print("Models loaded!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+        return info
+
+    def training_state(self):
+        """
+        Copy of the networks and optimizers state, safe to serialize while training goes on.
+        """
+        return copy.deepcopy({"actor": self.actor.state_dict(),
+                              "critic": self.critic.state_dict(),
+                              "actor_optimizer": self.actor.optimizer.state_dict(),
+                              "critic_optimizer": self.critic.optimizer.state_dict()})
+
+    def load_training_state(self, state):
+        self.actor.load_state_dict(state["actor"])
+        self.critic.load_state_dict(state["critic"])
+        self.actor.optimizer.load_state_dict(state["actor_optimizer"])
+        self.critic.optimizer.load_state_dict(state["critic_optimizer"])
@@ -0,0 +1,441 @@
+"""
+Benchmark suite of the environment, the policy and the PPO update.
+
+    python benchmarks.py --out results.json
+    python benchmarks.py --baseline results.json --tolerance 0.15
+
+Every scenario is seeded. The results are a JSON dict of metrics with their
+unit and direction. Metrics that miss their target (startup times) or, with
+--baseline, got worse by more than the tolerance are reported and the exit
+code is 1.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import numpy as np
+
+# Scenario groups, in run order
+GROUPS = ("startup", "env", "components", "policy", "train", "memory")
+POLICY_BATCH_SIZES = (1, 8, 64, 256)
+# Startup-time targets in seconds: the entry points and the evaluation
+# workers must not import torch or pygame
+STARTUP_TARGETS = {
+    "import_main": 0.3,
+    "main_help": 0.3,
+    "import_evaluation": 0.5,
+    "import_random_sample_exp_replay": 0.5
+}
+
+
+def _metric(value, unit, higher_is_better):
+    return {"value": float(value), "unit": unit, "higher_is_better": higher_is_better}
+
+def time_call(fn, number, repeat=5):
+    """
+    Seconds per call of fn, the best of `repeat` runs of `number` calls.
+    """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, time.perf_counter() - start)
+    return best / number
+
+def torch_seed(seed):
+    import torch
+    torch.manual_seed(seed)
+
+def _random_positions(rng, n):
+    evasors = rng.integers(20, 180, size=(n, 2))
+    pursuiters = rng.integers(14, 194, size=(n, 2))
+    return pursuiters, evasors
+
+
+####################################
+##            Startup             ##
+####################################
+
+def bench_startup(seed=0, repeat=5):
+    """
+    Seconds to start a fresh interpreter and import the entry points, the
+    best of `repeat` runs. Targets missed are reported as regressions by
+    compare even without a baseline entry.
+    """
+    import subprocess
+
+    src = os.path.dirname(os.path.abspath(__file__))
+    commands = {
+        "import_main": [sys.executable, "-c", "import main"],
+        "main_help": [sys.executable, "main.py", "--help"],
+        "import_evaluation": [sys.executable, "-c", "import evaluation"],
+        "import_random_sample_exp_replay": [sys.executable, "-c", "import random_sample_exp_replay"]
+    }
+    results = {}
+    for name, command in commands.items():
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=src, check=True, capture_output=True)
+            best = min(best, time.perf_counter() - start)
+        results[f"startup.{name}_s"] = _metric(best, "s", False)
+        results[f"startup.{name}_s"]["target"] = STARTUP_TARGETS[name]
+    return results
+
+
+####################################
+##          Environment           ##
+####################################
+
+def bench_env(seed=0, n_steps=2000):
+    """
+    Steps/sec of the Environment step path (without training) in every
+    observation mode, of the bare Simulation and of a BatchedSimulation.
+    """
+    from main import Environment
+    from preprocessing import preprocess_frames
+    from simulation import Simulation, BatchedSimulation
+    from lookup_env import LookupTables, LookupSimulation, BatchedLookupSimulation
+
+    results = {}
+    rng = np.random.default_rng(seed)
+    actions = rng.integers(0, 9, size=n_steps)
+
+    simulation = Simulation(seed=seed)
+    simulation.reset()
+    def simulation_step():
+        simulation.step(actions[simulation.run_time % n_steps])
+        if simulation.episode_over:
+            simulation.reset()
+    results["env.simulation_steps_per_sec"] = _metric(1 / time_call(simulation_step, n_steps), "steps/s", True)
+
+    n_envs = 64
+    batched = BatchedSimulation(n_envs, seed=seed)
+    batched.reset()
+    batched_actions = rng.integers(0, 9, size=(16, n_envs))
+    counter = iter(range(10 ** 9))
+    def batched_step():
+        batched.step(batched_actions[next(counter) % 16])
+    results["env.batched_simulation_steps_per_sec"] = \
+        _metric(n_envs / time_call(batched_step, n_steps // 10), "steps/s", True)
+
+    # Same stepping from the lookup tables, built in a temporary cache
+    with tempfile.TemporaryDirectory() as cache_dir:
+        tables = LookupTables(cache_dir=cache_dir)
+    simulation = LookupSimulation(seed=seed, tables=tables)
+    simulation.reset()
+    results["env.lookup_simulation_steps_per_sec"] = _metric(1 / time_call(simulation_step, n_steps), "steps/s", True)
+    batched = BatchedLookupSimulation(n_envs, seed=seed, tables=tables)
+    batched.reset()
+    results["env.batched_lookup_simulation_steps_per_sec"] = \
+        _metric(n_envs / time_call(batched_step, n_steps // 10), "steps/s", True)
+
+    for obs_mode, render_mode in (("lidar", "none"), ("lidar", "rgb_array"), ("both", "rgb_array")):
+        env = Environment(obs_mode=obs_mode, render_mode=render_mode)
+        torch_seed(seed)
+        state = {"lidar": env.simulation.reset()}
+        env.render()
+        def env_step():
+            env.handle_events()
+            if env.use_images:
+                env.current_state = preprocess_frames(env.get_capture())
+            action, prob, val = env.drl_algorithm.policy(state["lidar"], env.current_state)
+            lidar, reward, done = env.simulation.step(action)
+            env.render()
+            env.memory.store_memory(env.current_state, state["lidar"], action, prob, val, reward, done)
+            if env.memory.step == env.memory.capacity:
+                env.memory.clear_memory()
+            state["lidar"] = env.simulation.reset() if env.simulation.episode_over else lidar
+        number = n_steps // 4 if env.use_images else n_steps // 2
+        results[f"env.step_{obs_mode}_{render_mode}_steps_per_sec"] = \
+            _metric(1 / time_call(env_step, number, repeat=3), "steps/s", True)
+        if env.viewer is not None:
+            env.viewer.close()
+    return results
+
+def bench_components(seed=0, n_calls=2000):
+    """
+    Microseconds per call of the legacy pygame components and of their
+    headless replacements.
+    """
+    import pygame
+    from obstacles import Obstacles
+    from sensors import Sensor
+    from utils import Utils
+    from pursuiter import Pursuiter
+    from evasor import Evasor
+    from viewer import Viewer
+    from preprocessing import preprocess_frames
+    from ray_lidar import RayLidar
+    from obstacle_map import ObstacleMap
+    from simulation import Simulation, TARGET_ZONE, lidar_observations, get_reward
+
+    results = {}
+    rng = np.random.default_rng(seed)
+    pursuiters, evasors = _random_positions(rng, n_calls)
+    # Only positions whose lidar lines all reach a wall, as the legacy code expects
+    pursuiters = np.clip(pursuiters, 18, 182)
+    lidars = lidar_observations(pursuiters, evasors)
+
+    # Legacy objects drawn on an off-screen surface
+    screen = pygame.Surface((200, 200))
+    obstacles = Obstacles(screen)
+    obstacles.render_walls()
+    sensor = Sensor()
+    utils = Utils(obstacles, sensor)
+    pursuiter, evasor = Pursuiter(), Evasor()
+    pursuiter.position = [int(v) for v in pursuiters[0]]
+    evasor.position = [int(v) for v in evasors[0]]
+    pursuiter.spawn(screen)
+    evasor.spawn(screen)
+    sensor.update_position(list(pursuiter.position))
+    sensor.lidar(screen)
+    utils.lidar_observations(pursuiter.position[0], pursuiter.position[1], evasor)
+
+    us = 1e6
+    results["components.sensor_lidar_us"] = _metric(us * time_call(lambda: sensor.lidar(screen), n_calls), "us", False)
+    results["components.utils_lidar_observations_us"] = _metric(
+        us * time_call(lambda: utils.lidar_observations(pursuiter.position[0], pursuiter.position[1], evasor), n_calls),
+        "us", False)
+    results["components.utils_get_reward_us"] = _metric(
+        us * time_call(lambda: utils.get_reward(pursuiter.robot, evasor.robot, pursuiter.position, evasor.position), n_calls),
+        "us", False)
+
+    pursuiter_pos, evasor_pos, lidar = pursuiters[0], evasors[0], lidars[0]
+    results["components.lidar_observations_us"] = _metric(
+        us * time_call(lambda: lidar_observations(pursuiter_pos, evasor_pos), n_calls), "us", False)
+    results["components.get_reward_us"] = _metric(
+        us * time_call(lambda: get_reward(pursuiter_pos, evasor_pos, lidar), n_calls), "us", False)
+    # Per arena, over all the positions in one call
+    results["components.get_reward_batched_us_per_arena"] = _metric(
+        us * time_call(lambda: get_reward(pursuiters, evasors, lidars), 20) / n_calls, "us", False)
+    # Ray-cast lidar, single arena and per arena over all the positions in one call
+    for n_beams in (4, 16, 64):
+        ray_lidar = RayLidar(n_beams)
+        results[f"components.ray_lidar_{n_beams}_us"] = _metric(
+            us * time_call(lambda: ray_lidar(pursuiter_pos, evasor_pos), n_calls), "us", False)
+        results[f"components.ray_lidar_{n_beams}_batched_us_per_arena"] = _metric(
+            us * time_call(lambda: ray_lidar(pursuiters, evasors), 20) / n_calls, "us", False)
+    # Same on maps/cluttered.json
+    cluttered = ObstacleMap.from_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "maps",
+                                                   "cluttered.json"))
+    for n_beams in (8, 16):
+        ray_lidar = RayLidar(n_beams)
+        results[f"components.ray_lidar_{n_beams}_cluttered_us"] = _metric(
+            us * time_call(lambda: ray_lidar(pursuiter_pos, evasor_pos, cluttered), n_calls), "us", False)
+        results[f"components.ray_lidar_{n_beams}_cluttered_batched_us_per_arena"] = _metric(
+            us * time_call(lambda: ray_lidar(pursuiters, evasors, cluttered), 20) / n_calls, "us", False)
+
+    # Resets from the default spawn and from uniform draws of the spawn sampler
+    simulation = Simulation(seed=seed)
+    results["components.simulation_reset_us"] = _metric(us * time_call(simulation.reset, n_calls), "us", False)
+    simulation = Simulation(seed=seed, spawn_band=(TARGET_ZONE, 200.0))
+    simulation.reset()
+    results["components.simulation_reset_band_us"] = _metric(us * time_call(simulation.reset, n_calls), "us", False)
+
+    viewer = Viewer("rgb_array")
+    simulation = Simulation(seed=seed)
+    simulation.reset()
+    viewer.render(simulation)
+    results["components.render_us"] = _metric(us * time_call(lambda: viewer.render(simulation), n_calls // 4), "us", False)
+    results["components.get_capture_us"] = _metric(us * time_call(viewer.get_capture, n_calls // 4), "us", False)
+    frame = viewer.get_capture()
+    results["components.preprocess_frames_us"] = _metric(
+        us * time_call(lambda: preprocess_frames(frame), n_calls // 4), "us", False)
+    viewer.close()
+    return results
+
+
+####################################
+##         Policy and PPO         ##
+####################################
+
+def bench_policy(seed=0, n_calls=500):
+    """
+    Latency of DRL_algorithm.policy and of policy_batch / NumpyActor.act at
+    several batch sizes.
+    """
+    from memory import Memory
+    from DRL_algorithm import DRL_algorithm
+    from numpy_actor import NumpyActor
+
+    torch_seed(seed)
+    results = {}
+    rng = np.random.default_rng(seed)
+    drl_algorithm = DRL_algorithm(Memory(batch_size=32))
+    lidar = rng.uniform(0, 200, size=4).astype(np.float32)
+    results["policy.policy_ms"] = _metric(1e3 * time_call(lambda: drl_algorithm.policy(lidar), n_calls), "ms", False)
+
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "actor.npz")
+        drl_algorithm.actor.export_numpy(path)
+        actor = NumpyActor(path, seed=seed)
+    for batch_size in POLICY_BATCH_SIZES:
+        states = rng.uniform(0, 200, size=(batch_size, 4)).astype(np.float32)
+        number = max(10, n_calls // batch_size)
+        results[f"policy.policy_batch_{batch_size}_ms"] = _metric(
+            1e3 * time_call(lambda: drl_algorithm.policy_batch(states), number), "ms", False)
+        results[f"policy.numpy_actor_{batch_size}_ms"] = _metric(
+            1e3 * time_call(lambda: actor.act(states), number), "ms", False)
+    return results
+
+def _fill_memory(memory, rng, n_steps):
+    memory.clear_memory()
+    for _ in range(n_steps):
+        img_state = rng.integers(0, 256, size=(84, 84), dtype=np.uint8) if memory.store_images else None
+        memory.store_memory(img_state, rng.uniform(0, 200, size=4), int(rng.integers(0, 9)),
+                            float(rng.normal()), float(rng.normal()), float(rng.normal()), bool(rng.random() < 0.02))
+
+def bench_train(seed=0, n_updates=3):
+    """
+    Rollout samples per second of DRL_algorithm.train, for rollouts of 64
+    steps as in Environment.run.
+    """
+    from memory import Memory
+    from DRL_algorithm import DRL_algorithm
+
+    results = {}
+    rng = np.random.default_rng(seed)
+    for obs_mode in ("lidar", "both"):
+        torch_seed(seed)
+        memory = Memory(batch_size=32, store_images=obs_mode != "lidar")
+        drl_algorithm = DRL_algorithm(memory, obs_mode=obs_mode)
+        n_steps = 64
+        elapsed = np.inf
+        for _ in range(n_updates):
+            _fill_memory(memory, rng, n_steps)
+            start = time.perf_counter()
+            drl_algorithm.train()
+            elapsed = min(elapsed, time.perf_counter() - start)
+        results[f"train.{obs_mode}_samples_per_sec"] = _metric(n_steps / elapsed, "samples/s", True)
+        # Every sample goes through n_epochs minibatch updates
+        results[f"train.{obs_mode}_minibatch_samples_per_sec"] = \
+            _metric(n_steps * drl_algorithm.n_epochs / elapsed, "samples/s", True)
+    return results
+
+
+####################################
+##             Memory             ##
+####################################
+
+def bench_memory(seed=0):
+    """
+    Bytes per stored transition of Memory and ReplayBuffer.
+    """
+    from memory import Memory
+    from random_sample_exp_replay import ReplayBuffer
+
+    results = {}
+    for store_images in (False, True):
+        memory = Memory(batch_size=32, capacity=64, store_images=store_images)
+        fields = (memory.img_states, memory.lidar_states, memory.actions, memory.probs,
+                  memory.vals, memory.rewards, memory.dones)
+        n_bytes = sum(field.nbytes for field in fields if field is not None)
+        name = "memory.memory_images_bytes_per_transition" if store_images else "memory.memory_bytes_per_transition"
+        results[name] = _metric(n_bytes / memory.capacity, "bytes", False)
+
+    max_size = 1000
+    with tempfile.TemporaryDirectory() as root:
+        replay_buffer = ReplayBuffer(max_size, root=root, seed=seed)
+        fields = (replay_buffer.current_frames, replay_buffer.next_frames, replay_buffer.current_lidar,
+                  replay_buffer.next_lidar, replay_buffer.actions, replay_buffer.rewards, replay_buffer.dones)
+        n_bytes = sum(field.nbytes for field in fields)
+        del replay_buffer, fields
+    results["memory.replay_buffer_bytes_per_transition"] = _metric(n_bytes / max_size, "bytes", False)
+    return results
+
+
+BENCHMARKS = {
+    "startup": bench_startup,
+    "env": bench_env,
+    "components": bench_components,
+    "policy": bench_policy,
+    "train": bench_train,
+    "memory": bench_memory
+}
+
+
+def run(groups=GROUPS, seed=0):
+    """
+    Run the benchmark groups.
+
+    Return:
+        dict with the environment of the run ("meta") and the metrics ("results")
+    """
+    import torch
+
+    results = {}
+    for group in groups:
+        results.update(BENCHMARKS[group](seed=seed))
+    meta = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "seed": seed,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count()
+    }
+    return {"meta": meta, "results": results}
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Metrics of results that are worse than in baseline by more than tolerance
+    (relative), or that miss their target. baseline may be None.
+
+    Return:
+        list of (name, baseline value, value, relative change), the change
+        being positive when the metric improved
+    """
+    regressions = []
+    for name, metric in results["results"].items():
+        if "target" in metric and metric["value"] > metric["target"]:
+            regressions.append((name, metric["target"], metric["value"], metric["target"] / metric["value"] - 1))
+            continue
+        if baseline is None or name not in baseline["results"]:
+            continue
+        old, new = baseline["results"][name]["value"], metric["value"]
+        if old == 0:
+            continue
+        change = (new - old) / abs(old)
+        if not metric["higher_is_better"]:
+            change = -change
+        if change < -tolerance:
+            regressions.append((name, old, new, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", default=",".join(GROUPS), help="comma separated groups of " + ", ".join(GROUPS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative slowdown")
+    args = parser.parse_args(argv)
+
+    results = run(args.groups.split(","), args.seed)
+    for name, metric in results["results"].items():
+        print(f"{name:55s} {metric['value']:14.3f} {metric['unit']}")
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    regressions = compare(results, baseline, args.tolerance)
+    for name, old, new, change in regressions:
+        print(f"REGRESSION {name}: {old:.3f} -> {new:.3f} ({100 * change:+.1f}%)")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
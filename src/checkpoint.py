@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import queue
+import threading
+import numpy as np
+import torch
+
+INDEX_FILE = "checkpoints.json"
+# Prefix of the directory of every training run
+RUN_PREFIX = "run_"
+
+
+def rng_state(simulation=None):
+    """
+    States of the random generators used in training: NumPy's global one
+    (minibatch shuffles), torch's (action sampling) and the spawn generator
+    of the simulation.
+    """
+    state = {"numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["torch_cuda"] = torch.cuda.get_rng_state_all()
+    if simulation is not None:
+        state["simulation"] = simulation.rng.bit_generator.state
+    return state
+
+def set_rng_state(state, simulation=None):
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "torch_cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["torch_cuda"])
+    if simulation is not None and "simulation" in state:
+        simulation.rng.bit_generator.state = state["simulation"]
+
+def new_run_dir(root="../model/checkpoints"):
+    """
+    Directory for the checkpoints of a new training run, so its index and
+    episode numbers never mix with the ones of earlier runs.
+    """
+    name = RUN_PREFIX + time.strftime("%Y%m%d-%H%M%S")
+    run_dir, n = os.path.join(root, name), 1
+    while os.path.exists(run_dir):
+        run_dir, n = os.path.join(root, f"{name}_{n}"), n + 1
+    os.makedirs(run_dir)
+    return run_dir
+
+def latest_run_dir(root="../model/checkpoints"):
+    """
+    Run directory of root holding the most recently written checkpoint,
+    None when there is none. root itself counts as the directory of the
+    checkpoints written before there were run directories.
+    """
+    if not os.path.isdir(root):
+        return None
+    candidates = [root] + [os.path.join(root, name) for name in sorted(os.listdir(root)) if name.startswith(RUN_PREFIX)]
+    latest, latest_time = None, float("-inf")
+    for run_dir in candidates:
+        index_path = os.path.join(run_dir, INDEX_FILE)
+        if not os.path.exists(index_path):
+            continue
+        with open(index_path) as file:
+            index = json.load(file)
+        if index and max(entry["time"] for entry in index) > latest_time:
+            latest, latest_time = run_dir, max(entry["time"] for entry in index)
+    return latest
+
+def _atomic_write(path, write):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as file:
+        write(file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+class CheckpointManager:
+    """
+        Complete training checkpoints written on a background thread.
+
+        A checkpoint is a dict (networks, optimizers, counters, scores, RNG
+        states...) already copied by the caller, saved with torch.save to a
+        temporary file and renamed into place, so a crash never leaves a
+        partial checkpoint. checkpoints.json lists them with their episode
+        and score. The keep_top best scored ones and the keep_last most
+        recent ones are kept, the others are deleted.
+    """
+    def __init__(self, root="../model/checkpoints", keep_top=3, keep_last=1, max_pending=2):
+        self.root = root
+        self.keep_top = keep_top
+        self.keep_last = keep_last
+        os.makedirs(root, exist_ok=True)
+        index_path = os.path.join(root, INDEX_FILE)
+        self.index = []
+        if os.path.exists(index_path):
+            with open(index_path) as file:
+                self.index = json.load(file)
+        self.lock = threading.Lock()
+
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                # Re-raised by the next save/wait/close
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Saving a checkpoint failed") from error
+
+    def save(self, state, episode, score):
+        """
+        Queue a checkpoint. Only blocks while max_pending checkpoints are waiting.
+
+        Input:
+            state: dict to save, not modified afterwards by the caller
+            episode: int, last finished episode
+            score: float, score used to rank the checkpoint
+        """
+        self._check()
+        self.queue.put((state, episode, score))
+
+    def _write(self, state, episode, score):
+        file_name = f"checkpoint_{episode:07d}.pt"
+        _atomic_write(os.path.join(self.root, file_name), lambda file: torch.save(state, file))
+        with self.lock:
+            self.index = [entry for entry in self.index if entry["file"] != file_name]
+            self.index.append({"file": file_name, "episode": episode, "score": float(score), "time": time.time()})
+            by_score = sorted(self.index, key=lambda entry: -entry["score"])[:self.keep_top]
+            by_episode = sorted(self.index, key=lambda entry: -entry["episode"])[:self.keep_last]
+            keep = {entry["file"] for entry in by_score + by_episode}
+            removed = [entry for entry in self.index if entry["file"] not in keep]
+            self.index = sorted((entry for entry in self.index if entry["file"] in keep), key=lambda entry: entry["episode"])
+            index = list(self.index)
+        _atomic_write(os.path.join(self.root, INDEX_FILE), lambda file: file.write(json.dumps(index, indent=1).encode()))
+        # Files are only deleted once the index no longer lists them
+        for entry in removed:
+            path = os.path.join(self.root, entry["file"])
+            if os.path.exists(path):
+                os.remove(path)
+
+    def latest(self):
+        """
+        Path of the most recently written checkpoint, None when there is none.
+        """
+        with self.lock:
+            if not self.index:
+                return None
+            return os.path.join(self.root, max(self.index, key=lambda entry: entry["time"])["file"])
+
+    def best(self):
+        with self.lock:
+            if not self.index:
+                return None
+            return os.path.join(self.root, max(self.index, key=lambda entry: entry["score"])["file"])
+
+    def load(self, path=None, map_location=None):
+        """
+        Load a checkpoint, by default the latest one.
+
+        Return:
+            dict saved by save, None when there is no checkpoint
+        """
+        path = path or self.latest()
+        if path is None:
+            return None
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+    def wait(self):
+        """
+        Block until the queued checkpoints are written.
+        """
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._check()
@@ -0,0 +1,152 @@
+import multiprocessing as mp
+from functools import partial
+import numpy as np
+
+from numpy_actor import NumpyActor
+from obstacle_map import ObstacleMap
+from ray_lidar import RayLidar
+from simulation import Simulation, MAX_RUN_TIME, TARGET_ZONE, eucl_distance, evasor_collision
+from spawn_sampler import SpawnSampler
+from lookup_env import LookupSimulation, LookupTables
+
+# "default" starts every episode from the curriculum spawn points,
+# "random" draws a valid pursuiter spawn per episode, within spawn_band of
+# the evasor when one is given
+SPAWN_MODES = ("default", "random")
+# Episode outcomes. The pursuiter has to stay in the target zone of the
+# evasor without touching it: an episode that runs to the step limit inside
+# the zone is a success, outside it a timeout. Touching the evasor is a
+# collision like hitting a wall or an obstacle, as in get_reward.
+OUTCOMES = ("success", "timeout", "wall_collision", "evasor_collision")
+
+
+def episode_configs(n_episodes, seed=0, spawn="default", evasor_spawn=(60, 60), pursuiter_spawn=(150, 150),
+                    obstacle_map=None, spawn_band=None):
+    """
+    Deterministic configuration of each evaluation episode: its seed and its
+    spawn points. The same arguments always give the same episodes.
+    """
+    if spawn not in SPAWN_MODES:
+        raise ValueError(f"Unknown spawn mode {spawn!r}, expected one of {SPAWN_MODES}")
+    configs = []
+    sampler = SpawnSampler(obstacle_map) if spawn == "random" else None
+    for episode, child in enumerate(np.random.SeedSequence(seed).spawn(n_episodes)):
+        episode_seed = int(child.generate_state(1)[0])
+        position = np.array(pursuiter_spawn, dtype=np.int64)
+        if spawn == "random":
+            position = sampler.sample(evasor_spawn, np.random.default_rng(episode_seed), spawn_band)
+        configs.append({"episode": episode, "seed": episode_seed,
+                        "evasor_spawn": tuple(int(v) for v in evasor_spawn),
+                        "pursuiter_spawn": tuple(int(v) for v in position)})
+    return configs
+
+def run_episode(actor, config, greedy=False, max_run_time=MAX_RUN_TIME, obstacle_map=None, sensor=None, tables=None):
+    """
+    Play one episode headless, from lookup_env.LookupTables when tables are given.
+
+    Return:
+        dict with the episode, score, length, outcome (see OUTCOMES) and
+        zone_fraction, the fraction of the steps ending in the target zone
+    """
+    simulation_class = Simulation if tables is None else partial(LookupSimulation, tables=tables)
+    simulation = simulation_class(config["evasor_spawn"], config["pursuiter_spawn"], max_run_time, seed=config["seed"],
+                                  obstacle_map=obstacle_map, sensor=sensor)
+    # Seeding the action sampling per episode keeps the results independent of the workers
+    actor.rng = np.random.default_rng(config["seed"])
+    lidar = simulation.reset()
+    score = 0.0
+    zone_steps = 0
+    in_zone = False
+    while not simulation.episode_over:
+        action, _ = actor.policy(lidar, greedy)
+        lidar, reward, done = simulation.step(action)
+        score += reward
+        in_zone = eucl_distance(simulation.pursuiter_position, simulation.evasor_position) <= TARGET_ZONE
+        zone_steps += int(in_zone)
+
+    if not simulation.done:
+        outcome = "success" if in_zone else "timeout"
+    elif evasor_collision(simulation.pursuiter_position, simulation.evasor_position):
+        outcome = "evasor_collision"
+    else:
+        outcome = "wall_collision"
+    length = simulation.run_time - 1
+    return {"episode": config["episode"], "score": score, "length": length, "outcome": outcome,
+            "zone_fraction": zone_steps / max(length, 1)}
+
+def _run_chunk(args):
+    actor_path, configs, greedy, max_run_time, map_path, n_beams, lookup = args
+    actor = NumpyActor(actor_path)
+    obstacle_map = None if map_path is None else ObstacleMap.from_file(map_path)
+    sensor = None if n_beams is None else RayLidar(n_beams)
+    results = []
+    # Lookup tables of every evasor position, loaded from the cache once per chunk
+    tables = {}
+    for config in configs:
+        if lookup and config["evasor_spawn"] not in tables:
+            tables[config["evasor_spawn"]] = LookupTables(config["evasor_spawn"], obstacle_map, sensor)
+        results.append(run_episode(actor, config, greedy, max_run_time, obstacle_map, sensor,
+                                   tables.get(config["evasor_spawn"])))
+    return results
+
+def summarize(results):
+    scores = np.array([result["score"] for result in results])
+    lengths = np.array([result["length"] for result in results])
+    outcomes = np.array([result["outcome"] for result in results])
+    zone_fractions = np.array([result["zone_fraction"] for result in results])
+    stats = {
+        "episodes": len(results),
+        "mean_score": float(scores.mean()),
+        "std_score": float(scores.std())
+    }
+    # The outcome rates add up to 1
+    for outcome in OUTCOMES:
+        stats[f"{outcome}_rate"] = float(np.mean(outcomes == outcome))
+    stats.update({
+        "mean_zone_fraction": float(zone_fractions.mean()),
+        "mean_length": float(lengths.mean()),
+        "std_length": float(lengths.std())
+    })
+    return stats
+
+def evaluate(actor_path="../model/actor_network_ppo.npz", n_episodes=100, n_workers=None, seed=0,
+             spawn="default", greedy=False, max_run_time=MAX_RUN_TIME, start_method=None, map_path=None,
+             n_beams=None, lookup=False, **spawn_kwargs):
+    """
+    Evaluate an exported actor on a pool of headless processes.
+
+    Input:
+        actor_path: .npz file written by DRL_algorithm.export_actor
+        n_workers: processes, None for one per CPU, 0 to run in this process
+        seed, spawn, spawn_kwargs: episode configurations, see episode_configs
+        map_path: map file of the interior obstacles, None for the empty arena
+        n_beams: beams of a RayLidar, None for the four lidar lines
+        lookup: step from lookup_env.LookupTables, built here and cached
+                before the workers start
+    Return:
+        stats: dict of aggregate statistics, see summarize
+        results: list of per-episode dicts ordered by episode
+    """
+    if n_episodes < 1:
+        raise ValueError(f"Evaluating needs at least one episode, got n_episodes={n_episodes}")
+    n_lidar = 4 if n_beams is None else n_beams
+    if NumpyActor(actor_path).n_lidar != n_lidar:
+        raise ValueError(f"The actor {actor_path} does not take {n_lidar} lidar distances")
+    obstacle_map = None if map_path is None else ObstacleMap.from_file(map_path)
+    configs = episode_configs(n_episodes, seed, spawn, obstacle_map=obstacle_map, **spawn_kwargs)
+    if lookup:
+        sensor = None if n_beams is None else RayLidar(n_beams)
+        for evasor_spawn in {config["evasor_spawn"] for config in configs}:
+            LookupTables(evasor_spawn, obstacle_map, sensor)
+    if n_workers == 0:
+        results = _run_chunk((actor_path, configs, greedy, max_run_time, map_path, n_beams, lookup))
+    else:
+        context = mp.get_context(start_method)
+        n_workers = n_workers or context.cpu_count()
+        # A few chunks per worker balance the load without paying per-episode IPC
+        n_chunks = min(len(configs), 4 * n_workers)
+        chunks = [(actor_path, list(chunk), greedy, max_run_time, map_path, n_beams, lookup)
+                  for chunk in np.array_split(np.array(configs, dtype=object), n_chunks)]
+        with context.Pool(n_workers) as pool:
+            results = [result for chunk in pool.map(_run_chunk, chunks) for result in chunk]
+    return summarize(results), results
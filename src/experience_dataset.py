@@ -0,0 +1,242 @@
+import os
+import json
+import queue
+import threading
+import numpy as np
+
+from preprocessing import FRAME_SIZE, normalize_frames
+
+# Columns of an experience shard: (dtype, shape of one row), with the
+# lidar columns of the 4 lidar lines (see fields for other sensors)
+FIELDS = {
+    "current_frames": (np.uint8, (FRAME_SIZE, FRAME_SIZE)),
+    "current_lidar": (np.float32, (4,)),
+    "actions": (np.int64, ()),
+    "rewards": (np.float64, ()),
+    "next_frames": (np.uint8, (FRAME_SIZE, FRAME_SIZE)),
+    "next_lidar": (np.float32, (4,)),
+    "dones": (np.bool_, ())
+}
+INDEX_FILE = "index.json"
+
+
+def fields(n_lidar=4):
+    """
+    FIELDS with lidar columns of n_lidar distances.
+    """
+    return {name: (dtype, (n_lidar,) if name.endswith("_lidar") else shape) for name, (dtype, shape) in FIELDS.items()}
+
+def read_index(root):
+    path = os.path.join(root, INDEX_FILE)
+    if not os.path.exists(path):
+        return {"fields": list(FIELDS), "n_lidar": 4, "shards": []}
+    with open(path) as file:
+        index = json.load(file)
+    # Datasets written before the lidar width was recorded hold the 4 lidar lines
+    index.setdefault("n_lidar", 4)
+    return index
+
+
+class ShardWriter:
+    """
+        Append-only writer of compressed experience shards.
+
+        Rows are buffered in memory and written as shard_<n>.npz files of
+        shard_size rows. index.json lists the shards, their sizes and the
+        lidar width n_lidar and is replaced atomically after every shard, so
+        an interrupted export leaves a readable dataset.
+    """
+    def __init__(self, root, shard_size=10_000, n_lidar=4):
+        self.root = root
+        self.shard_size = shard_size
+        os.makedirs(root, exist_ok=True)
+        self.index = read_index(root)
+        if self.index["shards"] and self.index["n_lidar"] != n_lidar:
+            raise ValueError(f"{root} holds lidar observations of {self.index['n_lidar']} distances, not {n_lidar}")
+        self.index["n_lidar"] = n_lidar
+        self.fields = fields(n_lidar)
+        self.buffer = {name: [] for name in FIELDS}
+        self.buffered = 0
+
+    def add_batch(self, **columns):
+        """
+        Append rows. Every field of FIELDS must be given with the same number of rows.
+        """
+        n_rows = len(columns["actions"])
+        for name, (dtype, shape) in self.fields.items():
+            column = np.asarray(columns[name], dtype=dtype)
+            if column.shape != (n_rows, *shape):
+                raise ValueError(f"{name} has shape {column.shape}, expected {(n_rows, *shape)}")
+            self.buffer[name].append(column)
+        self.buffered += n_rows
+        while self.buffered >= self.shard_size:
+            self._write(self.shard_size)
+
+    def _write(self, n_rows):
+        columns = {name: np.concatenate(parts) for name, parts in self.buffer.items()}
+        shard = {name: column[:n_rows] for name, column in columns.items()}
+        self.buffer = {name: [column[n_rows:]] for name, column in columns.items()}
+        self.buffered -= n_rows
+
+        file_name = f"shard_{len(self.index['shards']):06d}.npz"
+        np.savez_compressed(os.path.join(self.root, file_name), **shard)
+        self.index["shards"].append({"file": file_name, "size": n_rows})
+        tmp_path = os.path.join(self.root, INDEX_FILE + ".tmp")
+        with open(tmp_path, 'w') as file:
+            json.dump(self.index, file)
+        os.replace(tmp_path, os.path.join(self.root, INDEX_FILE))
+
+    def close(self):
+        """
+        Write the buffered rows as a last, smaller shard.
+        """
+        if self.buffered > 0:
+            self._write(self.buffered)
+
+
+def export_replay_buffer(replay_buffer, root, shard_size=10_000):
+    """
+    Export the transitions of a ReplayBuffer, oldest first.
+    """
+    writer = ShardWriter(root, shard_size, replay_buffer.n_lidar)
+    # Once the ring buffer wrapped, the oldest transition is at the pointer
+    start = replay_buffer.experience_ind if replay_buffer.storage == replay_buffer.max_size else 0
+    order = (start + np.arange(replay_buffer.storage)) % replay_buffer.max_size
+    for i in range(0, len(order), shard_size):
+        rows = order[i:i+shard_size]
+        writer.add_batch(current_frames=replay_buffer.current_frames[rows],
+                         current_lidar=replay_buffer.current_lidar[rows],
+                         actions=replay_buffer.actions[rows],
+                         rewards=replay_buffer.rewards[rows],
+                         next_frames=replay_buffer.next_frames[rows],
+                         next_lidar=replay_buffer.next_lidar[rows],
+                         dones=replay_buffer.dones[rows])
+    writer.close()
+    return writer.index
+
+def import_legacy_dataset(src, root, shard_size=10_000):
+    """
+    Convert the ./dataset/<idx>/{current_state,next_state,ard} folders written
+    by the old ReplayBuffer.add (PNG frames and CSV files) into shards.
+    """
+    import pandas as pd
+    from PIL import Image
+    from random_sample_exp_replay import ReplayBuffer
+
+    ACTIONS = ReplayBuffer.ACTIONS
+    writer = ShardWriter(root, shard_size)
+    folders = sorted((int(name) for name in os.listdir(src) if name.isdigit()))
+    for i in range(0, len(folders), shard_size):
+        columns = {name: [] for name in FIELDS}
+        for idx in folders[i:i+shard_size]:
+            folder = os.path.join(src, str(idx))
+            ard = pd.read_csv(os.path.join(folder, "ard", "ard.csv"), header=0)
+            columns["current_frames"].append(np.asarray(Image.open(os.path.join(folder, "current_state", "c_s.png"))))
+            columns["current_lidar"].append(pd.read_csv(os.path.join(folder, "current_state", "lidar.csv"), header=0).values[0])
+            columns["next_frames"].append(np.asarray(Image.open(os.path.join(folder, "next_state", "n_s.png"))))
+            columns["next_lidar"].append(pd.read_csv(os.path.join(folder, "next_state", "lidar.csv"), header=0).values[0])
+            action = ard["action"].values[0]
+            columns["actions"].append(ACTIONS[action] if isinstance(action, str) else action)
+            columns["rewards"].append(ard["reward"].values[0])
+            columns["dones"].append(ard["done"].values[0])
+        writer.add_batch(**columns)
+    writer.close()
+    return writer.index
+
+
+class ShardLoader:
+    """
+        Streams minibatches from a shard directory.
+
+        A background thread decompresses shards_in_memory shards at a time,
+        in random order when shuffling, shuffles their rows together and
+        queues up to prefetch minibatches. Only those shards are held in
+        memory, never the whole dataset.
+    """
+    def __init__(self, root, batch_size, shuffle=True, shards_in_memory=4, prefetch=4, normalize=True, seed=None):
+        self.root = root
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shards_in_memory = shards_in_memory
+        self.prefetch = prefetch
+        # Frames as float32 in [0, 1] instead of uint8
+        self.normalize = normalize
+        self.rng = np.random.default_rng(seed)
+        index = read_index(root)
+        self.shards = index["shards"]
+        self.fields = fields(index["n_lidar"])
+        self._stop = None
+
+    @property
+    def n_rows(self):
+        return sum(shard["size"] for shard in self.shards)
+
+    def __len__(self):
+        """
+        Number of minibatches of a pass, the last one may be smaller.
+        """
+        return -(-self.n_rows // self.batch_size)
+
+    def _read(self, shard):
+        with np.load(os.path.join(self.root, shard["file"])) as data:
+            return {name: data[name] for name in FIELDS}
+
+    def _put(self, batches, item):
+        while not self._stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, batches):
+        try:
+            order = self.rng.permutation(len(self.shards)) if self.shuffle else np.arange(len(self.shards))
+            # Rows left over from the previous group of shards
+            pending = {name: np.empty((0, *shape), dtype=dtype) for name, (dtype, shape) in self.fields.items()}
+            for start in range(0, len(order), self.shards_in_memory):
+                group = [self._read(self.shards[i]) for i in order[start:start+self.shards_in_memory]]
+                data = {name: np.concatenate([pending[name]] + [shard[name] for shard in group]) for name in FIELDS}
+                n_rows = len(data["actions"])
+                rows = self.rng.permutation(n_rows) if self.shuffle else np.arange(n_rows)
+                last = start + self.shards_in_memory >= len(order)
+                n_full = n_rows if last else n_rows - n_rows % self.batch_size
+                for i in range(0, n_full, self.batch_size):
+                    batch = rows[i:i+self.batch_size]
+                    if not self._put(batches, {name: column[batch] for name, column in data.items()}):
+                        return
+                pending = {name: column[rows[n_full:]] for name, column in data.items()}
+        except Exception as e:
+            self._put(batches, e)
+            return
+        self._put(batches, None)
+
+    def __iter__(self):
+        """
+        Yield dicts of minibatch arrays keyed by the names of FIELDS, one pass over the data.
+        """
+        self.close()
+        self._stop = threading.Event()
+        batches = queue.Queue(maxsize=self.prefetch)
+        self._thread = threading.Thread(target=self._produce, args=(batches,), daemon=True)
+        self._thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                if self.normalize:
+                    batch["current_frames"] = normalize_frames(batch["current_frames"])
+                    batch["next_frames"] = normalize_frames(batch["next_frames"])
+                yield batch
+        finally:
+            self.close()
+
+    def close(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._thread.join()
+            self._stop = None
@@ -0,0 +1,135 @@
+import copy
+import queue
+import threading
+
+
+class AsyncLearner:
+    """
+        Runs the PPO updates of a DRL_algorithm on a background thread while
+        the environment keeps collecting experience.
+
+        The environment acts with `policy`, a snapshot of the networks that
+        is only refreshed by sync(). Rollouts go to the learner through a
+        bounded queue, tagged with the policy version that collected them, so
+        collection blocks when the learner falls behind.
+    """
+    def __init__(self, drl_algorithm, max_pending=1):
+        # Learner side, only touched by the background thread
+        self.drl_algorithm = drl_algorithm
+        # Acting side: same algorithm with its own copy of the networks
+        self.policy = copy.copy(drl_algorithm)
+        self.policy.actor = copy.deepcopy(drl_algorithm.actor)
+        self.policy.critic = copy.deepcopy(drl_algorithm.critic)
+        self.policy_version = 0
+
+        # Version of the learner networks and their published weights
+        self.version = 0
+        self.published = None
+        self.publish_lock = threading.Lock()
+        # Held while the learner networks change
+        self.update_lock = threading.Lock()
+
+        self.queue = queue.Queue(maxsize=max_pending)
+        # Versions of the policies behind the learner when their rollouts were used
+        self.staleness = []
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            version, rollout = item
+            try:
+                with self.update_lock:
+                    self.drl_algorithm.update(rollout)
+                    state = (_clone_state(self.drl_algorithm.actor), _clone_state(self.drl_algorithm.critic))
+                with self.publish_lock:
+                    self.staleness.append(self.version - version)
+                    self.version += 1
+                    self.published = state
+            except Exception as e:
+                # Re-raised in the collecting thread by submit/sync/close
+                self.error = e
+                break
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError("The learner thread failed") from self.error
+
+    def submit(self, rollout):
+        """
+        Queue a rollout for the learner, blocking while the queue is full.
+
+        Input:
+            rollout: tuple of arrays as Memory.copy_rollout, not reused by the caller
+        """
+        item = (self.policy_version, rollout)
+        while True:
+            self._check()
+            try:
+                self.queue.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                continue
+
+    def sync(self):
+        """
+        Load the latest published weights in the acting networks.
+
+        Return:
+            bool, True when the acting policy changed
+        """
+        self._check()
+        with self.publish_lock:
+            if self.published is None or self.policy_version == self.version:
+                return False
+            actor_state, critic_state = self.published
+            version = self.version
+        self.policy.actor.load_state_dict(actor_state)
+        self.policy.critic.load_state_dict(critic_state)
+        self.policy_version = version
+        return True
+
+    def wait(self):
+        """
+        Block until the queued rollouts are learned, then load the latest
+        weights in the acting networks.
+        """
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                self._check()
+                self.queue.all_tasks_done.wait(timeout=1.0)
+        self.sync()
+
+    def save_model(self, f=None, info=None):
+        """
+        Save the learner networks without catching them in the middle of an update.
+        """
+        with self.update_lock:
+            self.drl_algorithm.save_model(f, info)
+
+    def training_state(self):
+        """
+        DRL_algorithm.training_state of the learner, between two updates.
+        """
+        with self.update_lock:
+            return self.drl_algorithm.training_state()
+
+    def close(self):
+        """
+        Finish the queued updates and stop the thread.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._check()
+        self.sync()
+
+
+def _clone_state(network):
+    return {name: tensor.detach().clone() for name, tensor in network.state_dict().items()}
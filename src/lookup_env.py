@@ -0,0 +1,185 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+from simulation import (Simulation, BatchedSimulation, ACTION_DELTAS, LOWER_LIMIT, UPPER_LIMIT, MAX_RUN_TIME,
+                        eucl_distance, move, observe, get_reward)
+
+# Version of the table layout, part of the cache key
+TABLE_VERSION = 1
+# Pursuiter coordinates reachable by move: the limits push the disk back, so
+# it can not get further than one double step beyond them
+LOW = LOWER_LIMIT - int(np.abs(ACTION_DELTAS).max())
+HIGH = UPPER_LIMIT + int(np.abs(ACTION_DELTAS).max())
+
+
+class LookupTables:
+    """
+        Observation, reward and termination of every pursuiter cell of an
+        arena with a fixed evasor. Cells are the integer positions of
+        [LOW, HIGH] x [LOW, HIGH], flattened row by row:
+
+            observations (n_cells, n_obs)       lidar measured in the cell
+            next_cells (n_cells, n_actions)     cell reached by each action
+            rewards (n_cells, n_actions)        reward of each action
+            dones (n_cells, n_actions)          termination of each action
+
+        The tables are filled with the functions of simulation.py, so a
+        lookup gives exactly what Simulation.step computes. They are cached
+        in cache_dir under a hash of the evasor position, the map and the
+        sensor.
+    """
+    def __init__(self, evasor_pos=(60, 60), obstacle_map=None, sensor=None, cache_dir="../model/lookup"):
+        self.evasor_pos = np.array(evasor_pos, dtype=np.int64)
+        self.width = HIGH - LOW + 1
+        self.config = {
+            "version": TABLE_VERSION,
+            "evasor": self.evasor_pos.tolist(),
+            "limits": [LOW, HIGH],
+            "map": None if obstacle_map is None else obstacle_map.to_dict(),
+            "sensor": None if sensor is None else sensor.to_dict()
+        }
+        key = hashlib.sha1(json.dumps(self.config, sort_keys=True).encode()).hexdigest()[:16]
+        self.path = None if cache_dir is None else os.path.join(cache_dir, f"lookup_{key}.npz")
+
+        axis = np.arange(LOW, HIGH + 1, dtype=np.int64)
+        self.positions = np.stack(np.meshgrid(axis, axis), axis=-1).reshape(-1, 2)
+        if self.path is not None and os.path.exists(self.path):
+            self._load()
+        else:
+            self._build(obstacle_map, sensor)
+            if self.path is not None:
+                self._save()
+
+    def _build(self, obstacle_map, sensor, chunk_size=4096):
+        n_cells, n_actions = len(self.positions), len(ACTION_DELTAS)
+        # Cells in chunks, the ray lidar broadcasts beams x obstacles per cell
+        self.observations = np.concatenate([
+            observe(self.positions[i:i + chunk_size], self.evasor_pos, obstacle_map, sensor)
+            for i in range(0, n_cells, chunk_size)])
+        self.next_cells = np.empty((n_cells, n_actions), dtype=np.int32)
+        self.rewards = np.empty((n_cells, n_actions))
+        self.dones = np.empty((n_cells, n_actions), dtype=bool)
+        for action in range(n_actions):
+            next_positions = move(self.positions, action)
+            self.next_cells[:, action] = self.cell(next_positions)
+            self.rewards[:, action], self.dones[:, action] = get_reward(next_positions, self.evasor_pos,
+                                                                        self.observations, obstacle_map)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, config=json.dumps(self.config), observations=self.observations,
+                     next_cells=self.next_cells, rewards=self.rewards, dones=self.dones)
+        # Other processes building the same tables only ever see a complete file
+        os.replace(tmp_path, self.path)
+
+    def _load(self):
+        with np.load(self.path) as data:
+            if json.loads(str(data["config"])) != self.config:
+                raise ValueError(f"{self.path} holds the tables of another configuration")
+            self.observations = data["observations"]
+            self.next_cells = data["next_cells"]
+            self.rewards = data["rewards"]
+            self.dones = data["dones"]
+
+    def cell(self, positions):
+        """
+        Cell index of pursuiter positions (..., 2).
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        if np.any((positions < LOW) | (positions > HIGH)):
+            raise ValueError(f"Pursuiter positions out of the tabulated cells [{LOW}, {HIGH}]")
+        return (positions[..., 1] - LOW) * self.width + (positions[..., 0] - LOW)
+
+
+####################################
+##       Lookup Simulations       ##
+####################################
+
+class LookupSimulation(Simulation):
+    """
+        Simulation whose steps are lookups in LookupTables. The evasor stays
+        at evasor_spawn, everything else (spawns, episode limits, state
+        attributes) works as in Simulation.
+    """
+    def __init__(self, evasor_spawn=(60, 60), pursuiter_spawn=(150, 150), max_run_time=MAX_RUN_TIME, seed=None,
+                 profiler=None, obstacle_map=None, sensor=None, spawn_band=None, spawn_sampler=None,
+                 tables=None, cache_dir="../model/lookup"):
+        super().__init__(evasor_spawn, pursuiter_spawn, max_run_time, seed, profiler, obstacle_map, sensor, spawn_band,
+                         spawn_sampler)
+        if tables is None:
+            tables = LookupTables(evasor_spawn, obstacle_map, sensor, cache_dir)
+        elif not np.array_equal(tables.evasor_pos, self.evasor_spawn):
+            raise ValueError("The lookup tables were built for another evasor position")
+        self.tables = tables
+        self.cell = tables.cell(self.pursuiter_position)
+
+    def reset(self):
+        self.evasor_position = self.evasor_spawn.copy()
+        self.pursuiter_position = self.random_spawn()
+        self.spawn_eucl_dist = float(eucl_distance(self.pursuiter_position, self.evasor_position))
+        self.cell = self.tables.cell(self.pursuiter_position)
+        self.lidar = self.tables.observations[self.cell]
+        self.run_time = 1
+        self.done = False
+        return self.lidar.copy()
+
+    def step(self, action):
+        tables = self.tables
+        reward = float(tables.rewards[self.cell, action])
+        self.done = bool(tables.dones[self.cell, action])
+        self.cell = tables.next_cells[self.cell, action]
+        self.pursuiter_position = tables.positions[self.cell]
+        self.lidar = tables.observations[self.cell]
+        self.run_time += 1
+        return self.lidar.copy(), reward, self.done
+
+
+class BatchedLookupSimulation(BatchedSimulation):
+    """
+        BatchedSimulation whose steps are lookups in LookupTables. All the
+        arenas share the evasor position of the tables.
+    """
+    def __init__(self, n_envs, evasor_spawn=(60, 60), pursuiter_spawn=(150, 150), max_run_time=MAX_RUN_TIME, seed=None,
+                 obstacle_map=None, sensor=None, spawn_band=None, spawn_sampler=None,
+                 tables=None, cache_dir="../model/lookup"):
+        if np.asarray(evasor_spawn).ndim != 1:
+            raise ValueError("Lookup arenas share a single evasor position")
+        super().__init__(n_envs, evasor_spawn, pursuiter_spawn, max_run_time, seed, obstacle_map, sensor, spawn_band,
+                         spawn_sampler)
+        if tables is None:
+            tables = LookupTables(evasor_spawn, obstacle_map, sensor, cache_dir)
+        elif not np.array_equal(tables.evasor_pos, evasor_spawn):
+            raise ValueError("The lookup tables were built for another evasor position")
+        self.tables = tables
+        self.cell = tables.cell(self.pursuiter_position)
+
+    def reset(self, mask=None):
+        idx = np.arange(self.n_envs) if mask is None else np.flatnonzero(mask)
+        self.evasor_position[idx] = self.evasor_spawn[idx]
+        self.pursuiter_position[idx] = self.random_spawn(idx)
+        self.spawn_eucl_dist[idx] = eucl_distance(self.pursuiter_position[idx], self.evasor_position[idx])
+        self.cell[idx] = self.tables.cell(self.pursuiter_position[idx])
+        self.lidar[idx] = self.tables.observations[self.cell[idx]]
+        self.run_time[idx] = 1
+        return self.lidar.copy()
+
+    def step(self, actions):
+        tables = self.tables
+        actions = np.asarray(actions, dtype=np.int64)
+        rewards = tables.rewards[self.cell, actions]
+        dones = tables.dones[self.cell, actions]
+        self.cell = tables.next_cells[self.cell, actions]
+        self.pursuiter_position = tables.positions[self.cell]
+        self.lidar = tables.observations[self.cell]
+        self.run_time += 1
+        self.truncated = ~dones & (self.run_time > self.max_run_time)
+
+        finished = dones | self.truncated
+        if np.any(finished):
+            self.final_lidar[finished] = self.lidar[finished]
+            self.reset(finished)
+        return self.lidar.copy(), rewards, dones
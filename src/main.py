@@ -16,20 +16,16 @@ The algorithm is trained using the Random Sample Experience Replay method, which
 ##         Import Libraries       ##
 ####################################
 
-import pygame
-import sys
-import numpy as np
-from PIL import Image
+import argparse
 import gc
+import json
+import os
+import sys
 import time
 
-from pursuiter import Pursuiter
-from evasor import Evasor
-from utils import Utils
-from obstacles import Obstacles
-from memory import Memory
-from DRL_algorithm import DRL_algorithm
-from sensors import Sensor
+# Only the standard library is imported here: NumPy, torch and pygame are
+# imported by the code paths that use them, so the entry points below and
+# the evaluation workers start without paying for them.
 
 #################################### 
 ##       Environment Design       ##
@@ -39,21 +35,95 @@ class Environment:
     """
         This class define the pygame functionality to implement the Deep Reinforcement Learning method.
     """
-    def __init__(self):        
-        ##### PYGAME
-        # Initialise pygame
-        pygame.init()
-        # Set window
-        self.screen = pygame.display.set_mode((200, 200))
-        # FPS controler
-        self.clock = pygame.time.Clock() 
-
-        ##### OBSTACLES
-        self.sensor = Sensor()
-        self.obstacles = Obstacles(self.screen)
+    def __init__(self, obs_mode="lidar", render_mode="human", async_learning=False, profile=False, profile_every=1000,
+                 map_path=None, n_beams=None, spawn_band=None, lookup=False, n_envs=1, n_workers=0, n_batches=1):
+        ##### OBSERVATIONS
+        # Observations consumed by the networks: "lidar", "image" or "both".
+        # Frames are only captured and preprocessed when they are used.
+        self.obs_mode = obs_mode
+        self.use_images = obs_mode != "lidar"
+
+        ##### RENDERING
+        # "human" keeps the window and its frame pacing, "rgb_array" draws
+        # off-screen and "none" runs at full speed without drawing
+        if self.use_images and render_mode == "none":
+            raise ValueError(f"Observation mode {obs_mode!r} needs frames, use render_mode 'rgb_array' or 'human'")
+        # Arenas stepped in lockstep by run, only drawn and captured one at a time
+        self.n_envs = n_envs
+        if n_envs > 1 and (self.use_images or render_mode != "none"):
+            raise ValueError("Training on several arenas needs obs_mode 'lidar' and render_mode 'none'")
+        self.render_mode = render_mode
+        # pygame is only imported when something is drawn
+        self.viewer = None
+        if render_mode != "none":
+            from viewer import Viewer, RENDER_MODES
+            if render_mode not in RENDER_MODES:
+                raise ValueError(f"Unknown render mode {render_mode!r}, expected one of {RENDER_MODES}")
+
+        from profiling import Profiler
+        from simulation import Simulation, observation_size
+        from memory import Memory
+        from DRL_algorithm import DRL_algorithm
+
+        ##### PROFILING
+        # Per-phase wall time of the training loop, printed every profile_every
+        # steps and available from self.profiler.summary(). Disabled it costs
+        # a method call per phase.
+        self.profiler = Profiler(enabled=profile, report_every=profile_every)
+
+        ##### SIMULATION
+        # Headless physics, lidar and reward, with the interior obstacles of
+        # the map file (see obstacle_map.ObstacleMap) when one is given
+        self.map_path = map_path
+        obstacle_map = None
+        if map_path is not None:
+            from obstacle_map import ObstacleMap
+            obstacle_map = ObstacleMap.from_file(map_path)
+        # Observations of the four lidar lines, or of n_beams ray-cast beams
+        # (see ray_lidar.RayLidar)
+        self.n_beams = n_beams
+        sensor = None
+        if n_beams is not None:
+            from ray_lidar import RayLidar
+            sensor = RayLidar(n_beams)
+        # With lookup the steps are read from tables of every pursuiter cell,
+        # built once per map, sensor and evasor position and cached on disk
+        # (see lookup_env.LookupTables)
+        self.lookup = lookup
+        if lookup:
+            from lookup_env import LookupSimulation as Simulation
+        # Curriculum band (min_distance, max_distance) of the pursuiter spawns
+        # around the evasor, None to start from the default spawn
+        if n_envs == 1:
+            self.simulation = Simulation(profiler=self.profiler, obstacle_map=obstacle_map, sensor=sensor,
+                                         spawn_band=spawn_band)
+        elif n_workers > 0:
+            # The arenas are split between n_workers processes (see vec_env.SubprocVecEnv).
+            # With n_batches groups of workers, the policy runs on the
+            # observations of a group while the other groups simulate.
+            from vec_env import SubprocVecEnv
+            if lookup:
+                raise ValueError("Lookup tables are not shared with worker processes, use n_workers=0")
+            if n_envs % n_workers != 0:
+                raise ValueError(f"{n_envs} arenas can not be split evenly between {n_workers} workers")
+            if n_workers % n_batches != 0:
+                raise ValueError(f"{n_workers} workers can not be split evenly in {n_batches} batches")
+            self.simulation = SubprocVecEnv(n_workers, n_envs // n_workers, n_batches, obstacle_map=obstacle_map,
+                                            sensor=sensor, spawn_band=spawn_band)
+        elif n_batches > 1:
+            raise ValueError("Stepping the arenas in batches needs worker processes, use n_workers > 0")
+        else:
+            if lookup:
+                from lookup_env import BatchedLookupSimulation as BatchedSimulation
+            else:
+                from simulation import BatchedSimulation
+            self.simulation = BatchedSimulation(n_envs, obstacle_map=obstacle_map, sensor=sensor,
+                                                spawn_band=spawn_band)
 
-        ##### UTILS
-        self.utils = Utils(self.obstacles, self.sensor)
+        ##### PYGAME
+        # Window or off-screen surface that draws the simulation
+        if render_mode != "none":
+            self.viewer = Viewer(render_mode)
 
         ##### CONSTANT PARAMETERS
         # Episodes
@@ -75,268 +145,458 @@ class Environment:
         ###### MEMORY
         # Initial number of experience in storage to start the training
         
-        self.memory = Memory(batch_size=32)
+        n_lidar = observation_size(sensor)
+        self.memory = Memory(batch_size=32, n_envs=n_envs, store_images=self.use_images, n_lidar=n_lidar)
 
         ###### Deep Reinforcement Learning algorithm
-        self.drl_algorithm = DRL_algorithm(self.memory)
+        # Weights, exported actor and checkpoints of each observation config
+        # live in their own directory, see weights_dir
+        self.model_dir = weights_dir(obs_mode, n_beams)
+        self.drl_algorithm = DRL_algorithm(self.memory, obs_mode=obs_mode, n_lidar=n_lidar, model_dir=self.model_dir)
+        self.drl_algorithm.profiler = self.profiler
+        # Run the PPO updates on a background thread while collecting
+        self.async_learning = async_learning
 
         # Run parameters
-        self.current_state = np.empty((200,200,3))
-        self.next_state = np.empty((200,200,3))        
+        self.current_state = None
         self.done = False
 
         # Metric parameters        
         self.record_scores = []        
-
-        #### Players
-        self.pursuiter = Pursuiter()
-        self.evasor = Evasor()
-
-        ## triggers
-        self.restart_params_trigger = False
-        self.start_new_cycle_trigger = True
-        self.save_exp_trigger = False
-        self.training_trigger = False
+        # One row per episode, read back with metrics.MetricsReader
+        self.metrics_root = "../records/metrics"
+
+        # Checkpoints of the complete training state, one directory per run
+        # (see checkpoint.new_run_dir)
+        self.checkpoint_dir = os.path.join(self.model_dir, "checkpoints")
+        # Weights of the best average score of all the runs, with their
+        # exported actor and model_info.json: a run only replaces them when
+        # it beats the best score stored there. The released weights in
+        # ../model/ are only read: copy or --model-dir these ones to use them.
+        self.best_model_dir = os.path.join(self.checkpoint_dir, "best")
+        # Episodes between checkpoints, besides the ones of new best scores
+        self.checkpoint_every = 10
+        # Best scored checkpoints kept
+        self.keep_checkpoints = 3
+        # Average score to beat when training starts without a checkpoint and
+        # the model_info.json of the loaded weights holds no best score
+        self.initial_best_score = float("-inf")
+        # Episodes of the moving average of the scores. No average is a new
+        # best before the window is full, so a few lucky episodes after a
+        # start or a resume from weights never replace the best weights.
+        self.score_window = 50
 
         self.run_time = 1
 
-    def run(self):              
+    def run(self, resume=True):              
         """
-            This method run the game algorithm
+            This method run the game algorithm. With resume, the training
+            continues from the latest checkpoint, rollout in progress
+            included, or from the saved weights, their episode counter and
+            best score when there is no checkpoint yet. With n_envs arenas, every step runs
+            all of them with one policy_batch call, or one call per batch
+            of worker processes while the other batches simulate.
         """
-
-        ######## TRIGGERS
+        import numpy as np
+        from checkpoint import CheckpointManager, set_rng_state, new_run_dir, latest_run_dir
+        from learner import AsyncLearner
+        from metrics import MetricsWriter
+        from preprocessing import preprocess_frames
+
+        # A run without resume never touches the checkpoints of earlier runs
+        run_dir = latest_run_dir(self.checkpoint_dir) if resume else None
+        checkpoints = CheckpointManager(run_dir or new_run_dir(self.checkpoint_dir), keep_top=self.keep_checkpoints)
+        state = checkpoints.load(map_location=self.drl_algorithm.actor.device) if resume else None
+
+        ######## TRAINING COUNTERS
+        start_episode = 1
+        n_steps = 0
+        learn_iters = 0
         save_net_indicator = 1        
-        
-        load = True
-        if load:
-            self.drl_algorithm.load_models(1)    
+        best_scores = self.initial_best_score
+        if state is not None:
+            if (state.get("obs_mode"), state.get("n_beams")) != (self.obs_mode, self.n_beams):
+                raise ValueError(f"The latest checkpoint of {checkpoints.root} was trained on {state.get('obs_mode')} "
+                                 f"observations with n_beams={state.get('n_beams')}, not {self.obs_mode} ones "
+                                 f"with n_beams={self.n_beams}")
+            self.drl_algorithm.load_training_state(state["algorithm"])
+            set_rng_state(state["rng"], self._spawn_rng_owner())
+            start_episode = state["episode"] + 1
+            n_steps = state["n_steps"]
+            learn_iters = state["learn_iters"]
+            save_net_indicator = state["save_net_indicator"]
+            best_scores = state["best_score"]
+            self.record_scores = list(state["recent_scores"])
+            # Steps collected since the last PPO update, dropped when they
+            # come from another number of arenas
+            rollout = state.get("rollout")
+            if rollout is not None and rollout[2].shape[1:] == (self.n_envs,):
+                self.memory.restore_rollout(rollout)
+            elif rollout is not None:
+                print("Dropping the rollout of the checkpoint, collected on", rollout[2].shape[1], "arenas")
+            print("Resuming from episode", start_episode)
+        elif resume and os.path.exists(self.drl_algorithm.actor.save_dir):
+            # Weights saved without the rest of the training state: the
+            # counters continue from their model_info and new weights have to
+            # beat the score they were saved with
+            info = self.drl_algorithm.load_models()    
+            best_scores = info.get("best_score", self.initial_best_score)
+            start_episode = info.get("episode", 0) + 1
+            save_net_indicator = info.get("save_net_indicator", save_net_indicator)
+
+        # In asynchronous mode the actions come from a snapshot of the policy
+        # and the learner thread trains on the previous rollout
+        learner = AsyncLearner(self.drl_algorithm) if self.async_learning else None
+        acting = self.drl_algorithm if learner is None else learner.policy
+
+        metrics = MetricsWriter(self.metrics_root)
 
-        n_steps = 0
         avg_score = 0
-        best_scores = 84403.71148195057
-        learn_iters = 0
         N = 64    
             
-        for epis in range(1701, self.EPISODES+1):
-            ##### Restart the initial parameters in each episode
-            self.done = False           
-            
-            reward = 0
-            
-            scores = 0.0
-            self.run_time = 1           
-
-            ##### TRIGGERS
-            # 1st step
-            self.restart_params_trigger = False
-            # 2nd step
-            self.start_new_cycle_trigger = True
-            # 3rd step
-            self.save_exp_trigger = False
-            # 4th step
-            self.training_trigger = False
-
-            # Spawn the agents and draw the environment
-            self.screen.fill((138,138,138))
-            self.obstacles.render_walls()
-
-            print("STARTING RESPAWN")
-
-            self.evasor.position = []
-            self.pursuiter.position = []
-            self.sensor.position = []
-            x, y = self.utils.random_spawn(evasor_spawn=True)
-            self.evasor.position.append(x)            
-            self.evasor.position.append(y)
-            self.evasor.spawn(self.screen)
-
-            x, y = self.utils.random_spawn(self.evasor.position, self.screen, self.evasor, evasor_spawn=False)
-            self.pursuiter.position.append(x)            
-            self.pursuiter.position.append(y)
-            self.pursuiter.spawn(self.screen)
-
-            self.sensor.position.append(self.pursuiter.position[0])
-            self.sensor.position.append(self.pursuiter.position[1])
-            
-            self.sensor.lidar(self.screen)
-            self.screen.fill((138,138,138))
-            self.obstacles.render_walls()
-            self.evasor.spawn(self.screen)
-            self.pursuiter.spawn(self.screen)         
-            # Update the screen
-            pygame.display.update()             
-            
+        profiler = self.profiler
+        profiler.reset()
+        epis = start_episode - 1
+        if self.n_envs == 1:
+            for epis in range(start_episode, self.EPISODES+1):
+                ##### Restart the initial parameters in each episode
+                self.done = False           
             
+                scores = 0.0
+
+                # Spawn the agents and draw the environment
+                print("STARTING RESPAWN")
+                with profiler.phase("reset"):
+                    lidar_current_state = self.simulation.reset()
+                self.run_time = self.simulation.run_time
+                with profiler.phase("render"):
+                    self.render()
                            
-            print("######################################################EPISODE: ", epis)
-            while (self.run_time <= 452) and (not self.done):
-                # Run the game algorithm
-                
-                for event in pygame.event.get():
-                    # Exit event
-                    if event.type == pygame.QUIT:
-                        sys.exit()
-                    
-                ########### Restart parameters
-                        
-                if self.restart_params_trigger:                    
-                    ### Save metrics
-                    # Save score
-                    scores += reward
-                                                               
-                    # Check end episode condition
-                    if (self.done):
-                        break
-                    # Increase run time 
-                    
-                    # Set the dimensions of the states          
-                    self.current_state = np.empty((200,200,3))
-                    self.next_state = np.empty((200,200,3))        
-                     
-                    gc.collect()
-                    time.sleep(0.05)                  
-                    # Restart the trigger cycle
-                    self.drl_algorithm.training_finished = False
-                    self.restart_params_trigger = False                
-                    self.start_new_cycle_trigger = True
-                
-                ########### CAPTURE CURRENT STATE
-                    
-                if self.start_new_cycle_trigger:
-                                    
-                    # Get current state
-                            
+                print("######################################################EPISODE: ", epis)
+                while (self.run_time <= self.simulation.max_run_time) and (not self.done):
+                    # Run the game algorithm
+                    with profiler.phase("events"):
+                        self.handle_events()
+
+                    ########### CAPTURE CURRENT STATE
                     print("Run time: ", self.run_time)
-                    self.current_state = self.get_capture()                    
+                    if self.use_images:
+                        with profiler.phase("capture"):
+                            self.current_state = preprocess_frames(self.get_capture())
 
                     ###### EXECUTE THE ACTION 
-                    # Get lidar observation
-                    lidar_current_state = self.utils.lidar_observations(self.pursuiter.position[0], self.pursuiter.position[1], self.evasor)
                     # Select an action
-                    
-                    action, prob, val = self.drl_algorithm.policy(lidar_current_state)
-                    print(action)  
-                    action_string = self.ACTIONS[action]                
-                    print(action)               
-                    # Execute the action selected
-                    self.pursuiter.controls(action= action_string)                               
-                    # Update the position of the lidar rectangles
-                    self.sensor.update_position(self.pursuiter.position)
+                    with profiler.phase("policy"):
+                        action, prob, val = acting.policy(lidar_current_state, self.current_state)
+                    print(self.ACTIONS[action])
+                    # Execute the action selected and get the reward
+                    with profiler.phase("step"):
+                        lidar_next_state, reward, self.done = self.simulation.step(action)
+                    self.run_time = self.simulation.run_time
 
                     ######## DRAW ZONE
-                    # Draw the window with the updates
-                    # Draw lidar
-                    self.sensor.lidar(self.screen)
-                    # Draw background
-                    self.screen.fill((138,138,138))
-                    # Draw obstacles                    
-                    self.obstacles.render_walls()
-                    # Draw pursuiter
-                    self.pursuiter.spawn(self.screen)                         
-                    # Draw evasor
-                    self.evasor.spawn(self.screen)                                                           
-                    
-                    ####### END DRAW ZONE
-
-                    ###########  CAPTURE NEXT STATE 
-                                                    
-                    
-                    ######### GET REWARD
-                                        
-                    reward, self.done = self.utils.get_reward(self.pursuiter.robot, self.evasor.robot, self.pursuiter.position, self.evasor.position)                        
-
-                    #print(reward)
-                    
-                    # Activate and deactivate step triggers
-                    self.save_exp_trigger = True                   
-
-                ########## SAVE EXPERIENCE 
-                
-                    if self.save_exp_trigger:      
-                        # Add experience in memory                                                                          
-                        self.memory.store_memory(self.current_state.copy(), lidar_current_state, action, prob, val, reward, self.done)        
-                        n_steps += 1
-                        # Next step (TRAINING NETWORK)                                               
-                        self.save_exp_trigger = False                         
-                        self.run_time += 1                            
-                        pygame.display.update()
-                        if self.done:
-                            break
-
-
-                    print("Training step")
-                    self.start_new_cycle_trigger = False
-                    self.training_trigger = True                                                
+                    with profiler.phase("render"):
+                        self.render()
+
+                    # An episode cut at the step limit is stored as done and
+                    # bootstrapped from the value of its last observation
+                    truncated = not self.done and self.run_time > self.simulation.max_run_time
+                    final_val = 0.0
+                    if truncated:
+                        with profiler.phase("policy"):
+                            final_val = float(self._state_values(acting, lidar_next_state)[0])
+
+                    ########## SAVE EXPERIENCE 
+                    # Add experience in memory                                                                          
+                    with profiler.phase("store_memory"):
+                        self.memory.store_memory(self.current_state, lidar_current_state, action, prob, val, reward,
+                                                 self.done or truncated, final_val)
+                    n_steps += 1
+                    scores += reward
+                    lidar_current_state = lidar_next_state
 
-                if self.training_trigger:                
-                    # Train the model
+                    ########## TRAINING NETWORK
                     if n_steps % N == 0:
-                        self.drl_algorithm.train()           
-                    # Wait until the training has been completed.
-                        while not self.drl_algorithm.training_finished:
-                            continue
+                        print("Training step")
+                        with profiler.phase("policy"):
+                            last_vals = self._state_values(acting, lidar_current_state)
+                        self._learn(learner, last_vals)
                         learn_iters += 1
-                    
-                    self.restart_params_trigger = True
-           
-                # Update the display
-                pygame.display.update()                
-            
-            print("END RUN TIME")
-            # Save scores of the episode
-            self.record_scores.append(scores)            
-            avg_score = np.mean(self.record_scores[-50:])
+
+                    if self.render_mode == "human":
+                        with profiler.phase("sleep"):
+                            gc.collect()
+                            time.sleep(0.05)
+                    profiler.step()
             
-            # Check if the algorithm is still in the non-training phase.
+                print("END RUN TIME")
+                # Save scores of the episode
+                avg_score, best_scores, save_net_indicator, new_best = self._end_episode(
+                    metrics, learner, epis, scores, self.run_time, self.simulation.spawn_eucl_dist, best_scores,
+                    save_net_indicator)
+
+                # Complete training state, written on a background thread
+                if new_best or epis % self.checkpoint_every == 0:
+                    checkpoints.save(self._training_state(learner, epis, n_steps, learn_iters, save_net_indicator, best_scores),
+                                     epis, avg_score)
             
-                # Save the model if the score of the episode is grater than 2500
-            if (avg_score > best_scores):
-                # Save the weights
-                best_scores = avg_score
-                self.drl_algorithm.save_model(save_net_indicator)
-                # Save network records
-                with open("../records/save_network.txt", 'a') as file:
-                    file.write("Save: {0}, Episode: {1}/{2}, Best Score: {3}, Play_time: {4}, Spawn distance: {5}\n".format(save_net_indicator, epis, self.EPISODES, best_scores, self.run_time, self.utils.spawn_eucl_dist))
-                save_net_indicator += 1
-            # Save records and model each 100 episodes.
-            if epis % 100 == 0:        
-                # Save scores and losses
-                with open("../records/save_records.txt", 'a') as file:
-                    file.write("Scores: {0}\n".format(self.record_scores))
-                
-                
 
-                
-                # Restart the record scores and losses
-                self.record_scores = []               
-            
+                if self.render_mode == "human":
+                    with profiler.phase("sleep"):
+                        gc.collect()
+                        time.sleep(1)
+                print("END EPISODE")
+        else:
+            # Every step runs all the arenas and their finished episodes are
+            # counted in the order they end. n_steps counts these steps, so a
+            # PPO update trains on N steps of every arena.
+            simulation = self.simulation
+            pipelined = getattr(simulation, "n_batches", 1) > 1
+            with profiler.phase("reset"):
+                lidar_current_state = simulation.reset()
+            if pipelined:
+                # The first step of every batch is sent up front, the next
+                # ones by _step_batches
+                with profiler.phase("policy"):
+                    actions, probs, vals = acting.policy_batch(lidar_current_state)
+                for batch, envs in enumerate(simulation.batch_envs):
+                    simulation.step_async(actions[envs], batch)
+            scores = np.zeros(self.n_envs)
+            run_times = np.ones(self.n_envs, dtype=np.int64)
+            # Finished arenas are reset inside step, the spawn distance of an
+            # episode is kept from its start
+            spawn_distances = simulation.spawn_eucl_dist.copy()
+            while epis < self.EPISODES:
+                if pipelined:
+                    lidar_next_state, rewards, dones, truncated, final_lidar, next_spawn_distances, next_actions = \
+                        self._step_batches(acting)
+                else:
+                    with profiler.phase("policy"):
+                        actions, probs, vals = acting.policy_batch(lidar_current_state)
+                    with profiler.phase("step"):
+                        lidar_next_state, rewards, dones = simulation.step(actions)
+                    truncated, final_lidar = simulation.truncated, simulation.final_lidar
+                    next_spawn_distances = simulation.spawn_eucl_dist
+                finished = np.flatnonzero(dones | truncated)
+                # Arenas cut at the step limit are stored as done and bootstrapped
+                # from the value of their last observation, before the reset
+                final_vals = np.zeros(self.n_envs, dtype=np.float32)
+                if np.any(truncated):
+                    with profiler.phase("policy"):
+                        final_vals[truncated] = acting.values(final_lidar[truncated])
+
+                with profiler.phase("store_memory"):
+                    self.memory.store_memory_batch(lidar_current_state, actions, probs, vals, rewards, dones | truncated,
+                                                   final_vals=final_vals)
+                n_steps += 1
+                scores += rewards
+                run_times += 1
+                lidar_current_state = lidar_next_state
+
+                if n_steps % N == 0:
+                    print("Training step")
+                    if pipelined:
+                        # Values the policy already computed for the next step
+                        last_vals = next_actions[2]
+                    else:
+                        with profiler.phase("policy"):
+                            last_vals = acting.values(lidar_current_state)
+                    self._learn(learner, last_vals)
+                    learn_iters += 1
+
+                for env in finished:
+                    epis += 1
+                    print("######################################################EPISODE: ", epis)
+                    avg_score, best_scores, save_net_indicator, new_best = self._end_episode(
+                        metrics, learner, epis, float(scores[env]), int(run_times[env]), float(spawn_distances[env]),
+                        best_scores, save_net_indicator)
+                    if new_best or epis % self.checkpoint_every == 0:
+                        checkpoints.save(self._training_state(learner, epis, n_steps, learn_iters, save_net_indicator,
+                                                              best_scores),
+                                         epis, avg_score)
+                    if epis == self.EPISODES:
+                        break
+                scores[finished] = 0.0
+                run_times[finished] = 1
+                spawn_distances[finished] = next_spawn_distances[finished]
+                if pipelined:
+                    actions, probs, vals = next_actions
+                profiler.step()
+
+        metrics.close()
+        if learner is not None:
+            learner.close()
+        if epis >= start_episode and epis % self.checkpoint_every != 0:
+            checkpoints.save(self._training_state(learner, epis, n_steps, learn_iters, save_net_indicator, best_scores),
+                             epis, avg_score)
+        checkpoints.close()
+        if self.viewer is not None:
+            self.viewer.close()
+        if hasattr(self.simulation, "close"):
+            self.simulation.close()
+
+    def _learn(self, learner, last_vals):
+        """
+            PPO update on the rollout in memory, or hand it over to the
+            learner thread in asynchronous mode. last_vals are the values
+            of the states that follow the rollout, they bootstrap its last step.
+        """
+        self.memory.store_last_values(last_vals)
+        with self.profiler.phase("train"):
+            if learner is None:
+                self.drl_algorithm.train()
+            else:
+                learner.submit(self.memory.copy_rollout())
+                self.memory.clear_memory()
+                learner.sync()
+
+    def _step_batches(self, acting):
+        """
+            Finish the pending step of every batch of worker processes and
+            send the next one, chosen on the observations of the batch while
+            the next batches simulate. These actions are chosen before the
+            PPO update that may follow the step, so the first step of a
+            rollout comes from the policy of the previous one, with its own
+            probabilities.
 
-            gc.collect()
-            time.sleep(1)
-            print("END EPISODE")
+            Return:
+                observations, rewards, dones, truncated, last observations of
+                the finished arenas and spawn distances of the finished step,
+                and (actions, probs, vals) of the next one
+        """
+        import numpy as np
+
+        simulation = self.simulation
+        n_envs = simulation.n_envs
+        lidar_next_state = np.empty((n_envs, simulation.n_obs), dtype=np.float32)
+        rewards, dones = np.empty(n_envs), np.empty(n_envs, dtype=bool)
+        truncated, spawn_distances = np.empty(n_envs, dtype=bool), np.empty(n_envs)
+        final_lidar = np.empty_like(lidar_next_state)
+        actions = np.empty(n_envs, dtype=np.int64)
+        probs, vals = np.empty(n_envs, dtype=np.float32), np.empty(n_envs, dtype=np.float32)
+        for batch, envs in enumerate(simulation.batch_envs):
+            with self.profiler.phase("step"):
+                lidar_next_state[envs], rewards[envs], dones[envs] = simulation.step_wait(batch)
+            # Shared buffers, read before the next step of the batch writes them
+            truncated[envs] = simulation.truncated[envs]
+            final_lidar[envs] = simulation.final_lidar[envs]
+            spawn_distances[envs] = simulation.spawn_eucl_dist[envs]
+            with self.profiler.phase("policy"):
+                actions[envs], probs[envs], vals[envs] = acting.policy_batch(lidar_next_state[envs])
+            simulation.step_async(actions[envs], batch)
+        return lidar_next_state, rewards, dones, truncated, final_lidar, spawn_distances, (actions, probs, vals)
+
+    def _state_values(self, acting, lidar_state):
+        """
+            Critic value of the current state of the single arena, with the
+            frame on screen in the image modes.
 
-        pygame.quit()
+            Return:
+                float32 array (1,)
+        """
+        import numpy as np
+        from preprocessing import preprocess_frames
+
+        img_state = preprocess_frames(self.get_capture())[None] if self.use_images else None
+        return acting.values(np.asarray(lidar_state)[None], img_state)
+
+    def _end_episode(self, metrics, learner, episode, score, run_time, spawn_distance, best_score, save_net_indicator):
+        """
+            Record a finished episode. A moving average of the scores above
+            best_score is a new best of the run, its weights replace the
+            ones of best_model_dir when they also beat the score stored there.
+
+            Return:
+                moving average, best score, save_net_indicator and True on a new best
+        """
+        import numpy as np
+
+        self.record_scores.append(score)
+        avg_score = np.mean(self.record_scores[-self.score_window:])
+        # In asynchronous mode the losses are the ones of the latest finished update
+        actor_loss, critic_loss = self.drl_algorithm.last_losses
+        metrics.append(episode=episode, score=score, length=run_time - 1, spawn_distance=spawn_distance,
+                       actor_loss=actor_loss, critic_loss=critic_loss, wall_time=time.time())
+
+        new_best = len(self.record_scores) >= self.score_window and avg_score > best_score
+        if new_best:
+            best_score = avg_score
+        if new_best and best_score > self.drl_algorithm.model_info(self.best_model_dir).get("best_score", float("-inf")):
+            # Save the weights
+            info = {"best_score": float(best_score), "episode": episode, "save_net_indicator": save_net_indicator + 1}
+            if learner is None:
+                self.drl_algorithm.save_model(self.best_model_dir, info)
+            else:
+                learner.save_model(self.best_model_dir, info)
+            # Save network records
+            with open("../records/save_network.txt", 'a') as file:
+                file.write("Save: {0}, Episode: {1}/{2}, Best Score: {3}, Play_time: {4}, Spawn distance: {5}\n".format(save_net_indicator, episode, self.EPISODES, best_score, run_time, spawn_distance))
+            save_net_indicator += 1
+        # Only the scores of the moving average are kept in memory
+        self.record_scores = self.record_scores[-self.score_window:]
+        return avg_score, best_score, save_net_indicator, new_best
+
+    def _training_state(self, learner, episode, n_steps, learn_iters, save_net_indicator, best_score):
+        """
+            Everything run needs to resume after the given episode. In
+            asynchronous mode the queued rollouts are learned first, they
+            are neither in the networks nor in memory yet.
+        """
+        from checkpoint import rng_state
+
+        if learner is not None:
+            learner.wait()
+        algorithm = self.drl_algorithm.training_state() if learner is None else learner.training_state()
+        return {"algorithm": algorithm,
+                "rng": rng_state(self._spawn_rng_owner()),
+                "episode": episode,
+                "n_steps": n_steps,
+                "learn_iters": learn_iters,
+                "save_net_indicator": save_net_indicator,
+                "best_score": best_score,
+                "recent_scores": list(self.record_scores),
+                "rollout": self.memory.copy_rollout(),
+                "obs_mode": self.obs_mode,
+                "n_beams": self.n_beams}
+
+    def _spawn_rng_owner(self):
+        # The spawn generators of worker processes are not checkpointed
+        return self.simulation if hasattr(self.simulation, "rng") else None
+
+    def render(self):
+        if self.viewer is not None:
+            self.viewer.render(self.simulation)
+
+    def handle_events(self):
+        if self.viewer is not None:
+            self.viewer.handle_events()
 
     def get_capture(self):
         """
             Capture the current state image.
             Return:
-                captured (NumPy array): Return a NumPy array image with dimensions (405, 410, 3).
+                captured (NumPy array): Return a NumPy array image with dimensions (200, 200, 3).
 
         """
-        # Create the Surface        
-        capture = pygame.Surface((self.screen.get_width(), self.screen.get_height()))
-        # Blit the screen on the Surface
-        capture.blit(self.screen, (0, 0))
-        # Convert from Surface to Array
-               
-        # Return the capture
-        return pygame.surfarray.array3d(capture)   
-
-    def test(self):
+        return self.viewer.get_capture()
+
+    def test(self, greedy=False, actor_path=None):
+        from numpy_actor import NumpyActor
+        from preprocessing import preprocess_frames
+
+        actor_path = actor_path or os.path.join(self.model_dir, "actor_network_ppo.npz")
         # Loading the model
-        self.drl_algorithm.load_models(1)                    
+        if self.use_images:
+            # The NumPy actor only runs lidar networks
+            self.drl_algorithm.load_models()
+        elif actor_is_stale(actor_path, self.drl_algorithm.actor.save_dir):
+            self.drl_algorithm.load_models()
+            self.drl_algorithm.export_actor(actor_path)
+        if not self.use_images:
+            actor = NumpyActor(actor_path)
+            if actor.n_lidar != self.memory.n_lidar:
+                raise ValueError(f"The actor {actor_path} takes {actor.n_lidar} lidar distances, "
+                                 f"the simulation measures {self.memory.n_lidar}")
         scores = 0.0
         record_scores = []
         images = []
@@ -344,117 +604,39 @@ class Environment:
             print("Scores: ", scores)            
             self.done = False
 
-            reward = 0.0
-
             scores = 0.0
-            self.run_time = 1
-
-            ##### TRIGGERS
-            # 1st step
-            self.restart_params_trigger = False
-            # 2nd step
-            self.start_new_cycle_trigger = True
-            
-            # 3rd step            
 
             # Spawn the agents and draw the environment
-            self.screen.fill((138,138,138))
-            self.obstacles.render_walls()
-
             print("STARTING RESPAWN")
-
-            self.evasor.position = []
-            self.pursuiter.position = []
-            self.sensor.position = []
-            x, y = self.utils.random_spawn(evasor_spawn=True)
-            self.evasor.position.append(x)            
-            self.evasor.position.append(y)
-            self.evasor.spawn(self.screen)
-
-            x, y = self.utils.random_spawn(self.evasor.position, self.screen, self.evasor, evasor_spawn=False)
-            self.pursuiter.position.append(x)            
-            self.pursuiter.position.append(y)
-            self.pursuiter.spawn(self.screen)
-
-            self.sensor.position.append(self.pursuiter.position[0])
-            self.sensor.position.append(self.pursuiter.position[1])
-            
-            self.sensor.lidar(self.screen)
-            self.screen.fill((138,138,138))
-            self.obstacles.render_walls()
-            self.evasor.spawn(self.screen)
-            self.pursuiter.spawn(self.screen)         
-            # Update the screen
-            pygame.display.update() 
+            lidar_current_state = self.simulation.reset()
+            self.run_time = self.simulation.run_time
+            self.render()
 
             print("######################################################EPISODE: ", epis)
 
-            while (not self.done) and (self.run_time <= 452):
-                for event in pygame.event.get():
-                    # Exit event
-                    if event.type == pygame.QUIT:
-                        sys.exit()
-
-                
-                ### Save metrics
-                # Save score
-                
-                                                     
-                # Check end episode condition
-                if (self.done):
-                    break
-                # Increase run time 
-                    
-                # Set the dimensions of the states          
-                self.current_state = np.empty((200,200,3))
-                self.current_state = self.get_capture()
-                #images.append(Image.fromarray(self.current_state, 'RGB'))                
-                     
-                                          
+            while (not self.done) and (self.run_time <= self.simulation.max_run_time):
+                self.handle_events()
 
+                if self.use_images:
+                    self.current_state = preprocess_frames(self.get_capture())
                 
                 print("Run time: ", self.run_time)
-                                   
 
-                    ###### EXECUTE THE ACTION 
-                    # Get lidar observation
-                lidar_current_state = self.utils.lidar_observations(self.pursuiter.position[0], self.pursuiter.position[1], self.evasor)
-                    # Select an action
-                action, _, _ = self.drl_algorithm.policy(lidar_current_state)  
-                action_string = self.ACTIONS[action]                
-                print(action_string)               
-                    # Execute the action selected
-                self.pursuiter.controls(action= action_string)                               
-                    # Update the position of the lidar rectangles
-                self.sensor.update_position(self.pursuiter.position)
+                ###### EXECUTE THE ACTION 
+                # Select an action
+                if self.use_images:
+                    action, _, _ = self.drl_algorithm.policy(lidar_current_state, self.current_state)
+                else:
+                    action, _ = actor.policy(lidar_current_state, greedy)
+                print(self.ACTIONS[action])               
+                # Execute the action selected and get the reward
+                lidar_current_state, reward, self.done = self.simulation.step(action)
+                self.run_time = self.simulation.run_time
 
-                    ######## DRAW ZONE
-                    # Draw the window with the updates
-                    # Draw lidar
-                self.sensor.lidar(self.screen)
-                    # Draw background
-                self.screen.fill((138,138,138))
-                    # Draw obstacles                    
-                self.obstacles.render_walls()
-                    # Draw pursuiter
-                self.pursuiter.spawn(self.screen)                         
-                    # Draw evasor
-                self.evasor.spawn(self.screen)                                                           
-                        
-                    ####### END DRAW ZONE
+                ######## DRAW ZONE
+                self.render()
 
-                    ###########  CAPTURE NEXT STATE 
-                
-                    # Get lidar next state observations
-                
-                        
-                    ######### GET REWARD
-                                            
-                reward, self.done = self.utils.get_reward(self.pursuiter.robot, self.evasor.robot, self.pursuiter.position, self.evasor.position)                        
-                self.run_time += 1
                 scores += reward
-                
-                pygame.display.update()
             
             record_scores.append(scores)
         
@@ -462,16 +644,173 @@ class Environment:
         
         with open("../records/save_record_test.txt", 'a') as file:
             file.write("Scores: {0}\n".format(record_scores))
-                
-        
-        
 
-# Run the algorithm
-train = False
-gc.enable()
-gc.collect()
-if train:
-    Environment().run()
-else:
-    Environment().test()
+        if self.viewer is not None:
+            self.viewer.close()
 
+    def evaluate(self, n_episodes=100, n_workers=None, seed=0, spawn="default", greedy=False, actor_path=None):
+        """
+            Headless, parallel counterpart of test for lidar policies: the
+            episodes run on a process pool with deterministic seeds and spawns.
+            Return:
+                stats (dict): mean/std score and length, rate of every outcome and time in the target zone.
+        """
+        if self.use_images:
+            raise ValueError("The evaluation harness runs the NumPy actor, which only takes lidar observations")
+        actor_path = actor_path or os.path.join(self.model_dir, "actor_network_ppo.npz")
+        if actor_is_stale(actor_path, self.drl_algorithm.actor.save_dir):
+            self.drl_algorithm.load_models()
+            self.drl_algorithm.export_actor(actor_path)
+        return evaluate(n_episodes, n_workers, seed, spawn, greedy, actor_path, self.map_path, self.n_beams,
+                        lookup=self.lookup)
+
+
+####################################
+##          Entry points          ##
+####################################
+
+def weights_dir(obs_mode="lidar", n_beams=None, root="../model"):
+    """
+    Directory of the weights of an observation config. The networks of the
+    four lidar lines stay in root, the other configs get a subdirectory,
+    e.g. ../model/both or ../model/lidar_16beams, so weights of different
+    input sizes never overwrite each other.
+    """
+    if obs_mode == "lidar" and n_beams is None:
+        return root
+    # Image networks do not read the lidar
+    if n_beams is None or obs_mode == "image":
+        return os.path.join(root, obs_mode)
+    return os.path.join(root, f"{obs_mode}_{n_beams}beams")
+
+def actor_is_stale(actor_path, weights_path):
+    """
+    Check if the exported actor is missing or was not exported from the
+    current torch weights, e.g. after a training run saved new weights.
+    The actor records the digest of its weights file, file times are not
+    kept by a git checkout or a copy.
+    """
+    if not os.path.exists(actor_path):
+        return True
+    if not os.path.exists(weights_path):
+        return False
+    from numpy_actor import file_digest, exported_from
+    return exported_from(actor_path) != file_digest(weights_path)
+
+def train(obs_mode="lidar", render_mode="human", async_learning=False, profile=False, resume=True, map_path=None,
+          n_beams=None, spawn_band=None, lookup=False, n_envs=1, n_workers=0, n_batches=1):
+    gc.enable()
+    gc.collect()
+    Environment(obs_mode, render_mode, async_learning, profile, map_path=map_path, n_beams=n_beams,
+                spawn_band=spawn_band, lookup=lookup, n_envs=n_envs, n_workers=n_workers, n_batches=n_batches).run(resume)
+
+def test(obs_mode="lidar", render_mode="human", greedy=False, actor_path=None,
+         map_path=None, n_beams=None, lookup=False):
+    Environment(obs_mode, render_mode, map_path=map_path, n_beams=n_beams, lookup=lookup).test(greedy, actor_path)
+
+def evaluate(n_episodes=100, n_workers=None, seed=0, spawn="default", greedy=False,
+             actor_path=None, map_path=None, n_beams=None, spawn_band=None, lookup=False):
+    """
+        Evaluate the exported lidar actor with the headless harness, by
+        default the one of weights_dir("lidar", n_beams). Only NumPy is
+        imported, unless the actor has to be exported first.
+    """
+    import evaluation
+
+    if actor_path is None:
+        model_dir = weights_dir("lidar", n_beams)
+        actor_path = os.path.join(model_dir, "actor_network_ppo.npz")
+        if actor_is_stale(actor_path, os.path.join(model_dir, "actor_network_ppo")):
+            export(actor_path, model_dir, n_beams)
+    elif not os.path.exists(actor_path):
+        export(actor_path, n_beams=n_beams)
+    stats, _ = evaluation.evaluate(actor_path, n_episodes, n_workers, seed, spawn, greedy, map_path=map_path,
+                                   n_beams=n_beams, lookup=lookup, spawn_band=spawn_band)
+    stats.update(seed=seed, spawn=spawn, greedy=greedy, map=map_path, beams=n_beams, spawn_band=spawn_band)
+    print(stats)
+    with open("../records/save_evaluation.txt", 'a') as file:
+        file.write(json.dumps(stats) + "\n")
+    return stats
+
+def export(actor_path=None, model_dir=None, n_beams=None):
+    """
+        Export the saved lidar actor (model_dir, by default weights_dir of
+        n_beams) to the NumPy format, by default next to the weights.
+        n_beams is the one the actor was trained with.
+    """
+    from memory import Memory
+    from DRL_algorithm import DRL_algorithm
+
+    model_dir = model_dir or weights_dir("lidar", n_beams)
+    actor_path = actor_path or os.path.join(model_dir, "actor_network_ppo.npz")
+    n_lidar = 4 if n_beams is None else n_beams
+    drl_algorithm = DRL_algorithm(Memory(batch_size=32, n_lidar=n_lidar), n_lidar=n_lidar, model_dir=model_dir)
+    drl_algorithm.load_models()
+    drl_algorithm.export_actor(actor_path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train and evaluate the PPO pursuiter.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_train = commands.add_parser("train", help="train, resuming from the latest checkpoint")
+    parser_train.add_argument("--obs-mode", default="lidar", choices=("lidar", "image", "both"))
+    parser_train.add_argument("--render-mode", default="human", choices=("human", "rgb_array", "none"))
+    parser_train.add_argument("--async-learning", action="store_true")
+    parser_train.add_argument("--profile", action="store_true")
+    parser_train.add_argument("--no-resume", dest="resume", action="store_false")
+    parser_train.add_argument("--map", dest="map_path", help="JSON map of interior obstacles")
+    parser_train.add_argument("--beams", dest="n_beams", type=int, help="ray-cast lidar beams instead of the 4 lines")
+    parser_train.add_argument("--spawn-band", nargs=2, type=float, metavar=("MIN", "MAX"),
+                              help="draw the pursuiter spawns at these distances from the evasor")
+    parser_train.add_argument("--lookup", action="store_true", help="step from precomputed tables")
+    parser_train.add_argument("--n-envs", type=int, default=1,
+                              help="arenas stepped in lockstep, with lidar observations and render mode none")
+    parser_train.add_argument("--workers", dest="n_workers", type=int, default=0,
+                              help="processes simulating the --n-envs arenas, 0 to step them in this one")
+    parser_train.add_argument("--batches", dest="n_batches", type=int, default=1,
+                              help="groups of --workers stepped while the policy runs on the other groups")
+
+    parser_test = commands.add_parser("test", help="watch the policy play 100 episodes")
+    parser_test.add_argument("--obs-mode", default="lidar", choices=("lidar", "image", "both"))
+    parser_test.add_argument("--render-mode", default="human", choices=("human", "rgb_array", "none"))
+    parser_test.add_argument("--greedy", action="store_true")
+    parser_test.add_argument("--actor-path", help="exported actor, by default the one of the observation config")
+    parser_test.add_argument("--map", dest="map_path", help="JSON map of interior obstacles")
+    parser_test.add_argument("--beams", dest="n_beams", type=int, help="ray-cast lidar beams instead of the 4 lines")
+    parser_test.add_argument("--lookup", action="store_true", help="step from precomputed tables")
+
+    parser_evaluate = commands.add_parser("evaluate", help="parallel headless evaluation of the lidar actor")
+    parser_evaluate.add_argument("--episodes", type=int, default=100)
+    parser_evaluate.add_argument("--workers", type=int, default=None)
+    parser_evaluate.add_argument("--seed", type=int, default=0)
+    parser_evaluate.add_argument("--spawn", default="default", choices=("default", "random"))
+    parser_evaluate.add_argument("--greedy", action="store_true")
+    parser_evaluate.add_argument("--actor-path", help="exported actor, by default the one of the observation config")
+    parser_evaluate.add_argument("--map", dest="map_path", help="JSON map of interior obstacles")
+    parser_evaluate.add_argument("--beams", dest="n_beams", type=int, help="ray-cast lidar beams instead of the 4 lines")
+    parser_evaluate.add_argument("--spawn-band", nargs=2, type=float, metavar=("MIN", "MAX"),
+                                 help="distances of the random spawns from the evasor")
+    parser_evaluate.add_argument("--lookup", action="store_true", help="step from precomputed tables")
+
+    parser_export = commands.add_parser("export", help="export the saved actor to NumPy")
+    parser_export.add_argument("--actor-path", help="output file, by default next to the weights")
+    parser_export.add_argument("--model-dir", default=None, help="saved weights, by default the ones of --beams")
+    parser_export.add_argument("--beams", dest="n_beams", type=int, help="ray-cast lidar beams instead of the 4 lines")
+
+    args = parser.parse_args(argv)
+    if args.command == "train":
+        train(args.obs_mode, args.render_mode, args.async_learning, args.profile, args.resume, args.map_path,
+              args.n_beams, args.spawn_band, args.lookup, args.n_envs, args.n_workers, args.n_batches)
+    elif args.command == "test":
+        test(args.obs_mode, args.render_mode, args.greedy, args.actor_path, args.map_path, args.n_beams, args.lookup)
+    elif args.command == "evaluate":
+        evaluate(args.episodes, args.workers, args.seed, args.spawn, args.greedy, args.actor_path, args.map_path,
+                 args.n_beams, args.spawn_band, args.lookup)
+    else:
+        export(args.actor_path, args.model_dir, args.n_beams)
+    return 0
+
+
+# Run the algorithm
+if __name__ == "__main__":
+    sys.exit(main())
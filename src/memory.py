@@ -1,60 +1,138 @@
 import numpy as np
-from PIL import Image
 
-class Memory:
-    def __init__(self, batch_size):
-        self.img_states = []
-        self.lidar_states = []
-        self.probs = []
-        self.vals = []
-        self.actions = []
-        self.rewards = []
-        self.dones = []
+# Fields of a rollout, in the order of Memory.rollout
+FIELDS = ("img_states", "lidar_states", "actions", "probs", "vals", "rewards", "dones", "final_vals")
 
+class Memory:
+    """
+        Rollout buffer. Every field is a preallocated array shaped
+        (capacity, n_envs, ...), filled one step at a time and reused after
+        clear_memory. Frames are only stored when store_images is set, as
+        uint8 like preprocessing.preprocess_frames returns them.
+    """
+    def __init__(self, batch_size, n_envs=1, capacity=64, store_images=False, n_lidar=4):
         self.batch_size = batch_size
+        # Number of arenas stored side by side at every step
+        self.n_envs = n_envs
+        # Distances of a lidar observation, 4 lines or the beams of a RayLidar
+        self.n_lidar = n_lidar
+        self.store_images = store_images
+        # Number of stored steps
+        self.step = 0
+        # Values of the states that follow the last stored step, see store_last_values
+        self.last_vals = None
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self.img_states = None
+        if self.store_images:
+            self.img_states = np.zeros((capacity, self.n_envs, 84, 84), dtype=np.uint8)
+        self.lidar_states = np.zeros((capacity, self.n_envs, self.n_lidar), dtype=np.float32)
+        self.actions = np.zeros((capacity, self.n_envs), dtype=np.int64)
+        self.probs = np.zeros((capacity, self.n_envs), dtype=np.float32)
+        self.vals = np.zeros((capacity, self.n_envs), dtype=np.float32)
+        self.rewards = np.zeros((capacity, self.n_envs), dtype=np.float32)
+        self.dones = np.zeros((capacity, self.n_envs), dtype=np.float32)
+        self.final_vals = np.zeros((capacity, self.n_envs), dtype=np.float32)
+
+    def _grow(self):
+        # Only reached when a rollout is longer than the capacity
+        old = {name: getattr(self, name) for name in FIELDS}
+        self._allocate(2 * self.capacity)
+        for name in FIELDS:
+            if old[name] is not None:
+                getattr(self, name)[:self.step] = old[name][:self.step]
+
+    def __len__(self):
+        return self.step * self.n_envs
+
+    def rollout(self):
+        """
+        Views of the stored steps, time first.
+
+        Return:
+            img_states (T, n_envs, 84, 84), lidar_states (T, n_envs, n_lidar), actions,
+            probs, vals, rewards, dones and final_vals (T, n_envs), then last_vals
+            (n_envs,) or None
+        """
+        img_states = None if self.img_states is None else self.img_states[:self.step]
+        return img_states, \
+                self.lidar_states[:self.step], \
+                self.actions[:self.step], \
+                self.probs[:self.step], \
+                self.vals[:self.step], \
+                self.rewards[:self.step], \
+                self.dones[:self.step], \
+                self.final_vals[:self.step], \
+                self.last_vals
+
+    def copy_rollout(self):
+        """
+        Copy of rollout() that stays valid after clear_memory.
+        """
+        return tuple(None if arr is None else arr.copy() for arr in self.rollout())
+
+    def restore_rollout(self, rollout):
+        """
+        Replace the stored steps by a rollout returned by copy_rollout, e.g.
+        the partly filled one of a training checkpoint.
+        """
+        self.step = 0
+        n_steps = len(rollout[2])
+        while self.capacity < n_steps:
+            self._grow()
+        for name, arr in zip(FIELDS, rollout):
+            if arr is not None and getattr(self, name) is not None:
+                getattr(self, name)[:n_steps] = arr
+        self.step = n_steps
+        # Rollouts of older checkpoints end with the dones
+        if len(rollout) < len(FIELDS):
+            self.final_vals[:n_steps] = 0.0
+        self.last_vals = rollout[len(FIELDS)] if len(rollout) > len(FIELDS) else None
+
+    def store_memory(self, img_state, lidar_state, action, probs, vals, reward, done, final_val=0.0):
+        self.store_memory_batch(np.asarray(lidar_state)[None], action, probs, vals, reward, done,
+                                img_states=None if img_state is None else [img_state], final_vals=final_val)
+
+    def store_memory_batch(self, lidar_states, actions, probs, vals, rewards, dones, img_states=None, final_vals=0.0):
+        """
+        Store one step of the n_envs arenas.
+
+        Input:
+            lidar_states: array (n_envs, n_lidar), lidar distances
+            actions, probs, vals, rewards, dones: arrays (n_envs,). An episode
+                        cut at the step limit is done too, it is the end of its rollout
+            img_states: uint8 array (n_envs, 84, 84) of preprocessed frames, only
+                        needed when store_images is set
+            final_vals: array (n_envs,), values of the last observations of the
+                        episodes cut at the step limit, 0 for the other arenas
+        """
+        if self.step == self.capacity:
+            self._grow()
+        t = self.step
+        if self.store_images:
+            self.img_states[t] = img_states
+
+        self.lidar_states[t] = np.asarray(lidar_states) / 200.0
+        self.actions[t] = actions
+        self.probs[t] = probs
+        self.vals[t] = vals
+        self.rewards[t] = rewards
+        self.dones[t] = dones
+        self.final_vals[t] = final_vals
+        self.step += 1
+
+    def store_last_values(self, vals):
+        """
+        Critic values of the states that follow the last stored step, which
+        bootstrap its advantages (see DRL_algorithm.compute_gae).
 
-    def generate_batches(self):
-        n_states = len(self.img_states)
-        batch_start = np.arange(0, n_states, self.batch_size)
-        indices = np.arange(n_states, dtype=np.int64)
-        np.random.shuffle(indices)
-        batches = [indices[i:i+self.batch_size] for i in batch_start]
-
-        return np.array(self.img_states),\
-                np.array(self.lidar_states), \
-                np.array(self.actions),\
-                np.array(self.probs), \
-                np.array(self.vals), \
-                np.array(self.rewards), \
-                np.array(self.dones),\
-                batches
-    
-    def store_memory(self, img_state, lidar_state, action, probs, vals, reward, done):
-
-        img_state = Image.fromarray(img_state).convert('L')
-        img_state = img_state.rotate(-90)
-        img_state = img_state.transpose(Image.FLIP_LEFT_RIGHT)  
-        img_state = img_state.resize((84,84))
-        img_state = np.array(img_state) 
-        img_state = img_state / 255.0 
-        self.img_states.append(img_state)
-        
-        lidar_state = np.array(lidar_state) / 200.0
-        
-        self.lidar_states.append(lidar_state)
-        
-        self.actions.append(action)
-        self.probs.append(probs)
-        self.vals.append(vals)
-        self.rewards.append(reward)
-        self.dones.append(done)
+        Input:
+            vals: array (n_envs,)
+        """
+        self.last_vals = np.array(vals, dtype=np.float32).reshape(self.n_envs)
 
     def clear_memory(self):
-        self.img_states = []
-        self.lidar_states = []
-        self.probs = []
-        self.actions = []
-        self.vals = []
-        self.rewards = []
-        self.dones = []
-    
\ No newline at end of file
+        self.step = 0
+        self.last_vals = None
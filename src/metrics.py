@@ -0,0 +1,200 @@
+import os
+import json
+import numpy as np
+
+# Columns of the metrics log, one row per episode
+COLUMNS = {
+    "episode": np.int64,
+    "score": np.float64,
+    "length": np.int64,
+    "spawn_distance": np.float64,
+    "actor_loss": np.float32,
+    "critic_loss": np.float32,
+    # Seconds since the epoch at the end of the episode
+    "wall_time": np.float64
+}
+SCHEMA_FILE = "schema.json"
+
+
+def _column_path(root, name):
+    return os.path.join(root, f"{name}.bin")
+
+
+class MetricsWriter:
+    """
+        Append-only columnar metrics log.
+
+        Each column is a raw little-endian binary file <name>.bin next to a
+        schema.json with the dtypes. Rows are buffered and appended to every
+        column file each buffer_rows rows, so reopening the directory keeps
+        appending to the same log.
+    """
+    def __init__(self, root, buffer_rows=100):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        schema = {name: np.dtype(dtype).newbyteorder('<').str for name, dtype in COLUMNS.items()}
+        schema_path = os.path.join(root, SCHEMA_FILE)
+        if os.path.exists(schema_path):
+            with open(schema_path) as file:
+                if json.load(file) != schema:
+                    raise ValueError(f"{root} holds metrics with a different schema")
+        else:
+            with open(schema_path, 'w') as file:
+                json.dump(schema, file)
+        # An interrupted flush can leave columns of different lengths, cut them back
+        n_rows = _n_rows(root, schema)
+        for name, dtype in schema.items():
+            with open(_column_path(root, name), 'ab') as file:
+                file.truncate(n_rows * np.dtype(dtype).itemsize)
+
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in schema.items()}
+        self.buffer = {name: np.empty(buffer_rows, dtype=dtype) for name, dtype in self.dtypes.items()}
+        self.buffered = 0
+
+    def append(self, **row):
+        """
+        Add one row. Missing loss columns are stored as NaN.
+        """
+        for name, column in self.buffer.items():
+            if name in row:
+                column[self.buffered] = row[name]
+            elif name.endswith("_loss"):
+                column[self.buffered] = np.nan
+            else:
+                raise ValueError(f"Missing metrics column {name!r}")
+        self.buffered += 1
+        if self.buffered == len(self.buffer["episode"]):
+            self.flush()
+
+    def flush(self):
+        for name, column in self.buffer.items():
+            with open(_column_path(self.root, name), 'ab') as file:
+                file.write(column[:self.buffered].tobytes())
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+
+
+def _n_rows(root, schema):
+    sizes = []
+    for name, dtype in schema.items():
+        path = _column_path(root, name)
+        sizes.append(os.path.getsize(path) // np.dtype(dtype).itemsize if os.path.exists(path) else 0)
+    return min(sizes)
+
+
+class MetricsReader:
+    """
+        Streams a metrics log written by MetricsWriter in chunks of chunk_rows
+        rows, so aggregates never hold more than one chunk of a column.
+    """
+    def __init__(self, root, chunk_rows=1_000_000):
+        self.root = root
+        self.chunk_rows = chunk_rows
+        with open(os.path.join(root, SCHEMA_FILE)) as file:
+            self.dtypes = {name: np.dtype(dtype) for name, dtype in json.load(file).items()}
+
+    def __len__(self):
+        return _n_rows(self.root, self.dtypes)
+
+    def chunks(self, columns=None):
+        """
+        Yield dicts of column arrays of up to chunk_rows rows, oldest first.
+        """
+        columns = list(self.dtypes) if columns is None else columns
+        n_rows = len(self)
+        for start in range(0, n_rows, self.chunk_rows):
+            count = min(self.chunk_rows, n_rows - start)
+            yield {name: np.fromfile(_column_path(self.root, name), dtype=self.dtypes[name], count=count,
+                                     offset=start * self.dtypes[name].itemsize)
+                   for name in columns}
+
+    def read(self, column, every=1):
+        """
+        One column, keeping one row out of `every`.
+        """
+        parts = []
+        offset = 0
+        for chunk in self.chunks([column]):
+            values = chunk[column]
+            parts.append(values[(-offset) % every::every])
+            offset += len(values)
+        return np.concatenate(parts) if parts else np.empty(0, dtype=self.dtypes[column])
+
+    def rolling_mean(self, column="score", window=100, every=1):
+        """
+        Mean of the last `window` rows at each row from the window-th on,
+        keeping the rows that read(column, every) keeps.
+        """
+        parts = []
+        # The last window-1 rows of the previous chunk start the windows of the next one
+        tail = np.empty(0)
+        produced = 0
+        for chunk in self.chunks([column]):
+            values = np.concatenate([tail, chunk[column].astype(np.float64)])
+            cumsum = np.cumsum(np.r_[0.0, values])
+            means = (cumsum[window:] - cumsum[:-window]) / window
+            # means[0] ends at row produced + window - 1
+            parts.append(means[-(produced + window - 1) % every::every])
+            produced += len(means)
+            # A chunk shorter than the window adds its rows to the tail instead
+            tail = values[max(0, len(values) - window + 1):]
+        return np.concatenate(parts) if parts else np.empty(0)
+
+    def summary(self, column="score", percentiles=(5, 25, 50, 75, 95), bins=10_000):
+        """
+        Count, mean, std, min, max and percentiles of a column in two passes.
+        Percentiles come from a bins-bin histogram, so they are exact to
+        within (max - min) / bins.
+        """
+        count, total, total_sq = 0, 0.0, 0.0
+        low, high = np.inf, -np.inf
+        for chunk in self.chunks([column]):
+            values = chunk[column].astype(np.float64)
+            values = values[~np.isnan(values)]
+            count += len(values)
+            total += values.sum()
+            total_sq += np.square(values).sum()
+            if len(values):
+                low, high = min(low, values.min()), max(high, values.max())
+        if count == 0:
+            return {"count": 0}
+        mean = total / count
+        stats = {"count": count, "mean": mean, "std": np.sqrt(max(total_sq / count - mean ** 2, 0.0)),
+                 "min": low, "max": high}
+
+        edges = np.linspace(low, high, bins + 1) if high > low else np.array([low, low + 1.0])
+        hist = np.zeros(len(edges) - 1, dtype=np.int64)
+        for chunk in self.chunks([column]):
+            values = chunk[column].astype(np.float64)
+            hist += np.histogram(values[~np.isnan(values)], bins=edges)[0]
+        cdf = np.cumsum(hist)
+        for q in percentiles:
+            i = min(np.searchsorted(cdf, q / 100 * count), len(hist) - 1)
+            stats[f"p{q}"] = (edges[i] + edges[i + 1]) / 2 if high > low else low
+        return stats
+
+
+def import_legacy_records(path, root):
+    """
+    Write the scores of a save_records.txt file ("Scores: [...]" lines) to
+    a new metrics log, numbering the episodes from 1. Only the score is
+    known. A root that already holds rows is refused, importing twice would
+    duplicate them.
+    """
+    if os.path.exists(os.path.join(root, SCHEMA_FILE)) and len(MetricsReader(root)):
+        raise ValueError(f"{root} already holds a metrics log")
+    writer = MetricsWriter(root)
+    episode = 0
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line.startswith("Scores: ["):
+                continue
+            scores = np.array(line[len("Scores: ["):].rstrip("]").split(","), dtype=np.float64)
+            for score in scores:
+                episode += 1
+                writer.append(episode=episode, score=score, length=-1, spawn_distance=np.nan, wall_time=np.nan)
+    writer.close()
+    return episode
@@ -0,0 +1,113 @@
+import hashlib
+import numpy as np
+
+
+def file_digest(path):
+    """
+    SHA-1 of a file, e.g. of the torch weights an actor is exported from.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def exported_from(path):
+    """
+    file_digest of the weights the actor in path was exported from, None
+    when it was exported without it.
+    """
+    with np.load(path) as data:
+        return str(data["source_digest"]) if "source_digest" in data else None
+
+def save_actor(path, layers, source_digest=None):
+    """
+    Save the actor layers in a NumPy .npz file.
+    Consecutive linear layers without activation are folded in one layer.
+
+    Input:
+        path: str, output file
+        layers: list of (weight (in, out), bias (out,), activation) tuples,
+                activation is "relu" or None
+        source_digest: str, file_digest of the weights the layers come from
+    """
+    folded = []
+    for weight, bias, activation in layers:
+        weight = np.asarray(weight, dtype=np.float64)
+        bias = np.asarray(bias, dtype=np.float64)
+        if folded and folded[-1][2] is None:
+            prev_weight, prev_bias, _ = folded.pop()
+            weight, bias = prev_weight @ weight, prev_bias @ weight + bias
+        folded.append((weight, bias, activation))
+
+    arrays = {"activations": np.array([activation or "" for _, _, activation in folded])}
+    for i, (weight, bias, _) in enumerate(folded):
+        arrays[f"w{i}"] = weight.astype(np.float32)
+        arrays[f"b{i}"] = bias.astype(np.float32)
+    if source_digest is not None:
+        arrays["source_digest"] = np.array(source_digest)
+    np.savez(path, **arrays)
+
+
+class NumpyActor:
+    """
+        Torch-free forward pass of the actor exported with
+        DRL_algorithm.export_actor.
+    """
+    def __init__(self, path="../model/actor_network_ppo.npz", seed=None):
+        with np.load(path) as data:
+            self.activations = [str(activation) for activation in data["activations"]]
+            self.weights = [data[f"w{i}"] for i in range(len(self.activations))]
+            self.biases = [data[f"b{i}"] for i in range(len(self.activations))]
+        self.n_actions = self.biases[-1].shape[0]
+        # Distances of the lidar observations the actor was trained on
+        self.n_lidar = self.weights[0].shape[0]
+        self.rng = np.random.default_rng(seed)
+
+    def forward(self, lidar_states):
+        """
+        Input:
+            lidar_states: array (N, n_lidar), lidar distances
+        Return:
+            float32 array (N, n_actions), log-probabilities of the actions
+        """
+        x = np.asarray(lidar_states, dtype=np.float32) / np.float32(200.0)
+        for weight, bias, activation in zip(self.weights, self.biases, self.activations):
+            x = x @ weight + bias
+            if activation == "relu":
+                np.maximum(x, 0, out=x)
+        # Log-softmax
+        x -= x.max(axis=-1, keepdims=True)
+        x -= np.log(np.exp(x).sum(axis=-1, keepdims=True))
+        return x
+
+    def act(self, lidar_states, greedy=False):
+        """
+        Select the actions of many lidar observations.
+
+        Input:
+            lidar_states: array (N, n_lidar), lidar distances
+            greedy: bool, take the most probable action instead of sampling
+        Return:
+            actions: int64 array (N,)
+            probs: float32 array (N,), log-probabilities of the actions
+        """
+        log_probs = self.forward(lidar_states)
+        if greedy:
+            actions = np.argmax(log_probs, axis=-1)
+        else:
+            # Inverse transform sampling on the cumulative distribution
+            cdf = np.cumsum(np.exp(log_probs), axis=-1)
+            u = self.rng.random((cdf.shape[0], 1)) * cdf[:, -1:]
+            actions = np.minimum(np.sum(cdf < u, axis=-1), self.n_actions - 1)
+        return actions, np.take_along_axis(log_probs, actions[:, None], axis=-1)[:, 0]
+
+    def policy(self, lidar_state, greedy=False):
+        """
+        Select the action of a single lidar observation.
+
+        Return:
+            action (int) and log-probability (float)
+        """
+        actions, probs = self.act(np.asarray(lidar_state)[None], greedy)
+        return int(actions[0]), float(probs[0])
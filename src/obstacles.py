@@ -36,6 +36,17 @@ class Obstacles:
         # Render Bottom wall
         self.bottom_wall = pygame.draw.rect(self.screen, self.wall_color, self.bottom_wall_desc)
 
+    def render_obstacles(self, obstacle_map):
+        """
+
+        Render the interior obstacles of an ObstacleMap
+
+        """
+        for x, y, width, height in obstacle_map.rects:
+            pygame.draw.rect(self.screen, self.wall_color, (int(x), int(y), int(width), int(height)))
+        for x, y, radius in obstacle_map.circles:
+            pygame.draw.circle(self.screen, self.wall_color, (int(x), int(y)), int(radius))
+
 
     
         
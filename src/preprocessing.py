@@ -0,0 +1,61 @@
+import numpy as np
+
+# Size of the preprocessed frames
+FRAME_SIZE = 84
+# Luma weights of the PIL 'L' conversion
+GRAY_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def _bicubic(x, a=-0.5):
+    x = np.abs(x)
+    near = ((a + 2) * x - (a + 3)) * x * x + 1
+    far = (((x - 5) * x + 8) * x - 4) * a
+    return np.where(x < 1, near, np.where(x < 2, far, 0.0))
+
+def resize_matrix(in_size, out_size=FRAME_SIZE):
+    """
+    Matrix (out_size, in_size) of the antialiased bicubic resize used by
+    PIL's Image.resize, so a resize is out = W @ image @ W.T.
+    """
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    center = (np.arange(out_size) + 0.5) * scale
+    x = np.arange(in_size) + 0.5
+    weights = _bicubic((x[None, :] - center[:, None]) / filterscale)
+    weights /= weights.sum(axis=1, keepdims=True)
+    return weights.astype(np.float32)
+
+_resize_matrices = {}
+
+def preprocess_frames(frames):
+    """
+    Grayscale 84x84 uint8 frames from pygame captures.
+
+    The captures of pygame.surfarray are indexed (x, y), so a transpose gives
+    the upright image that the old PIL rotate(-90) + FLIP_LEFT_RIGHT produced.
+
+    Input:
+        frames: uint8 array (N, W, H, 3) or a single capture (W, H, 3)
+    Return:
+        uint8 array (N, 84, 84), or (84, 84) for a single capture
+    """
+    frames = np.asarray(frames)
+    single = frames.ndim == 3
+    if single:
+        frames = frames[None]
+    width, height = frames.shape[1], frames.shape[2]
+    for size in (width, height):
+        if size not in _resize_matrices:
+            _resize_matrices[size] = resize_matrix(size)
+
+    gray = frames @ GRAY_WEIGHTS
+    # (x, y) -> (y, x) and resize in one pass: W_h @ gray.T @ W_w.T
+    resized = _resize_matrices[height] @ np.swapaxes(gray, 1, 2) @ _resize_matrices[width].T
+    resized = np.clip(np.rint(resized), 0, 255).astype(np.uint8)
+    return resized[0] if single else resized
+
+def normalize_frames(frames):
+    """
+    Float32 frames in [0, 1] from uint8 frames.
+    """
+    return np.asarray(frames, dtype=np.float32) / np.float32(255.0)
@@ -0,0 +1,110 @@
+import time
+from contextlib import nullcontext
+
+# Shared do-nothing context returned by disabled profilers
+_NULL_PHASE = nullcontext()
+
+
+class _Phase:
+    __slots__ = ("stats", "start")
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.stats[0] += time.perf_counter() - self.start
+        self.stats[1] += 1
+
+
+class Profiler:
+    """
+        Accumulates the wall time and the number of calls of named phases,
+        plus plain counters.
+
+            with profiler.phase("policy"):
+                ...
+            profiler.count("ppo.samples", 64)
+
+        A disabled profiler hands out one shared null context and ignores
+        counts, so instrumented code costs a method call per phase. Phases
+        may nest; the time of a nested phase is also part of its parent.
+    """
+    def __init__(self, enabled=True, report_every=None):
+        self.enabled = enabled
+        # Steps between printed summaries, None to never print
+        self.report_every = report_every
+        self.reset()
+
+    def reset(self):
+        # name -> [seconds, calls]
+        self.phases = {}
+        self.phase_contexts = {}
+        self.counters = {}
+        self.steps = 0
+        self.start = time.perf_counter()
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        context = self.phase_contexts.get(name)
+        if context is None:
+            stats = self.phases.setdefault(name, [0.0, 0])
+            context = self.phase_contexts[name] = _Phase(stats)
+        return context
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def step(self):
+        """
+        Mark the end of an environment step and print the summary every report_every steps.
+        """
+        if not self.enabled:
+            return
+        self.steps += 1
+        if self.report_every and self.steps % self.report_every == 0:
+            print(self.report())
+
+    def summary(self):
+        """
+        Return:
+            dict with the elapsed seconds, the steps, the counters and, per
+            phase, its total seconds, calls, mean milliseconds per call and
+            share of the elapsed time
+        """
+        elapsed = time.perf_counter() - self.start
+        phases = {}
+        for name, (seconds, calls) in self.phases.items():
+            phases[name] = {"seconds": seconds, "calls": calls,
+                            "mean_ms": 1e3 * seconds / calls if calls else 0.0,
+                            "share": seconds / elapsed if elapsed > 0 else 0.0}
+        summary = {"elapsed": elapsed, "steps": self.steps, "phases": phases, "counters": dict(self.counters)}
+        # Rates of the PPO updates timed by DRL_algorithm.update
+        update = phases.get("ppo.update")
+        if update is not None and update["seconds"] > 0:
+            summary["ppo"] = {
+                "update_ms": update["mean_ms"],
+                "minibatches_per_sec": self.counters.get("ppo.minibatches", 0) / update["seconds"],
+                "samples_per_update": self.counters.get("ppo.samples", 0) / update["calls"]
+            }
+        return summary
+
+    def report(self):
+        summary = self.summary()
+        lines = [f"Profile: {summary['steps']} steps in {summary['elapsed']:.1f} s"]
+        for name, stats in sorted(summary["phases"].items(), key=lambda item: -item[1]["seconds"]):
+            lines.append(f"  {name:20s} {stats['seconds']:9.3f} s {stats['calls']:9d} calls "
+                         f"{stats['mean_ms']:9.3f} ms/call {100 * stats['share']:5.1f} %")
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f"  {name:20s} {value}")
+        for name, value in summary.get("ppo", {}).items():
+            lines.append(f"  ppo.{name:16s} {value:.2f}")
+        return "\n".join(lines)
+
+
+# Default of the instrumented classes when no profiler is given
+NULL_PROFILER = Profiler(enabled=False)
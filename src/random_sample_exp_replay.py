@@ -1,118 +1,160 @@
 import os
-import pandas as pd
 import numpy as np
-from PIL import Image
+from numpy.lib.format import open_memmap
 
+from preprocessing import preprocess_frames, normalize_frames, FRAME_SIZE
+from sum_tree import SumTree
 
-class ReplayBuffer:
 
-    def __init__(self, max_size, pointer, screen):
+class ReplayBuffer:
+    """
+        Experience replay stored in fixed-size memory-mapped .npy files that
+        act as a ring buffer. Reopening the same directory restores the
+        stored experience and the write pointer.
+
+        With prioritized=True transitions are sampled with probability
+        p_i^alpha / sum_k p_k^alpha from a sum tree and sample() also returns
+        their indices and importance-sampling weights. New transitions get
+        the highest priority seen so far. Priorities live in memory only, a
+        reopened buffer starts with equal priorities.
+
+        The lidar columns hold n_lidar distances, the observation size of
+        the simulation (4 lidar lines or the beams of a RayLidar).
+    """
+    ACTIONS = {
+        "NO ACTION": 0,
+        "UP": 1,
+        "DOWN": 2,
+        "LEFT": 3,
+        "RIGHT": 4,
+        "DOUBLE-UP": 5,
+        "DOUBLE-DOWN": 6,
+        "DOUBLE-LEFT": 7,
+        "DOUBLE-RIGHT": 8
+    }
+
+    def __init__(self, max_size, pointer=None, screen=None, root="./dataset",
+                 prioritized=False, alpha=0.6, beta=0.4, eps=1e-6, seed=None, n_lidar=4):
         # Memory
         self.storage = 0
         # Memory size
         self.max_size = max_size
-        # Puntero a las diferentes celdas en la memoria
-        self.experience_ind = pointer        
         self.screen = screen
-        self.flag = False
-
-        self.ACTIONS = {
-            "NO ACTION": 0,            
-            "UP": 1,
-            "DOWN": 2,
-            "LEFT": 3,
-            "RIGHT": 4,
-            "DOUBLE-UP": 5,
-            "DOUBLE-DOWN": 6,
-            "DOUBLE-LEFT": 7,
-            "DOUBLE-RIGHT": 8
-        }
+        self.root = root
+        self.n_lidar = n_lidar
+
+        ######## Storage files
+        os.makedirs(root, exist_ok=True)
+        self.current_frames = self._open("current_frames", (FRAME_SIZE, FRAME_SIZE), np.uint8)
+        self.next_frames = self._open("next_frames", (FRAME_SIZE, FRAME_SIZE), np.uint8)
+        self.current_lidar = self._open("current_lidar", (n_lidar,), np.float32)
+        self.next_lidar = self._open("next_lidar", (n_lidar,), np.float32)
+        self.actions = self._open("actions", (), np.int64)
+        self.rewards = self._open("rewards", (), np.float64)
+        self.dones = self._open("dones", (), np.bool_)
+        # [pointer, storage], kept on disk to resume after a restart
+        self.state = self._open("state", None, np.int64)
+
+        # Puntero a las diferentes celdas en la memoria
+        if pointer is not None:
+            self.state[0] = pointer
+        self.experience_ind = int(self.state[0])
+        self.storage = int(self.state[1])
+
+        ######## Sampling
+        self.rng = np.random.default_rng(seed)
+        self.prioritized = prioritized
+        # Priority exponent, importance-sampling exponent (anneal it towards 1)
+        self.alpha = alpha
+        self.beta = beta
+        # Keeps transitions with a zero TD error reachable
+        self.eps = eps
+        self.max_priority = 1.0
+        if prioritized:
+            self.tree = SumTree(max_size)
+            self.tree.update(np.arange(self.storage), np.ones(self.storage))
+
+    def _open(self, name, shape, dtype):
+        path = os.path.join(self.root, f"{name}.npy")
+        full_shape = (2,) if shape is None else (self.max_size, *shape)
+        if os.path.exists(path):
+            array = open_memmap(path, mode='r+')
+            if array.shape != full_shape or array.dtype != dtype:
+                raise ValueError(f"{path} holds {array.dtype} {array.shape}, expected {np.dtype(dtype)} {full_shape}")
+            return array
+        return open_memmap(path, mode='w+', dtype=dtype, shape=full_shape)
 
     def add(self, experience):
-        ######## Save experience in disk
-
-        # Create the experience folder and subfolders                
-        os.makedirs(f"./dataset/{self.experience_ind}/current_state", exist_ok=True)
-        os.makedirs(f"./dataset/{self.experience_ind}/next_state", exist_ok=True)
-        os.makedirs(f"./dataset/{self.experience_ind}/ard", exist_ok=True)
-        
-
-        # Save current state images
-        #for i, current_cap in enumerate(experience[0]):                   
-
-        current_cap = Image.fromarray(experience[0]).convert('L')                    
-        current_cap = current_cap.rotate(-90)
-        current_cap = current_cap.transpose(Image.FLIP_LEFT_RIGHT)  
-        current_cap = current_cap.resize((84,84))                     
-        current_cap.save(f"./dataset/{self.experience_ind}/current_state/c_s.png")          
-        
-        lidar_current_state = pd.DataFrame(np.array(experience[1]).reshape(1, len(experience[1])) / 200.0)        
-        lidar_current_state.to_csv((f"./dataset/{self.experience_ind}/current_state/lidar.csv"), index=False, mode='w')
-
-        # Save next state images
-        
-        next_cap = Image.fromarray(experience[4]).convert('L')                       
-        next_cap = next_cap.rotate(-90)
-        next_cap = next_cap.transpose(Image.FLIP_LEFT_RIGHT)        
-        next_cap = next_cap.resize((84,84))
-        next_cap.save(f"./dataset/{self.experience_ind}/next_state/n_s.png")
-
-        lidar_next_state = pd.DataFrame(np.array(experience[5]).reshape(1, len(experience[5])) / 200.0)
-        lidar_next_state.to_csv((f"./dataset/{self.experience_ind}/next_state/lidar.csv"), index=False, mode="w")
-
-        # Save action, reward, done
-        ard = pd.DataFrame({"action": [experience[2]], "reward": [experience[3]], "done": [experience[6]]})
-        ard.to_csv((f"./dataset/{self.experience_ind}/ard/ard.csv"), index=False)
-
-        ########
-        
-        self.storage = self.experience_ind
-        self.experience_ind += 1 
+        """
+        Save an experience (current capture, current lidar, action, reward,
+        next capture, next lidar, done) in the ring buffer.
+        """
+        i = self.experience_ind
+        # Both captures are preprocessed in one call
+        self.current_frames[i], self.next_frames[i] = preprocess_frames(np.stack([experience[0], experience[4]]))
+        self.current_lidar[i] = np.asarray(experience[1]) / 200.0
+        self.next_lidar[i] = np.asarray(experience[5]) / 200.0
+        action = experience[2]
+        self.actions[i] = self.ACTIONS[action] if isinstance(action, str) else action
+        self.rewards[i] = experience[3]
+        self.dones[i] = experience[6]
+        if self.prioritized:
+            self.tree.update([i], [self.max_priority ** self.alpha])
+
+        self.experience_ind += 1
         if self.experience_ind >= self.max_size:
-            self.experience_ind = 0    
-            self.flag=True
-        if self.flag:
-            self.storage = self.max_size
-
-        print("EXP ADDED")  
+            self.experience_ind = 0
+        self.storage = min(self.storage + 1, self.max_size)
+        self.state[0] = self.experience_ind
+        self.state[1] = self.storage
         return
 
     def sample(self, batch_size):
-        # Selecting the experience in memory
-        batch = np.random.choice(self.storage, batch_size, replace=False)
-        minibatch_rewards = []
-        minibatch_dones = []
-        minibatch_actions = []
-        minibatch_lidar_c_state, minibatch_lidar_n_state = np.empty((batch_size, 4), dtype=float), np.empty((batch_size, 4), dtype=float)
-        minibatch_current_state, minibatch_next_state = np.empty((batch_size, 84, 84), dtype=float), np.empty((batch_size, 84, 84), dtype=float)
-
-        for i, data_index in enumerate(batch):
-            ### Get data
-            # Getting current state
-            try:            
-                minibatch_current_state[i, :, :] = np.array(Image.open(f"./dataset/{data_index}/current_state/c_s.png")) / 255.0                                
-                lidar_current_state = np.array(pd.read_csv(f"./dataset/{data_index}/current_state/lidar.csv", header=0))
-                minibatch_lidar_c_state[i, :] = lidar_current_state
-                # Getting next state
-                #for j in range(4):
-                
-                minibatch_next_state[i, :, :] = np.array(Image.open(f"./dataset/{data_index}/next_state/n_s.png")) / 255.0
-                lidar_next_state = np.array(pd.read_csv(f"./dataset/{data_index}/next_state/lidar.csv", header=0))
-                minibatch_lidar_n_state[i, :] = lidar_next_state
-                        
-                ard = pd.read_csv(f"./dataset/{data_index}/ard/ard.csv", header=0)          
-                
-                
-                
-                minibatch_rewards.append(ard['reward'])
-                
-                minibatch_actions.append(self.ACTIONS[ard['action'].values[0]])
-                minibatch_dones.append(ard['done'])
-                
-            except Exception as e:
-                print(e)
-                
-                
-
-        return minibatch_current_state, minibatch_lidar_c_state,\
-                  np.array(minibatch_rewards), np.array(minibatch_actions), minibatch_next_state, minibatch_lidar_n_state, np.array(minibatch_dones)
\ No newline at end of file
+        """
+        Draw batch_size transitions, O(batch_size) when uniform and
+        O(batch_size log max_size) when prioritized. Uniform draws are
+        distinct. Prioritized draws take one transition per segment of the
+        priority mass, so a transition holding more than one segment can be
+        drawn several times, as in proportional prioritized replay.
+
+        Return:
+            current frames, current lidar, rewards, actions, next frames, next lidar, dones,
+            and when prioritized also the buffer indices (for update_priorities)
+            and the importance-sampling weights (batch_size, 1), max weight 1
+        """
+        if not self.prioritized:
+            # Floyd's algorithm for large buffers, no permutation of the whole storage
+            batch = np.sort(self.rng.choice(self.storage, batch_size, replace=False))
+            return self._gather(batch)
+
+        # Stratified: one prefix sum in each of batch_size equal segments
+        segment = self.tree.total() / batch_size
+        values = (np.arange(batch_size) + self.rng.random(batch_size)) * segment
+        batch = np.minimum(self.tree.find(values), self.storage - 1)
+        probs = self.tree.priorities(batch) / self.tree.total()
+        weights = (self.storage * probs) ** -self.beta
+        weights /= weights.max()
+        return (*self._gather(batch), batch, weights.astype(np.float32)[:, None])
+
+    def _gather(self, batch):
+        return normalize_frames(self.current_frames[batch]), self.current_lidar[batch], \
+                self.rewards[batch][:, None], self.actions[batch], \
+                normalize_frames(self.next_frames[batch]), self.next_lidar[batch], self.dones[batch][:, None]
+
+    def update_priorities(self, indices, td_errors):
+        """
+        Set the priorities of sampled transitions after a learning step.
+
+        Input:
+            indices: buffer indices returned by sample
+            td_errors: array (batch_size,) or (batch_size, 1), TD errors of those transitions
+        """
+        priorities = np.abs(np.asarray(td_errors, dtype=np.float64).reshape(-1)) + self.eps
+        # A transition drawn twice keeps its last priority
+        self.tree.update(indices, priorities ** self.alpha)
+        self.max_priority = max(self.max_priority, priorities.max())
+
+    def flush(self):
+        for array in (self.current_frames, self.next_frames, self.current_lidar, self.next_lidar,
+                      self.actions, self.rewards, self.dones, self.state):
+            array.flush()
@@ -0,0 +1,241 @@
+"""
+Regression checks of the vectorized code against the code it replaced.
+
+    python regression.py
+    python regression.py --checks simulation,lookup --seed 3
+
+Every check is seeded and compares the outputs of both implementations on
+the same inputs:
+
+    simulation      move, lidar_observations and get_reward against the
+                    pygame rects of Pursuiter, Sensor and Utils
+    lookup          LookupSimulation and BatchedLookupSimulation against
+                    Simulation and BatchedSimulation, step by step
+    preprocessing   preprocess_frames against the PIL pipeline it replaced,
+                    on rendered captures
+
+Checks with mismatches are reported and the exit code is 1.
+"""
+import os
+import sys
+import argparse
+import numpy as np
+
+# Checks, in run order
+CHECKS = ("simulation", "lookup", "preprocessing")
+# Action names of Pursuiter.controls, in the order of simulation.ACTION_DELTAS
+ACTION_NAMES = ("NO ACTION", "UP", "DOWN", "LEFT", "RIGHT", "DOUBLE-UP", "DOUBLE-DOWN", "DOUBLE-LEFT", "DOUBLE-RIGHT")
+# Largest grey level difference allowed between preprocess_frames and PIL,
+# which rounds to uint8 between the two passes of its resize
+FRAME_TOLERANCE = 1
+CLUTTERED_MAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "maps", "cluttered.json")
+
+
+def _result(checked, mismatches, max_error=0.0):
+    return {"checked": int(checked), "mismatches": int(mismatches), "max_error": float(max_error)}
+
+
+####################################
+##           Simulation           ##
+####################################
+
+def check_simulation(seed=0, n_states=2000):
+    """
+    Random states drawn on an off-screen surface with the legacy objects.
+    The lidar is only compared where all the lines reach a wall, Utils
+    keeps the previous distance of a line that does not.
+    """
+    import pygame
+    from obstacles import Obstacles
+    from sensors import Sensor
+    from utils import Utils
+    from pursuiter import Pursuiter
+    from evasor import Evasor
+    from simulation import move, lidar_observations, get_reward
+
+    rng = np.random.default_rng(seed)
+    evasors = rng.integers(20, 180, size=(n_states, 2))
+    pursuiters = rng.integers(18, 183, size=(n_states, 2))
+    actions = rng.integers(0, len(ACTION_NAMES), size=n_states)
+    # Beyond the limits too, where the disk is pushed back
+    far_pursuiters = rng.integers(8, 198, size=(n_states, 2))
+
+    screen = pygame.Surface((200, 200))
+    obstacles = Obstacles(screen)
+    sensor = Sensor()
+    utils = Utils(obstacles, sensor)
+    pursuiter, evasor = Pursuiter(), Evasor()
+
+    legacy_moves = np.empty_like(far_pursuiters)
+    for i, (position, action) in enumerate(zip(far_pursuiters, actions)):
+        pursuiter.position = [int(v) for v in position]
+        pursuiter.controls(ACTION_NAMES[action])
+        legacy_moves[i] = pursuiter.position
+
+    legacy_lidars = np.empty((n_states, 4))
+    legacy_rewards = np.empty(n_states)
+    legacy_dones = np.empty(n_states, dtype=bool)
+    for i in range(n_states):
+        screen.fill((138, 138, 138))
+        obstacles.render_walls()
+        evasor.position = [int(v) for v in evasors[i]]
+        evasor.spawn(screen)
+        pursuiter.position = [int(v) for v in pursuiters[i]]
+        pursuiter.spawn(screen)
+        sensor.update_position(list(pursuiter.position))
+        sensor.lidar(screen)
+        legacy_lidars[i] = utils.lidar_observations(pursuiter.position[0], pursuiter.position[1], evasor)
+        # The reward of the action reads the lidar measured before it
+        pursuiter.controls(ACTION_NAMES[actions[i]])
+        pursuiter.spawn(screen)
+        legacy_rewards[i], legacy_dones[i] = utils.get_reward(pursuiter.robot, evasor.robot, pursuiter.position,
+                                                              evasor.position)
+
+    moves = move(far_pursuiters, actions)
+    lidars = lidar_observations(pursuiters, evasors)
+    rewards, dones = get_reward(move(pursuiters, actions), evasors, lidars)
+    reward_errors = np.abs(rewards - legacy_rewards)
+    return {
+        "simulation.move": _result(n_states, np.any(moves != legacy_moves, axis=-1).sum()),
+        "simulation.lidar_observations": _result(n_states, np.any(lidars != legacy_lidars, axis=-1).sum(),
+                                                 np.abs(lidars - legacy_lidars).max()),
+        "simulation.get_reward": _result(n_states, (reward_errors > 1e-9).sum(), reward_errors.max()),
+        "simulation.get_reward_done": _result(n_states, (dones != legacy_dones).sum())
+    }
+
+
+####################################
+##             Lookup             ##
+####################################
+
+def _configs():
+    from obstacle_map import ObstacleMap
+    from ray_lidar import RayLidar
+
+    return {"empty": (None, None), "cluttered_8beams": (ObstacleMap.from_file(CLUTTERED_MAP), RayLidar(8))}
+
+def check_lookup(seed=0, n_episodes=20, n_envs=16, n_batched_steps=200):
+    """
+    Random actions from random spawns, the lookup simulations must follow
+    the simulations exactly: observations, rewards, dones and positions.
+    The tables are built in memory, nothing is cached.
+    """
+    from simulation import Simulation, BatchedSimulation, TARGET_ZONE
+    from lookup_env import LookupTables, LookupSimulation, BatchedLookupSimulation
+
+    results = {}
+    spawn_band = (TARGET_ZONE, 200.0)
+    for name, (obstacle_map, sensor) in _configs().items():
+        rng = np.random.default_rng(seed)
+        tables = LookupTables((60, 60), obstacle_map, sensor, cache_dir=None)
+        kwargs = dict(seed=seed, obstacle_map=obstacle_map, sensor=sensor, spawn_band=spawn_band)
+
+        simulation, lookup = Simulation(**kwargs), LookupSimulation(tables=tables, **kwargs)
+        checked = mismatches = 0
+        for _ in range(n_episodes):
+            obs, lookup_obs = simulation.reset(), lookup.reset()
+            mismatches += not np.array_equal(obs, lookup_obs)
+            checked += 1
+            while not simulation.episode_over:
+                action = int(rng.integers(len(ACTION_NAMES)))
+                obs, reward, done = simulation.step(action)
+                lookup_obs, lookup_reward, lookup_done = lookup.step(action)
+                mismatches += not (np.array_equal(obs, lookup_obs) and reward == lookup_reward and done == lookup_done
+                                   and np.array_equal(simulation.pursuiter_position, lookup.pursuiter_position))
+                checked += 1
+        results[f"lookup.{name}.steps"] = _result(checked, mismatches)
+
+        simulation = BatchedSimulation(n_envs, **kwargs)
+        lookup = BatchedLookupSimulation(n_envs, tables=tables, **kwargs)
+        mismatches = int(not np.array_equal(simulation.reset(), lookup.reset()))
+        for _ in range(n_batched_steps):
+            actions = rng.integers(len(ACTION_NAMES), size=n_envs)
+            obs, rewards, dones = simulation.step(actions)
+            lookup_obs, lookup_rewards, lookup_dones = lookup.step(actions)
+            mismatches += not (np.array_equal(obs, lookup_obs) and np.array_equal(rewards, lookup_rewards)
+                               and np.array_equal(dones, lookup_dones)
+                               and np.array_equal(simulation.pursuiter_position, lookup.pursuiter_position))
+        results[f"lookup.{name}.batched_steps"] = _result(n_batched_steps + 1, mismatches)
+    return results
+
+
+####################################
+##         Preprocessing          ##
+####################################
+
+def legacy_preprocess_frame(capture):
+    """
+    Frame preprocessing of the PIL pipeline replaced by preprocess_frames.
+    """
+    from PIL import Image
+
+    image = Image.fromarray(capture).convert('L')
+    image = image.rotate(-90)
+    image = image.transpose(Image.FLIP_LEFT_RIGHT)
+    return np.array(image.resize((84, 84)))
+
+def check_preprocessing(seed=0, n_frames=64):
+    """
+    Captures of the Viewer at random states, with and without the obstacles
+    of the cluttered map.
+    """
+    from viewer import Viewer
+    from simulation import Simulation
+    from preprocessing import preprocess_frames
+
+    rng = np.random.default_rng(seed)
+    viewer = Viewer("rgb_array")
+    captures = []
+    for obstacle_map, _ in _configs().values():
+        simulation = Simulation(seed=seed, obstacle_map=obstacle_map)
+        for _ in range(n_frames // 2):
+            simulation.evasor_position = rng.integers(20, 180, size=2)
+            simulation.pursuiter_position = rng.integers(18, 183, size=2)
+            viewer.render(simulation)
+            captures.append(viewer.get_capture())
+    viewer.close()
+
+    frames = preprocess_frames(np.stack(captures)).astype(np.int64)
+    legacy_frames = np.stack([legacy_preprocess_frame(capture) for capture in captures]).astype(np.int64)
+    errors = np.abs(frames - legacy_frames).reshape(len(captures), -1).max(axis=1)
+    return {"preprocessing.preprocess_frames": _result(len(captures), (errors > FRAME_TOLERANCE).sum(), errors.max())}
+
+
+CHECK_FUNCTIONS = {
+    "simulation": check_simulation,
+    "lookup": check_lookup,
+    "preprocessing": check_preprocessing
+}
+
+
+def run(checks=CHECKS, seed=0):
+    """
+    Run the checks.
+
+    Return:
+        dict of results: number of compared items, mismatches and largest error
+    """
+    results = {}
+    for check in checks:
+        results.update(CHECK_FUNCTIONS[check](seed=seed))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checks", default=",".join(CHECKS), help="comma separated checks of " + ", ".join(CHECKS))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    results = run(args.checks.split(","), args.seed)
+    for name, result in results.items():
+        print(f"{name:45s} {result['mismatches']:6d} / {result['checked']:6d} mismatches"
+              f"   max error {result['max_error']:.3g}")
+    failed = [name for name, result in results.items() if result["mismatches"]]
+    for name in failed:
+        print(f"MISMATCH {name}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,39 +1,29 @@
-import numpy as np
+import os
+import sys
 import matplotlib.pyplot as plt
-import pandas as pd
 
+from metrics import MetricsReader, import_legacy_records, SCHEMA_FILE
 
-path = "C:/Carpeta personal/Professional/Portfolio/New folder (2)/Deep-Reinforcement-Learning-Portfolio/smart-disks-PPO/records/save_record_test.txt"
-#path = "C:/Carpeta personal/Professional/Portfolio/New folder (2)/Deep-Reinforcement-Learning-Portfolio/smart-disks-PPO/records/save_records.txt"
 
+# Metrics log written by Environment.run, or a legacy save_records.txt to
+# convert first. The conversion is kept and reused by the next runs.
+path = sys.argv[1] if len(sys.argv) > 1 else "../records/metrics"
+if path.endswith(".txt"):
+    root = path[:-len(".txt")] + "_metrics"
+    if not os.path.exists(os.path.join(root, SCHEMA_FILE)):
+        import_legacy_records(path, root)
+    path = root
 
-records = pd.read_csv(path, header=None)
-#print(type(records.iloc[0,0]))
-#print(records.iloc[0,0])
-records[0] = records[0].str.replace("Scores: [", "")
-records[99] = records[99].str.replace("]", "")
-#records[100] = records[100].str.replace("Losses: [", "")
-#records[199] = records[199].str.replace("]", "")
-records = records.astype(float)
-data = []
-for i in range(records.shape[0]):
-    for j in range(100):
-        data.append(records.iloc[i,j])
-
-x = [i+1 for i in range(records.shape[0]*100)]
-plt.plot(range(100*(records.shape[0])), data, color="#FFA500", alpha=0.7)
+records = MetricsReader(path)
+print(records.summary("score"))
 
+# Long logs are thinned to about 100k plotted points
 window_size = 100
-rolling_average = np.convolve(data, np.ones(window_size)/window_size, mode='valid')
-x_rolling = x[window_size//2 : -(window_size//2) + 1]
+every = max(1, len(records) // 100_000)
+episodes = records.read("episode", every)
+plt.plot(episodes, records.read("score", every), color="#FFA500", alpha=0.7)
 
-plt.plot(x_rolling, rolling_average, label='Average line', linestyle='--', color='green')
-#plt.axhline(mean, color='red')
-plt.ylim(0, 90000)
-plt.show()
-'''
-mean = np.mean(losses)
-plt.plot(range(100*records.shape[0]), losses)
-plt.axhline(mean, color='red')
+rolling_average = records.rolling_mean("score", window_size, every)
+plt.plot(episodes[len(episodes) - len(rolling_average):], rolling_average, label='Average line', linestyle='--', color='green')
+plt.legend()
 plt.show()
-'''
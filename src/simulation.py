@@ -0,0 +1,414 @@
+import numpy as np
+
+from profiling import NULL_PROFILER
+
+####################################
+##        Arena Geometry          ##
+####################################
+
+# Window size in pixels (square world)
+SCREEN_SIZE = 200
+# Thickness of the limit walls
+WALL_WIDTH = 10
+# Radius of the pursuiter and evasor disks
+ROBOT_RADIUS = 8
+# Limits used by Pursuiter.controls to push the disk back into the world
+LOWER_LIMIT = 18
+UPPER_LIMIT = 188
+# Maximum number of steps of an episode
+MAX_RUN_TIME = 452
+
+# Displacement (dx, dy) of every action, same order as Environment.ACTIONS
+ACTION_DELTAS = np.array([
+    [0, 0],     # NO ACTION
+    [0, -2],    # UP
+    [0, 2],     # DOWN
+    [-2, 0],    # LEFT
+    [2, 0],     # RIGHT
+    [0, -4],    # DOUBLE-UP
+    [0, 4],     # DOUBLE-DOWN
+    [-4, 0],    # DOUBLE-LEFT
+    [4, 0]      # DOUBLE-RIGHT
+], dtype=np.int64)
+
+REWARDS = {
+    "COLLISION": -200,
+    "GOAL": 200
+}
+DANGER_ZONE = 25.0
+TARGET_ZONE = 45.0
+
+
+####################################
+##         Arena Physics          ##
+####################################
+# The functions below work on the last axis of their inputs, so they accept a
+# single arena (shape (2,)) as well as a batch of arenas (shape (N, 2)).
+# The rect arithmetic reproduces the pygame rects returned by pygame.draw:
+# a disk of radius 8 covers [x-8, x+8) and a 3 pixel lidar line covers
+# [x-1, x+2) across its direction.
+
+def eucl_distance(pursuiter_pos, evasor_pos):
+    delta = np.asarray(pursuiter_pos, dtype=np.float64) - np.asarray(evasor_pos, dtype=np.float64)
+    return np.sqrt(np.sum(np.power(delta, 2), axis=-1))
+
+def move(position, action):
+    """
+    Apply an action to the pursuiter position, as in Pursuiter.controls.
+
+    Input:
+        position: int array (..., 2), current pursuiter position
+        action: int or int array (...), index of the action
+    Return:
+        int array (..., 2), new position
+    """
+    position = np.asarray(position, dtype=np.int64)
+    delta = ACTION_DELTAS[action]
+    # A disk beyond the limit is pushed back to it instead of moving further
+    backward = np.where(position < LOWER_LIMIT, LOWER_LIMIT, position + delta)
+    forward = np.where(position > UPPER_LIMIT, UPPER_LIMIT, position + delta)
+    return np.where(delta < 0, backward, np.where(delta > 0, forward, position))
+
+def wall_collision(position):
+    position = np.asarray(position)
+    x, y = position[..., 0], position[..., 1]
+    low = WALL_WIDTH + ROBOT_RADIUS
+    high = SCREEN_SIZE - WALL_WIDTH - ROBOT_RADIUS
+    return (x < low) | (y < low) | (x > high) | (y > high)
+
+def evasor_collision(pursuiter_pos, evasor_pos):
+    delta = np.asarray(pursuiter_pos) - np.asarray(evasor_pos)
+    return np.all(np.abs(delta) < 2 * ROBOT_RADIUS, axis=-1)
+
+def lidar_observations(pursuiter_pos, evasor_pos, obstacle_map=None):
+    """
+    Distances measured by the four lidar lines, as in Utils.lidar_observations.
+    With interior obstacles a line measures the nearest of its reading and
+    the distance to the first obstacle it meets.
+
+    Input:
+        pursuiter_pos: array (..., 2)
+        evasor_pos: array (..., 2)
+        obstacle_map: ObstacleMap or None
+    Return:
+        float array (..., 4) with the distances [left, upper, right, bottom]
+    """
+    pursuiter_pos = np.asarray(pursuiter_pos, dtype=np.float64)
+    evasor_pos = np.asarray(evasor_pos, dtype=np.float64)
+    x, y = pursuiter_pos[..., 0], pursuiter_pos[..., 1]
+    dx = x - evasor_pos[..., 0]
+    dy = y - evasor_pos[..., 1]
+    # Vertical lines cover [x-1, x+2), horizontal lines [y-1, y+2)
+    vertical_overlap = (dx > -(ROBOT_RADIUS + 2)) & (dx < ROBOT_RADIUS + 1)
+    horizontal_overlap = (dy > -(ROBOT_RADIUS + 2)) & (dy < ROBOT_RADIUS + 1)
+    # Left line covers [0, x+1), upper [0, y+1), right [x, 200), bottom [y, 200)
+    left_hit = horizontal_overlap & (dx > -(ROBOT_RADIUS + 1))
+    upper_hit = vertical_overlap & (dy > -(ROBOT_RADIUS + 1))
+    right_hit = horizontal_overlap & (dx < ROBOT_RADIUS)
+    bottom_hit = vertical_overlap & (dy < ROBOT_RADIUS)
+
+    wall = SCREEN_SIZE - WALL_WIDTH
+    left = np.where(left_hit, np.abs(dx), x + WALL_WIDTH)
+    upper = np.where(upper_hit, np.abs(dy), y + WALL_WIDTH)
+    right = np.where(right_hit, np.abs(dx), np.abs(x - wall))
+    bottom = np.where(bottom_hit, np.abs(dy), np.abs(y - wall))
+    lidar = np.stack([left, upper, right, bottom], axis=-1)
+    if obstacle_map is not None:
+        lidar = np.minimum(lidar, obstacle_map.lidar_distances(pursuiter_pos))
+    return lidar
+
+def observe(pursuiter_pos, evasor_pos, obstacle_map=None, sensor=None):
+    """
+    Lidar observation: the four legacy lines, or the beams of the sensor
+    (ray_lidar.RayLidar) when one is given.
+    """
+    if sensor is None:
+        return lidar_observations(pursuiter_pos, evasor_pos, obstacle_map)
+    return sensor(pursuiter_pos, evasor_pos, obstacle_map)
+
+def observation_size(sensor=None):
+    return 4 if sensor is None else sensor.n_beams
+
+def danger_zone_rewards(eucl_dist):
+    rate = (DANGER_ZONE - eucl_dist) / (DANGER_ZONE + eucl_dist)
+    return REWARDS["COLLISION"] * rate
+
+def obstacle_collision(position, obstacle_map=None):
+    """
+    Collision with a wall or, when there is a map, an interior obstacle.
+    """
+    collision = wall_collision(position)
+    if obstacle_map is not None:
+        collision = collision | obstacle_map.collides(position, ROBOT_RADIUS)
+    return collision
+
+def get_reward(pursuiter_pos, evasor_pos, lidar, obstacle_map=None):
+    """
+    Reward and termination flag, as in Utils.get_reward. Hitting an interior
+    obstacle is a collision like hitting a wall.
+
+    A pure function of its arguments: the lidar distances are passed in
+    instead of being read from the last lidar_observations call, so rewards
+    can be computed for any batch of states. Utils.get_reward reads the
+    distances measured before the action, so does Simulation.step.
+
+    Input:
+        pursuiter_pos: array (..., 2), pursuiter position after the action
+        evasor_pos: array (..., 2)
+        lidar: array (..., n_beams), lidar observation taken before the action
+        obstacle_map: ObstacleMap or None
+    Return:
+        reward: float array (...)
+        done: bool array (...)
+    """
+    lidar = np.asarray(lidar, dtype=np.float64)
+    delta = np.asarray(pursuiter_pos, dtype=np.float64) - np.asarray(evasor_pos, dtype=np.float64)
+    dx, dy = delta[..., 0], delta[..., 1]
+    # Same operations as eucl_distance and evasor_collision, on the shared delta
+    dist_p_e = np.sqrt(dx * dx + dy * dy)
+    done = obstacle_collision(pursuiter_pos, obstacle_map) \
+        | ((np.abs(dx) < 2 * ROBOT_RADIUS) & (np.abs(dy) < 2 * ROBOT_RADIUS))
+
+    # The first lidar line (left, upper, right, bottom) or beam inside the danger
+    # zone gives the penalty, only while the evasor is out of the target zone
+    in_danger = lidar <= DANGER_ZONE
+    first = np.argmax(in_danger, axis=-1)[..., None]
+    danger_dist = np.take_along_axis(lidar, first, axis=-1)[..., 0]
+    in_danger = np.take_along_axis(in_danger, first, axis=-1)[..., 0] & (dist_p_e > TARGET_ZONE)
+    fc = np.where(done, float(REWARDS["COLLISION"]), np.where(in_danger, danger_zone_rewards(danger_dist), 0.0))
+
+    with np.errstate(divide='ignore'):
+        living = 10 / dist_p_e
+    goal = np.where(dist_p_e <= DANGER_ZONE, 2 * danger_zone_rewards(dist_p_e), float(REWARDS["GOAL"]))
+    fp = np.where(dist_p_e <= TARGET_ZONE, goal, living)
+    return fc + fp, done
+
+def trajectory_rewards(pursuiter_positions, evasor_positions, obstacle_map=None, sensor=None):
+    """
+    Rewards and termination flags of whole trajectories in one call, e.g. to
+    relabel stored episodes. Row 0 holds the spawn and row t the state after
+    step t, the reward of step t uses the lidar measured at row t-1 as in
+    Simulation.step.
+
+    Input:
+        pursuiter_positions: array (T+1, ..., 2)
+        evasor_positions: array broadcastable to pursuiter_positions
+        obstacle_map, sensor: as in Simulation
+    Return:
+        rewards: float array (T, ...)
+        dones: bool array (T, ...)
+    """
+    pursuiter_positions = np.asarray(pursuiter_positions)
+    evasor_positions = np.broadcast_to(evasor_positions, pursuiter_positions.shape)
+    lidar = observe(pursuiter_positions[:-1], evasor_positions[:-1], obstacle_map, sensor)
+    return get_reward(pursuiter_positions[1:], evasor_positions[1:], lidar, obstacle_map)
+
+def valid_spawn(pursuiter_pos, evasor_pos, obstacle_map=None):
+    """
+    Check the spawn conditions of Utils.random_spawn: the pursuiter can not
+    overlap the evasor, a wall or an obstacle and must start out of the
+    target zone.
+    """
+    return ~(evasor_collision(pursuiter_pos, evasor_pos)
+             | (eucl_distance(pursuiter_pos, evasor_pos) <= TARGET_ZONE)
+             | obstacle_collision(pursuiter_pos, obstacle_map))
+
+
+####################################
+##       Headless Simulation      ##
+####################################
+
+class Simulation:
+    """
+        Headless pursuiter/evasor arena. Every quantity is computed from the
+        coordinates of the disks, no pygame display is needed.
+    """
+    def __init__(self, evasor_spawn=(60, 60), pursuiter_spawn=(150, 150), max_run_time=MAX_RUN_TIME, seed=None,
+                 profiler=None, obstacle_map=None, sensor=None, spawn_band=None, spawn_sampler=None):
+        self.rng = np.random.default_rng(seed)
+        # Interior obstacles (obstacle_map.ObstacleMap), None for the empty arena
+        self.obstacle_map = obstacle_map
+        # Beams of the observations (ray_lidar.RayLidar), None for the four lidar lines
+        self.sensor = sensor
+        # Times the move, reward and lidar phases of step
+        self.profiler = NULL_PROFILER if profiler is None else profiler
+        # Default spawn points of the curriculum
+        self.evasor_spawn = np.array(evasor_spawn, dtype=np.int64)
+        self.pursuiter_spawn = np.array(pursuiter_spawn, dtype=np.int64)
+        # Curriculum band (min_distance, max_distance) of the pursuiter spawns
+        # around the evasor, None to start from the default spawn when valid
+        self.spawn_band = spawn_band
+        # spawn_sampler.SpawnSampler of the map, built on the first random spawn
+        self._spawn_sampler = spawn_sampler
+        self.max_run_time = max_run_time
+
+        self.evasor_position = self.evasor_spawn.copy()
+        self.pursuiter_position = self.pursuiter_spawn.copy()
+        # Last lidar observation, [left, upper, right, bottom] without sensor
+        self.lidar = np.zeros(observation_size(sensor))
+        self.run_time = 1
+        self.done = False
+        self.spawn_eucl_dist = 0.0
+
+    @property
+    def spawn_sampler(self):
+        if self._spawn_sampler is None:
+            from spawn_sampler import SpawnSampler
+            self._spawn_sampler = SpawnSampler(self.obstacle_map)
+        return self._spawn_sampler
+
+    def random_spawn(self):
+        """
+        Pursuiter spawn position. Without spawn band the default spawn is used
+        when it is valid, otherwise a valid position is drawn uniformly, in
+        the spawn band when there is one.
+        """
+        position = self.pursuiter_spawn.copy()
+        if self.spawn_band is None and valid_spawn(position, self.evasor_position, self.obstacle_map):
+            return position
+        return self.spawn_sampler.sample(self.evasor_position, self.rng, self.spawn_band)
+
+    def reset(self):
+        """
+        Start a new episode.
+
+        Return:
+            float array (n_beams,), lidar observation of the spawn position
+        """
+        self.evasor_position = self.evasor_spawn.copy()
+        self.pursuiter_position = self.random_spawn()
+        self.spawn_eucl_dist = float(eucl_distance(self.pursuiter_position, self.evasor_position))
+        self.lidar = observe(self.pursuiter_position, self.evasor_position, self.obstacle_map, self.sensor)
+        self.run_time = 1
+        self.done = False
+        return self.lidar.copy()
+
+    def step(self, action):
+        """
+        Execute one action.
+
+        Input:
+            action: int, index of the action
+        Return:
+            obs: float array (n_beams,), lidar observation after the action
+            reward: float
+            done: bool, True when the pursuiter collided
+        """
+        profiler = self.profiler
+        with profiler.phase("move"):
+            self.pursuiter_position = move(self.pursuiter_position, action)
+        # The danger zone uses the lidar distances measured before the action
+        with profiler.phase("reward"):
+            reward, done = get_reward(self.pursuiter_position, self.evasor_position, self.lidar, self.obstacle_map)
+        with profiler.phase("lidar"):
+            self.lidar = observe(self.pursuiter_position, self.evasor_position, self.obstacle_map, self.sensor)
+        self.run_time += 1
+        self.done = bool(done)
+        return self.lidar.copy(), float(reward), self.done
+
+    @property
+    def episode_over(self):
+        return self.done or self.run_time > self.max_run_time
+
+
+####################################
+##       Batched Simulation       ##
+####################################
+
+class BatchedSimulation:
+    """
+        N independent arenas stepped in lockstep. The state of every arena is
+        kept in NumPy arrays and finished arenas are reset automatically.
+    """
+    def __init__(self, n_envs, evasor_spawn=(60, 60), pursuiter_spawn=(150, 150), max_run_time=MAX_RUN_TIME, seed=None,
+                 obstacle_map=None, sensor=None, spawn_band=None, spawn_sampler=None):
+        self.n_envs = n_envs
+        self.rng = np.random.default_rng(seed)
+        # Interior obstacles shared by all the arenas, None for empty arenas
+        self.obstacle_map = obstacle_map
+        # Beams of the observations, None for the four lidar lines
+        self.sensor = sensor
+        # Default spawn points of the curriculum, shared or one per arena
+        self.evasor_spawn = np.broadcast_to(np.array(evasor_spawn, dtype=np.int64), (n_envs, 2)).copy()
+        self.pursuiter_spawn = np.broadcast_to(np.array(pursuiter_spawn, dtype=np.int64), (n_envs, 2)).copy()
+        # Curriculum band of the pursuiter spawns, see Simulation
+        self.spawn_band = spawn_band
+        self._spawn_sampler = spawn_sampler
+        self.max_run_time = max_run_time
+
+        ##### Arena state
+        self.evasor_position = self.evasor_spawn.copy()
+        self.pursuiter_position = self.pursuiter_spawn.copy()
+        self.lidar = np.zeros((n_envs, observation_size(sensor)))
+        self.run_time = np.ones(n_envs, dtype=np.int64)
+        self.spawn_eucl_dist = np.zeros(n_envs)
+        # Arenas that reached the step limit in the last step
+        self.truncated = np.zeros(n_envs, dtype=bool)
+        # Last observations of the arenas that finished in the last step,
+        # before their reset. The rows of the other arenas are outdated.
+        self.final_lidar = np.zeros_like(self.lidar)
+
+    @property
+    def spawn_sampler(self):
+        if self._spawn_sampler is None:
+            from spawn_sampler import SpawnSampler
+            self._spawn_sampler = SpawnSampler(self.obstacle_map)
+        return self._spawn_sampler
+
+    def random_spawn(self, idx):
+        """
+        Pursuiter spawn positions of the arenas idx, drawn as in
+        Simulation.random_spawn for all the arenas at once.
+        """
+        position = self.pursuiter_spawn[idx]
+        evasor_position = self.evasor_position[idx]
+        if self.spawn_band is None:
+            redraw = ~valid_spawn(position, evasor_position, self.obstacle_map)
+        else:
+            redraw = np.ones(len(position), dtype=bool)
+        if np.any(redraw):
+            position[redraw] = self.spawn_sampler.sample_batch(evasor_position[redraw], self.rng, self.spawn_band)
+        return position
+
+    def reset(self, mask=None):
+        """
+        Start a new episode in the selected arenas.
+
+        Input:
+            mask: bool array (N,), arenas to reset. All of them if None
+        Return:
+            float array (N, n_beams), lidar observations of every arena
+        """
+        idx = np.arange(self.n_envs) if mask is None else np.flatnonzero(mask)
+        self.evasor_position[idx] = self.evasor_spawn[idx]
+        self.pursuiter_position[idx] = self.random_spawn(idx)
+        self.spawn_eucl_dist[idx] = eucl_distance(self.pursuiter_position[idx], self.evasor_position[idx])
+        self.lidar[idx] = observe(self.pursuiter_position[idx], self.evasor_position[idx], self.obstacle_map, self.sensor)
+        self.run_time[idx] = 1
+        return self.lidar.copy()
+
+    def step(self, actions):
+        """
+        Execute one action in every arena.
+
+        Input:
+            actions: int array (N,), index of the action of each arena
+        Return:
+            obs: float array (N, n_beams), lidar observations. Finished arenas
+                 return the observation of their new episode
+            rewards: float array (N,)
+            dones: bool array (N,), True where the pursuiter collided
+        """
+        actions = np.asarray(actions, dtype=np.int64)
+        self.pursuiter_position = move(self.pursuiter_position, actions)
+        # The danger zone uses the lidar distances measured before the action
+        rewards, dones = get_reward(self.pursuiter_position, self.evasor_position, self.lidar, self.obstacle_map)
+        self.lidar = observe(self.pursuiter_position, self.evasor_position, self.obstacle_map, self.sensor)
+        self.run_time += 1
+        self.truncated = ~dones & (self.run_time > self.max_run_time)
+
+        finished = dones | self.truncated
+        if np.any(finished):
+            self.final_lidar[finished] = self.lidar[finished]
+            self.reset(finished)
+        return self.lidar.copy(), rewards, dones
@@ -0,0 +1,85 @@
+import numpy as np
+
+from simulation import TARGET_ZONE, eucl_distance, evasor_collision, obstacle_collision
+
+
+class SpawnSampler:
+    """
+        Uniform draws of valid pursuiter spawns without rejection loops.
+
+        The integer positions of [low, high) x [low, high) clear of the walls
+        and the obstacles of the map are found once. For every evasor position
+        the ones that also pass valid_spawn are kept in a table sorted by their
+        distance to the evasor, so a draw is one random index, also for a
+        curriculum band (min_distance, max_distance) of spawn distances: the
+        band is a contiguous slice of the table.
+
+        Tables are cached per evasor position, the oldest one is dropped past
+        max_tables.
+    """
+    def __init__(self, obstacle_map=None, low=20, high=180, max_tables=64):
+        axis = np.arange(low, high, dtype=np.int64)
+        positions = np.stack(np.meshgrid(axis, axis), axis=-1).reshape(-1, 2)
+        # Positions clear of the walls and the obstacles, whatever the evasor position
+        self.free = positions[~obstacle_collision(positions, obstacle_map)]
+        self.max_tables = max_tables
+        # (x, y) of the evasor -> (positions, distances) sorted by distance
+        self.tables = {}
+
+    def table(self, evasor_pos):
+        key = (int(evasor_pos[0]), int(evasor_pos[1]))
+        table = self.tables.get(key)
+        if table is None:
+            distances = eucl_distance(self.free, key)
+            valid = ~evasor_collision(self.free, key) & (distances > TARGET_ZONE)
+            order = np.argsort(distances[valid], kind="stable")
+            table = (self.free[valid][order], distances[valid][order])
+            if len(self.tables) >= self.max_tables:
+                del self.tables[next(iter(self.tables))]
+            self.tables[key] = table
+        return table
+
+    def _band(self, distances, band):
+        if band is None:
+            start, stop = 0, len(distances)
+        else:
+            start = np.searchsorted(distances, band[0], side="left")
+            stop = np.searchsorted(distances, band[1], side="right")
+        if start >= stop:
+            raise ValueError(f"No valid spawn position in the distance band {band}")
+        return start, stop
+
+    def sample(self, evasor_pos, rng, band=None, size=None):
+        """
+        Draw pursuiter spawns for one evasor position.
+
+        Input:
+            evasor_pos: array (2,)
+            rng: np.random.Generator
+            band: (min_distance, max_distance) to the evasor, None for any distance
+            size: number of spawns, None for a single one
+        Return:
+            int array (2,), or (size, 2)
+        """
+        positions, distances = self.table(evasor_pos)
+        start, stop = self._band(distances, band)
+        return positions[rng.integers(start, stop, size=size)].copy()
+
+    def sample_batch(self, evasor_positions, rng, band=None):
+        """
+        Draw one pursuiter spawn per evasor position.
+
+        Input:
+            evasor_positions: array (N, 2)
+        Return:
+            int array (N, 2)
+        """
+        evasor_positions = np.asarray(evasor_positions, dtype=np.int64)
+        spawns = np.empty((len(evasor_positions), 2), dtype=np.int64)
+        # Arenas sharing an evasor position are drawn together
+        unique, inverse = np.unique(evasor_positions, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        for i, evasor_pos in enumerate(unique):
+            rows = np.flatnonzero(inverse == i)
+            spawns[rows] = self.sample(evasor_pos, rng, band, size=len(rows))
+        return spawns
@@ -0,0 +1,53 @@
+import numpy as np
+
+
+class SumTree:
+    """
+        Array-based binary sum tree over `capacity` priorities.
+
+        Node i has children 2i+1 and 2i+2 and holds the sum of its subtree.
+        The leaves are the last `size` nodes, padded to a power of two so
+        all of them are at the same depth. Updates and searches work on
+        batches of indices, one tree level at a time.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 1
+        while self.size < capacity:
+            self.size *= 2
+        self.depth = int(np.log2(self.size))
+        self.tree = np.zeros(2 * self.size - 1, dtype=np.float64)
+
+    def total(self):
+        return self.tree[0]
+
+    def priorities(self, indices):
+        return self.tree[np.asarray(indices) + self.size - 1]
+
+    def update(self, indices, priorities):
+        """
+        Set the priorities of the leaves `indices`, O(k log n) for k indices.
+        """
+        nodes = np.asarray(indices, dtype=np.int64) + self.size - 1
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique((nodes - 1) // 2)
+            self.tree[nodes] = self.tree[2 * nodes + 1] + self.tree[2 * nodes + 2]
+
+    def find(self, values):
+        """
+        Leaves where the prefix sums `values` fall, O(k log n) for k values.
+
+        Input:
+            values: float array (k,), each one in [0, total())
+        Return:
+            int array (k,), leaf indices
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.zeros(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes + 1
+            go_right = values >= self.tree[left]
+            values -= np.where(go_right, self.tree[left], 0.0)
+            nodes = np.where(go_right, left + 1, left)
+        return nodes - (self.size - 1)
@@ -0,0 +1,184 @@
+import multiprocessing as mp
+import numpy as np
+
+from simulation import BatchedSimulation, observation_size
+
+
+def _worker(remote, parent_remote, buffers, start, stop, simulation_kwargs, seed):
+    """
+    Worker process loop. The arenas [start, stop) are simulated here and
+    their results are written in the shared buffers, the pipe only carries
+    the commands and the acknowledgements.
+    """
+    parent_remote.close()
+    simulation = BatchedSimulation(stop - start, seed=seed, **simulation_kwargs)
+    obs, rewards, dones, truncated, actions, spawn_distances, final_obs = \
+        _as_arrays(buffers, observation_size(simulation.sensor))
+    try:
+        while True:
+            cmd = remote.recv()
+            if cmd == "step":
+                obs[start:stop], rewards[start:stop], dones[start:stop] = simulation.step(actions[start:stop])
+                truncated[start:stop] = simulation.truncated
+                spawn_distances[start:stop] = simulation.spawn_eucl_dist
+                final_obs[start:stop] = simulation.final_lidar
+            elif cmd == "reset":
+                obs[start:stop] = simulation.reset()
+                rewards[start:stop] = 0.0
+                dones[start:stop] = False
+                truncated[start:stop] = False
+                spawn_distances[start:stop] = simulation.spawn_eucl_dist
+            elif cmd == "close":
+                break
+            remote.send(True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        remote.close()
+
+def _as_arrays(buffers, n_obs):
+    obs, rewards, dones, truncated, actions, spawn_distances, final_obs = buffers
+    return np.frombuffer(obs, dtype=np.float32).reshape(-1, n_obs), \
+            np.frombuffer(rewards, dtype=np.float64), \
+            np.frombuffer(dones, dtype=np.bool_), \
+            np.frombuffer(truncated, dtype=np.bool_), \
+            np.frombuffer(actions, dtype=np.int64), \
+            np.frombuffer(spawn_distances, dtype=np.float64), \
+            np.frombuffer(final_obs, dtype=np.float32).reshape(-1, n_obs)
+
+
+class SubprocVecEnv:
+    """
+        Runs the arenas in n_workers processes, each one simulating
+        envs_per_worker arenas with a BatchedSimulation.
+
+        Observations, rewards, dones and actions live in preallocated shared
+        memory buffers. The workers are split in n_batches groups that can be
+        stepped independently, so the policy can run on the observations of
+        one group while the other groups are simulating:
+
+            for batch in range(env.n_batches):
+                env.reset_async(batch)
+            while training:
+                for batch in range(env.n_batches):
+                    obs, rewards, dones = env.step_wait(batch)
+                    actions, probs, vals = drl_algorithm.policy_batch(obs)
+                    env.step_async(actions, batch)
+    """
+    def __init__(self, n_workers, envs_per_worker=1, n_batches=1, seed=None, start_method=None, **simulation_kwargs):
+        if n_workers % n_batches != 0:
+            raise ValueError("n_workers must be a multiple of n_batches")
+        self.n_workers = n_workers
+        self.envs_per_worker = envs_per_worker
+        self.n_batches = n_batches
+        self.n_envs = n_workers * envs_per_worker
+        # Width of the observations, 4 lidar lines or the beams of the sensor
+        self.n_obs = observation_size(simulation_kwargs.get("sensor"))
+        self.closed = False
+
+        ctx = mp.get_context(start_method)
+        ##### Shared buffers
+        self.buffers = (
+            ctx.RawArray('f', self.n_envs * self.n_obs),    # observations
+            ctx.RawArray('d', self.n_envs),                 # rewards
+            ctx.RawArray('b', self.n_envs),                 # dones
+            ctx.RawArray('b', self.n_envs),                 # truncated
+            ctx.RawArray('q', self.n_envs),                 # actions
+            ctx.RawArray('d', self.n_envs),                 # spawn distances of the current episodes
+            ctx.RawArray('f', self.n_envs * self.n_obs)     # observations of the finished arenas before their reset
+        )
+        # truncated, spawn_eucl_dist and final_lidar are read like the ones of a BatchedSimulation
+        self.obs, self.rewards, self.dones, self.truncated, self.actions, self.spawn_eucl_dist, self.final_lidar = \
+            _as_arrays(self.buffers, self.n_obs)
+
+        ##### Workers
+        seeds = np.random.SeedSequence(seed).spawn(n_workers)
+        self.remotes, self.processes = [], []
+        for i in range(n_workers):
+            remote, work_remote = ctx.Pipe()
+            start, stop = i * envs_per_worker, (i + 1) * envs_per_worker
+            process = ctx.Process(target=_worker,
+                                  args=(work_remote, remote, self.buffers, start, stop, simulation_kwargs, seeds[i]),
+                                  daemon=True)
+            process.start()
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+
+        # Workers and arenas of every batch
+        workers_per_batch = n_workers // n_batches
+        self.batch_workers = [range(b * workers_per_batch, (b + 1) * workers_per_batch) for b in range(n_batches)]
+        self.batch_envs = [slice(b * workers_per_batch * envs_per_worker, (b + 1) * workers_per_batch * envs_per_worker)
+                           for b in range(n_batches)]
+        self.waiting = [False] * n_batches
+
+    def _send(self, cmd, batch):
+        batches = range(self.n_batches) if batch is None else [batch]
+        for b in batches:
+            for i in self.batch_workers[b]:
+                self.remotes[i].send(cmd)
+            self.waiting[b] = True
+
+    def _wait(self, batch):
+        batches = range(self.n_batches) if batch is None else [batch]
+        for b in batches:
+            if self.waiting[b]:
+                for i in self.batch_workers[b]:
+                    self.remotes[i].recv()
+                self.waiting[b] = False
+        envs = slice(None) if batch is None else self.batch_envs[batch]
+        return envs
+
+    def reset_async(self, batch=None):
+        self._send("reset", batch)
+
+    def reset_wait(self, batch=None):
+        """
+        Return:
+            float32 array (n, n_obs), observations of the batch (all arenas if None)
+        """
+        envs = self._wait(batch)
+        return self.obs[envs].copy()
+
+    def reset(self, batch=None):
+        self.reset_async(batch)
+        return self.reset_wait(batch)
+
+    def step_async(self, actions, batch=None):
+        """
+        Write the actions in the shared buffer and let the workers simulate.
+
+        Input:
+            actions: int array (n,), actions of the batch (all arenas if None)
+        """
+        envs = slice(None) if batch is None else self.batch_envs[batch]
+        self.actions[envs] = actions
+        self._send("step", batch)
+
+    def step_wait(self, batch=None):
+        """
+        Wait for the workers of the batch.
+
+        Return:
+            obs: float32 array (n, n_obs)
+            rewards: float array (n,)
+            dones: bool array (n,)
+        """
+        envs = self._wait(batch)
+        return self.obs[envs].copy(), self.rewards[envs].copy(), self.dones[envs].copy()
+
+    def step(self, actions, batch=None):
+        self.step_async(actions, batch)
+        return self.step_wait(batch)
+
+    def close(self):
+        if self.closed:
+            return
+        self._wait(None)
+        for remote in self.remotes:
+            remote.send("close")
+        for process in self.processes:
+            process.join()
+        for remote in self.remotes:
+            remote.close()
+        self.closed = True
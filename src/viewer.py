@@ -0,0 +1,86 @@
+import sys
+import pygame
+
+from pursuiter import Pursuiter
+from evasor import Evasor
+from obstacles import Obstacles
+
+# "human" draws in a window, "rgb_array" draws off-screen for captures and
+# "none" does not draw at all (no Viewer is created)
+RENDER_MODES = ("human", "rgb_array", "none")
+
+
+class Viewer:
+    """
+        Optional pygame window that draws the state of a Simulation.
+        The simulation does not depend on it.
+    """
+    def __init__(self, render_mode="human"):
+        self.render_mode = render_mode
+        if render_mode == "human":
+            # Initialise pygame
+            pygame.init()
+            # Set window
+            self.screen = pygame.display.set_mode((200, 200))
+        else:
+            # Off-screen surface, no display is opened
+            self.screen = pygame.Surface((200, 200))
+        # FPS controler
+        self.clock = pygame.time.Clock()
+        self.background_color = (138, 138, 138)
+
+        ##### Drawable objects
+        self.obstacles = Obstacles(self.screen)
+        self.pursuiter = Pursuiter()
+        self.evasor = Evasor()
+
+    def render(self, simulation):
+        """
+        Draw the world and update the display
+
+        Input:
+            simulation: Simulation object to draw
+        """
+        self.pursuiter.position = [int(simulation.pursuiter_position[0]), int(simulation.pursuiter_position[1])]
+        self.evasor.position = [int(simulation.evasor_position[0]), int(simulation.evasor_position[1])]
+        # Draw background
+        self.screen.fill(self.background_color)
+        # Draw obstacles
+        self.obstacles.render_walls()
+        if simulation.obstacle_map is not None:
+            self.obstacles.render_obstacles(simulation.obstacle_map)
+        # Draw pursuiter
+        self.pursuiter.spawn(self.screen)
+        # Draw evasor
+        self.evasor.spawn(self.screen)
+        # Update the display
+        if self.render_mode == "human":
+            pygame.display.update()
+
+    def handle_events(self):
+        if self.render_mode != "human":
+            return
+        for event in pygame.event.get():
+            # Exit event
+            if event.type == pygame.QUIT:
+                sys.exit()
+
+    def get_capture(self):
+        """
+            Capture the current state image.
+            Return:
+                captured (NumPy array): Return a NumPy array image with dimensions (200, 200, 3).
+
+        """
+        if self.render_mode != "human":
+            return pygame.surfarray.array3d(self.screen)
+        # Create the Surface
+        capture = pygame.Surface((self.screen.get_width(), self.screen.get_height()))
+        # Blit the screen on the Surface
+        capture.blit(self.screen, (0, 0))
+        # Convert from Surface to Array
+        return pygame.surfarray.array3d(capture)
+
+    def close(self):
+        if self.render_mode == "human":
+            pygame.quit()